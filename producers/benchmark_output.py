@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Benchmark the output policies (chunking & compression, see
+smalldata_tools/SmallDataOutputPolicy.py) on a synthetic small data file.
+
+The file has the dataset classes of a typical producer output: scalars (event
+codes, ipm sums,...), traces (azav, projections) and calibrated ROIs. It is written
+uncompressed like small_data does, then repacked with each policy. For each policy
+the write (repack) throughput, the file size and the read throughput of column
+reads of all scalars (pytables, like SmallDataAna), full trace reads and random
+single event ROI reads are reported.
+
+examples:
+    python benchmark_output.py --nevents 20000
+    python benchmark_output.py --policies none blosc lz4 --output bench_output.json
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+fpath=os.path.dirname(os.path.abspath(__file__))
+fpathup = '/'.join(fpath.split('/')[:-1])
+sys.path.append(fpathup)
+
+from smalldata_tools.SmallDataOutputPolicy import OutputPolicy, repack, compressions
+#after the output policy, which sets up the plugin path for the filters
+import tables
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--nevents', help='number of events', type=int, default=20000)
+parser.add_argument('--nscalars', help='number of scalar datasets', type=int, default=50)
+parser.add_argument('--ntraces', help='number of trace datasets', type=int, default=4)
+parser.add_argument('--tracelen', help='length of the traces', type=int, default=500)
+parser.add_argument('--roi', help='shape of the ROI', type=int, nargs=2, default=[64,64])
+parser.add_argument('--occupancy', help='photons/pixel in the ROI', type=float, default=0.05)
+parser.add_argument('--adu', help='ADU per photon of the ROI', type=float, default=150.)
+parser.add_argument('--policies', help='compressions to test (quantize: blosc w/ photon counts)', nargs='+', default=compressions+['quantize'])
+parser.add_argument('--nreads', help='number of random single event ROI reads', type=int, default=500)
+parser.add_argument('--dir', help='directory for the files', type=str, default=None)
+parser.add_argument('--output', help='write results to json file', type=str, default=None)
+args = parser.parse_args()
+
+def writeTestFile(fname):
+    """ file as written by small_data: one contiguous dataset per variable """
+    rng = np.random.default_rng(0)
+    nEvt = args.nevents
+    with h5py.File(fname, 'w') as f:
+        f['event_time'] = (np.uint64(1600000000)<<np.uint64(32)) + np.arange(nEvt, dtype=np.uint64)*np.uint64(8333333)
+        f['fiducials'] = (np.arange(nEvt)*3).astype(np.int32)
+        f['lightStatus/xray'] = (rng.random(nEvt)>0.1).astype(np.int32)
+        f['lightStatus/laser'] = (np.arange(nEvt)%2).astype(np.int32)
+        for i in range(args.nscalars):
+            f['ipm%d/sum'%i] = (rng.normal(1., 0.2, nEvt)).astype(np.float64)
+        q = np.linspace(0, 1, args.tracelen)
+        for i in range(args.ntraces):
+            f['epix/azav_%d'%i] = (np.exp(-q*5)[np.newaxis]*rng.normal(1., 0.05, (nEvt,1))+rng.normal(0, 0.01, (nEvt, args.tracelen))).astype(np.float32)
+        roi = f.create_dataset('epix/ROI_0_area', shape=(nEvt,)+tuple(args.roi), dtype=np.float32)
+        for start in range(0, nEvt, 1000):
+            n = min(1000, nEvt-start)
+            photons = rng.poisson(args.occupancy, (n,)+tuple(args.roi))
+            roi[start:start+n] = photons*args.adu+rng.normal(0, 0.05*args.adu, photons.shape)
+        f['UserDataCfg/epix/ROI_0_ROI'] = np.array([[0, args.roi[0]], [0, args.roi[1]]])
+        f['Sums/epix_calib'] = rng.random((704, 768))
+
+def dataMB(fname):
+    with h5py.File(fname, 'r') as f:
+        sizes = []
+        f.visititems(lambda name, obj: sizes.append(obj.size*obj.dtype.itemsize) if isinstance(obj, h5py.Dataset) else None)
+    return sum(sizes)/1024.**2
+
+def readBenchmark(fname):
+    res = {}
+    #column reads of all scalars like SmallDataAna
+    t0 = time.time()
+    nBytes = 0
+    with tables.open_file(fname, 'r') as fh5:
+        for node in fh5.walk_nodes('/', classname='Array'):
+            if len(node.shape)==1 and node.shape[0]==args.nevents:
+                nBytes += node.read().nbytes
+    res['scalarReadMBs'] = nBytes/1024.**2/(time.time()-t0)
+    with h5py.File(fname, 'r') as f:
+        t0 = time.time()
+        nBytes = sum([f['epix/azav_%d'%i][:].nbytes for i in range(args.ntraces)])
+        res['traceReadMBs'] = nBytes/1024.**2/(time.time()-t0)
+        rng = np.random.default_rng(1)
+        idx = rng.integers(0, args.nevents, args.nreads)
+        t0 = time.time()
+        for i in idx:
+            f['epix/ROI_0_area'][i]
+        res['roiReadEvtPerS'] = args.nreads/(time.time()-t0)
+    return res
+
+tmpDir = args.dir if args.dir is not None else tempfile.mkdtemp(prefix='smd_output_')
+baseName = os.path.join(tmpDir, 'bench_base.h5')
+t0 = time.time()
+writeTestFile(baseName)
+print('Wrote test file with %d events in %.1f s: %.1f MB of data'%(args.nevents, time.time()-t0, dataMB(baseName)))
+totalMB = dataMB(baseName)
+
+results = {'nevents': args.nevents, 'dataMB': totalMB, 'policies': {}}
+res = {'sizeMB': os.path.getsize(baseName)/1024.**2, 'writeMBs': np.nan}
+res.update(readBenchmark(baseName))
+results['policies']['small_data'] = res
+for name in args.policies:
+    if name=='quantize':
+        policy = OutputPolicy(compression='blosc', quantize={'epix/ROI_0_area': args.adu})
+    else:
+        policy = OutputPolicy(compression=name)
+    fname = os.path.join(tmpDir, 'bench_%s.h5'%name)
+    t0 = time.time()
+    sizeBefore, sizeAfter = repack(baseName, policy, outname=fname)
+    res = {'compression': policy.compression, 'sizeMB': sizeAfter/1024.**2, 'writeMBs': totalMB/(time.time()-t0)}
+    res.update(readBenchmark(fname))
+    results['policies'][name] = res
+    os.remove(fname)
+os.remove(baseName)
+
+print('\n%-12s %10s %8s %12s %14s %13s %13s'%('policy', 'size [MB]', 'ratio', 'write [MB/s]', 'scalars [MB/s]', 'traces [MB/s]', 'ROI [evt/s]'))
+for name, res in results['policies'].items():
+    print('%-12s %10.1f %8.2f %12.1f %14.1f %13.1f %13.0f'%(name, res['sizeMB'], totalMB/res['sizeMB'], res['writeMBs'],
+                                                          res['scalarReadMBs'], res['traceReadMBs'], res['roiReadEvtPerS']))
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Benchmark the smalldata producer building blocks on simulated data (see
+smalldata_tools/psana_sim.py), no psana installation or xtc files are needed.
+
+For each simulated area detector, every DetObjectFunc is timed on its own
+(events/s, peak memory of the processing step via tracemalloc), then the full
+chain as set up in define_dets (default detectors, DetObject.getData, all
+functions, getUserData, storeSum) is run over the events.
+
+examples:
+    python benchmark_producer.py --detectors jungfrau1M epix100 --nevents 50
+    python benchmark_producer.py --output bench.json
+    python benchmark_producer.py --compare bench.json --tolerance 0.25
+With --compare, the script exits with 1 if any rate dropped by more than the tolerance.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import logging
+import resource
+import tracemalloc
+import importlib
+import platform
+import numpy as np
+
+fpath=os.path.dirname(os.path.abspath(__file__))
+fpathup = '/'.join(fpath.split('/')[:-1])
+sys.path.append(fpathup)
+
+from smalldata_tools import psana_sim
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--detectors', help='simulated area detectors', nargs='+', default=list(psana_sim.areaDetSpecs.keys()))
+parser.add_argument('--funcs', help='functions to benchmark (default: all)', nargs='+', default=None)
+parser.add_argument('--nevents', help='number of events', type=int, default=100)
+parser.add_argument('--nframes', help='number of distinct frames used for the function benchmarks', type=int, default=10)
+parser.add_argument('--memevents', help='number of events used to measure the peak memory', type=int, default=3)
+parser.add_argument('--occupancy', help='mean number of photons/pixel (scaled by pulse energy)', type=float, default=2e-3)
+parser.add_argument('--seed', help='seed of the simulation', type=int, default=0)
+parser.add_argument('--hutch', help='hutch for the default detectors', type=str, default='xpp')
+parser.add_argument('--nochain', help='skip the define_dets chain', action='store_true', default=False)
+parser.add_argument('--nofuncs', help='skip the single function benchmarks', action='store_true', default=False)
+parser.add_argument('--output', help='write results to json file', type=str, default=None)
+parser.add_argument('--compare', help='json file of a previous run to compare to', type=str, default=None)
+parser.add_argument('--tolerance', help='allowed relative drop of events/s for --compare', type=float, default=0.2)
+args = parser.parse_args()
+
+psana = psana_sim.install(areaDets=args.detectors, nEvents=args.nevents, seed=args.seed, occupancy=args.occupancy)
+
+#these import psana: only after the simulation has been installed
+from smalldata_tools.DetObject import DetObject
+from smalldata_tools.SmallDataUtils import defaultDetectors, detData, getUserData
+
+def photonADU(alias):
+    """ signal of one photon in units of calib """
+    spec = psana_sim.areaDetSpecs[alias]
+    if spec['nGains'] > 1:
+        return psana_sim._config.photonEnergy
+    return psana_sim._config.photonEnergy*spec['aduPerKeV']
+
+def defaultROI(alias):
+    """ ROI around the powder ring in the first tile """
+    shape = psana_sim.areaDetSpecs[alias]['shape']
+    roi = [[shape[-2]//4, shape[-2]*3//4], [shape[-1]//4, shape[-1]*3//4]]
+    if len(shape) > 2:
+        roi = [[0,1]] + roi
+    return roi
+
+###
+# functions to benchmark: name -> (module, class name, function returning the kwargs
+# for a detector, optional subfunction (module, class, kwargs function)).
+###
+funcDefs = {
+    'ROI': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'ROI_0', 'ROI': defaultROI(a)}, None),
+    'ROI_area': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'ROI_area', 'ROI': defaultROI(a), 'writeArea': True}, None),
+    'projection': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'ROI_pj', 'ROI': defaultROI(a)},
+                   ('roi_rebin', 'projectionFunc', lambda a: {'axis': 0, 'thresADU': 0.5*photonADU(a)})),
+    'spectrum': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'ROI_spec', 'ROI': defaultROI(a)},
+                 ('roi_rebin', 'spectrumFunc', lambda a: {'bins': [-0.5*photonADU(a), 4.5*photonADU(a), 0.05*photonADU(a)]})),
+    'sparsify': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'ROI_sparse', 'ROI': defaultROI(a), 'thresADU': 0.5*photonADU(a)},
+                 ('roi_rebin', 'sparsifyFunc', lambda a: {'nData': 2000})),
+    'image': ('roi_rebin', 'ROIFunc', lambda a: {'name': 'full'},
+              ('roi_rebin', 'imageFunc', lambda a: {'coords': ['x','y']})),
+    'photon': ('photons', 'photonFunc', lambda a: {'ADU_per_photon': photonADU(a), 'thresADU': 0.5*photonADU(a)}, None),
+    'droplet': ('droplet', 'dropletFunc', lambda a: {'threshold': 5., 'thresholdLow': 3., 'thresADU': 0.5*photonADU(a)}, None),
+    'droplet2': ('droplet2Func', 'droplet2Func', lambda a: {'threshold': 0.5*photonADU(a), 'aduspphot': photonADU(a), 'offset': 0.5*photonADU(a)}, None),
+    'azav': ('azimuthalBinning', 'azimuthalBinning', lambda a: {'center': [0., 0.], 'dis_to_sam': 80., 'eBeam': psana_sim._config.photonEnergy, 'qbin': 0.01}, None),
+}
+
+def makeFunc(funcName, alias):
+    """ instantiate the function (and its subfunction), None if the module can not be imported """
+    modName, clsName, kwFunc, subDef = funcDefs[funcName]
+    try:
+        cls = getattr(importlib.import_module('smalldata_tools.ana_funcs.%s'%modName), clsName)
+        func = cls(**kwFunc(alias))
+        if subDef is not None:
+            subCls = getattr(importlib.import_module('smalldata_tools.ana_funcs.%s'%subDef[0]), subDef[1])
+            func.addFunc(subCls(**subDef[2](alias)))
+    except Exception as e:
+        logger.warning('Function {0} is not available: {1}'.format(funcName, e))
+        return None
+    return func
+
+def maxRSS():
+    """ peak resident memory of this process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+def benchFunc(det, func, frames, nEvents, memEvents):
+    """ time func.process on copies of the frames, then measure its peak memory """
+    det.addFunc(func)
+    res = {}
+    try:
+        func.process(frames[0].copy()) #warm up, e.g. numba compilation
+        tProc = 0.
+        for iEvt in range(nEvents):
+            dat = frames[iEvt%len(frames)].copy()
+            tStart = time.perf_counter()
+            func.process(dat)
+            tProc += time.perf_counter()-tStart
+        res['evts_per_s'] = nEvents/tProc if tProc > 0 else np.inf
+        res['ms_per_evt'] = 1e3*tProc/nEvents
+        tracemalloc.start()
+        for iEvt in range(min(memEvents, nEvents)):
+            dat = frames[iEvt%len(frames)].copy()
+            tracemalloc.reset_peak()
+            baseMem = tracemalloc.get_traced_memory()[0]
+            func.process(dat)
+            res['peak_MB'] = max(res.get('peak_MB', 0.), (tracemalloc.get_traced_memory()[1]-baseMem)/1024.**2)
+        tracemalloc.stop()
+    except Exception as e:
+        logger.warning('Function {0} failed: {1}'.format(func._name, e))
+        res = {'error': str(e)}
+    del det.__dict__[func._name]
+    return res
+
+def runFuncBenchmarks(ds, funcNames):
+    results = {}
+    for alias in args.detectors:
+        det = DetObject(alias, ds.env(), psana_sim._config.run)
+        frames = []
+        tGet = 0.
+        for evt in ds.events():
+            if len(frames) >= args.nframes:
+                break
+            det.det.raw(evt) #simulate the frame outside of the timing
+            tStart = time.perf_counter()
+            det.getData(evt)
+            tGet += time.perf_counter()-tStart
+            frames.append(det.evt.dat.copy())
+        results[alias] = {'getData': {'evts_per_s': len(frames)/tGet, 'ms_per_evt': 1e3*tGet/len(frames)}}
+        for funcName in funcNames:
+            func = makeFunc(funcName, alias)
+            if func is None:
+                results[alias][funcName] = {'error': 'not available'}
+                continue
+            results[alias][funcName] = benchFunc(det, func, frames, args.nevents, args.memevents)
+        del frames
+    return results
+
+def define_dets(ds, funcNames):
+    """ all simulated area detectors with all available functions, as in the producer """
+    dets = []
+    for alias in args.detectors:
+        det = DetObject(alias, ds.env(), psana_sim._config.run)
+        for funcName in funcNames:
+            func = makeFunc(funcName, alias)
+            if func is not None:
+                det.addFunc(func)
+        det.storeSum(sumAlgo='calib')
+        dets.append(det)
+    return dets
+
+def runChain(ds, funcNames):
+    """ event loop of smd_producer on the simulated events, time per step """
+    default_dets = defaultDetectors(args.hutch)
+    dets = define_dets(ds, funcNames)
+    times = {'simulation': 0., 'default': 0., 'getData': 0., 'processFuncs': 0., 'userData': 0., 'processSums': 0.}
+    nEvt = 0
+    tracemalloc.start()
+    peakMem = 0.
+    tStartLoop = time.perf_counter()
+    for evt in ds.events():
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            baseMem = tracemalloc.get_traced_memory()[0]
+        tStart = time.perf_counter()
+        for det in dets:
+            det.det.raw(evt)
+        tNow = time.perf_counter()
+        times['simulation'] += tNow-tStart
+        detData(default_dets, evt)
+        tLast, tNow = tNow, time.perf_counter()
+        times['default'] += tNow-tLast
+        userDict = {}
+        for det in dets:
+            det.getData(evt)
+            tLast, tNow = tNow, time.perf_counter()
+            times['getData'] += tNow-tLast
+            det.processFuncs()
+            tLast, tNow = tNow, time.perf_counter()
+            times['processFuncs'] += tNow-tLast
+            userDict[det._name] = getUserData(det)
+            tLast, tNow = tNow, time.perf_counter()
+            times['userData'] += tNow-tLast
+            det.processSums()
+            tLast, tNow = tNow, time.perf_counter()
+            times['processSums'] += tNow-tLast
+        nEvt += 1
+        if tracing:
+            peakMem = max(peakMem, (tracemalloc.get_traced_memory()[1]-baseMem)/1024.**2)
+            if nEvt >= args.memevents:
+                #stop tracing, it slows down the python heavy parts
+                tracemalloc.stop()
+                tStartLoop = time.perf_counter()
+                times = {k: 0. for k in times}
+                nEvtTimed = nEvt
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+        nEvtTimed = 0
+    tLoop = time.perf_counter()-tStartLoop
+    nTimed = nEvt-nEvtTimed
+    tNoSim = tLoop-times['simulation']
+    res = {'nevents': nTimed,
+           'evts_per_s': nTimed/tNoSim if tNoSim > 0 and nTimed > 0 else np.nan,
+           'peak_MB': peakMem,
+           'ms_per_evt': {k: 1e3*v/max(1,nTimed) for k,v in times.items()}}
+    return res
+
+def printResults(results):
+    if 'funcs' in results:
+        print('%-12s %-12s %12s %12s %10s'%('detector', 'function', 'evts/s', 'ms/evt', 'peak MB'))
+        for alias, funcRes in results['funcs'].items():
+            for funcName, res in funcRes.items():
+                if 'error' in res:
+                    print('%-12s %-12s %s'%(alias, funcName, res['error']))
+                else:
+                    print('%-12s %-12s %12.1f %12.2f %10s'%(alias, funcName, res['evts_per_s'], res['ms_per_evt'],
+                                                        '%.1f'%res['peak_MB'] if 'peak_MB' in res else '-'))
+    if 'chain' in results:
+        chain = results['chain']
+        print('define_dets chain (%s): %.2f evts/s over %d events, peak %.1f MB/event'%(
+            ', '.join(args.detectors), chain['evts_per_s'], chain['nevents'], chain['peak_MB']))
+        print('    ms/evt: '+', '.join(['%s %.2f'%(k,v) for k,v in chain['ms_per_evt'].items()]))
+    print('max RSS: %.1f MB'%results['maxRSS_MB'])
+
+def compareResults(results, reference, tolerance):
+    """ list of (key, reference, current) where events/s dropped by more than tolerance """
+    slower = []
+    for alias, funcRes in results.get('funcs', {}).items():
+        for funcName, res in funcRes.items():
+            try:
+                ref = reference['funcs'][alias][funcName]['evts_per_s']
+            except KeyError:
+                continue
+            if 'evts_per_s' in res and res['evts_per_s'] < ref*(1.-tolerance):
+                slower.append(('%s/%s'%(alias, funcName), ref, res['evts_per_s']))
+    if 'chain' in results and 'chain' in reference:
+        ref = reference['chain']['evts_per_s']
+        if results['chain']['evts_per_s'] < ref*(1.-tolerance):
+            slower.append(('chain', ref, results['chain']['evts_per_s']))
+    return slower
+
+funcNames = args.funcs if args.funcs is not None else list(funcDefs.keys())
+for funcName in funcNames:
+    if funcName not in funcDefs:
+        logger.error('Unknown function {0}, choose from {1}'.format(funcName, list(funcDefs.keys())))
+        sys.exit(2)
+
+ds = psana.MPIDataSource('exp=%s:run=%d:smd'%(psana_sim._config.expname, psana_sim._config.run))
+results = {'config': {'detectors': args.detectors, 'nevents': args.nevents, 'occupancy': args.occupancy,
+                      'seed': args.seed, 'numpy': np.__version__, 'python': platform.python_version(),
+                      'host': platform.node()}}
+if not args.nofuncs:
+    results['funcs'] = runFuncBenchmarks(ds, funcNames)
+if not args.nochain:
+    results['chain'] = runChain(ds, funcNames)
+results['maxRSS_MB'] = maxRSS()
+printResults(results)
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    logger.info('Wrote results to {0}'.format(args.output))
+
+if args.compare is not None:
+    with open(args.compare) as f:
+        reference = json.load(f)
+    slower = compareResults(results, reference, args.tolerance)
+    for key, ref, cur in slower:
+        logger.error('{0}: {1:.1f} evts/s, was {2:.1f} evts/s'.format(key, cur, ref))
+    if len(slower) > 0:
+        sys.exit(1)
+    logger.info('No regression beyond {0:.0f}% compared to {1}'.format(100*args.tolerance, args.compare))
@@ -22,6 +22,7 @@ fpathup = '/'.join(fpath.split('/')[:-1])
 sys.path.append(fpathup)
 print(fpathup)
 import smalldata_tools.cube.cube_mpi_fun as mpi_fun
+from smalldata_tools.utilities import combineStd
 
 ##########################################################
 # Custom exception handler to make job abort if a single rank fails.
@@ -54,11 +55,17 @@ parser.add_argument("--nevents", help="number of events/bin", default=-1)
 parser.add_argument("--postRuntable", help="postTrigger for seconday jobs", action='store_true')
 parser.add_argument('--url', default="https://pswww.slac.stanford.edu/ws-auth/lgbk/")
 parser.add_argument('--config', help='Name of the config file module to use (without .py extension)', default=None, type=str)
-parser.add_argument("--optimize_cores", help="split processing over more cores than bins", action='store_true')
+parser.add_argument("--optimize_cores", help="split processing over more cores than bins (random sub-bins)", action='store_true')
+parser.add_argument("--cube_store", help="add the cubes to this multi-run cube store file", default=None)
+parser.add_argument("--read_ahead", help="number of events a worker reads ahead (0: no read ahead)", type=int, default=4)
+parser.add_argument("--split_events", help="split bins with more events into chunks for several workers (def: auto, 0: no split)", default='auto')
+parser.add_argument("--batch_post", help="run the det_proc funcs once on all bins of the cube instead of on each bin", action='store_true')
+parser.add_argument("--no_resume", help="do not resume from the bins completed by an earlier job (.inprogress file)", action='store_true')
 args = parser.parse_args()
     
 exp = args.experiment
 run = args.run
+split_events = args.split_events if args.split_events=='auto' else int(args.split_events)
 
 if rank==0:
     from smalldata_tools.SmallDataAna import SmallDataAna
@@ -235,18 +242,18 @@ if rank==0:
         if config.laser:
             #request 'on' events base on input filter (add optical laser filter)
             cubeName, bins, nEntries = anaps.makeCubeData(cubeName, onoff=1, nEvtsPerBin=args.nevents, \
-                dirname=args.outdirectory)
+                dirname=args.outdirectory, splitEvents=split_events, resume=not args.no_resume, batchPost=args.batch_post)
             cube_infos.append([f'{cubeName}_on', bins, nEntries])
             comm.bcast('Work!', root=0)
             time.sleep(1) # is this necessary? Just putting it here in case...
             #request 'off' events base on input filter (switch optical laser filter, drop tt
             cubeName, bins, nEntries = anaps.makeCubeData(cubeName, onoff=0, nEvtsPerBin=args.nevents, \
-                dirname=args.outdirectory)
+                dirname=args.outdirectory, splitEvents=split_events, resume=not args.no_resume, batchPost=args.batch_post)
             cube_infos.append([f'{cubeName}_off', bins, nEntries])
         else:
             # no laser filters
             cubeName, bins, nEntries = anaps.makeCubeData(cubeName, onoff=2, nEvtsPerBin=args.nevents, \
-                dirname=args.outdirectory)
+                dirname=args.outdirectory, splitEvents=split_events, resume=not args.no_resume, batchPost=args.batch_post)
             cube_infos.append([cubeName, bins, nEntries])
     comm.bcast('Go home!', root=0)
             
@@ -266,30 +273,58 @@ if rank==0:
             bins_remove = getattr(dat.root,'bins_random_remove', None)
             if bins_remove is None:
                 print('Did not find the axis to be removed, quit.')
+                dat.close()
                 continue
             nBins_remove = bins_remove.shape[0]
             print('Remove extra dimension: ', nSplit, nBins_remove)
             dat.remove_node('/bins_random_remove')
             #get all keys (not directories) & find binning variable random_remove
             h5_variables = [k for k in dir(dat.root) if k[0]!='_']
+            #std first: they are combined using the sums & numbers of events of the sub-bins
+            h5_variables = sorted(h5_variables, key=lambda k: not k.endswith('_std'))
+            binShape = dat.root.nEntries.shape
+            def read_binned(var):
+                """ data of var with the bin axes in the shape of nEntries (<det>_nEntries are flat) """
+                data = getattr(dat.root,var).read()
+                if len(data.shape)>0 and data.shape[:len(binShape)]!=binShape and data.shape[0]==np.prod(binShape):
+                    data = data.reshape(binShape+data.shape[1:])
+                return data
             #get data            
             for var in h5_variables:
                 try:
-                    org_data = getattr(dat.root,var).read()
+                    org_data = read_binned(var)
                     if len(org_data.shape)<=1:
                         #print('Dim not available')
                         continue
                     if org_data.shape[1]!=nBins_remove:
                         #print('Did not find the right variable to sum over ', org_data.shape, nBins_remove)
                         continue
-                    #sum to remove dim
-                    new_data = org_data.sum(axis=1)
+                    data_var, n_var = var.replace('_std','_data'), var.replace('_std','_nEntries')
+                    if var.endswith('_std') and data_var in h5_variables:
+                        #std can not be summed
+                        nEntries = read_binned(n_var if n_var in h5_variables else 'nEntries')
+                        new_data = combineStd(org_data, read_binned(data_var), nEntries, 1)
+                    else:
+                        #sum to remove dim
+                        new_data = org_data.sum(axis=1)
                     #remove dataset
                     dat.remove_node('/%s'%var)
                     #add dataset
                     dat.create_array('/',var, obj=new_data)
                 except:
                     pass
+            dat.close()
+
+    if args.cube_store is not None:
+        # add the cubes of this run to the multi-run store
+        from smalldata_tools.cube.cube_store import CubeStore
+        store = CubeStore(args.cube_store)
+        cubedirectory = args.outdirectory if args.outdirectory!='' else ana.dirname
+        for cubeName in ana.cubes:
+            cubeFName = 'Cube_%s_Run%04d_%s.h5'%(args.experiment, int(run), cubeName )
+            onoffNames = [cubeFName.replace('.h5','_on.h5'), cubeFName.replace('.h5','_off.h5')] if config.laser else [cubeFName]
+            for cubeFName in onoffNames:
+                store.addRun('%s/%s'%(cubedirectory, cubeFName), run, cubeName=cubeFName.replace('Cube_%s_Run%04d_'%(args.experiment, int(run)),'').replace('.h5',''))
 
     if config.save_tiff is True:
         tiffdir='/cds/data/drpsrcf/mec/meclu9418/scratch/run%s'%args.run
@@ -314,7 +349,7 @@ if rank==0:
         
 else:
     work = 1
-    binWorker = mpi_fun.BinWorker(run, exp)
+    binWorker = mpi_fun.BinWorker(run, exp, read_ahead=args.read_ahead)
     while(work):
         time.sleep(1) # is this necessary? Just putting it here in case...
         amIStillWorking = comm.bcast(None, root=0)
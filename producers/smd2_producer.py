@@ -13,6 +13,7 @@ import os
 import logging 
 import requests
 import sys
+import threading
 from glob import glob
 from requests.auth import HTTPBasicAuth
 from mpi4py import MPI
@@ -166,6 +167,12 @@ ttCalib=[]
 #decide which analog input to save & give them nice names
 #aioParams=[[1],['laser']]
 aioParams=[]
+#pre-selection: expensive functions (droplet, photon, azav, autocorrelation) are only run
+#on events passing these cuts on the default detectors, the others get fill values.
+#preselCuts=[['lightStatus/xray',0.5,1.5], ['ipm2/sum',0.05,10.]]
+preselCuts=[]
+#function classes or names to skip, None: use default list in SmallDataPreselection
+preselFuncs=None
 ########################################################## 
 ##
 ## <-- User Input end
@@ -205,6 +212,12 @@ if rank==0: print(fpathup)
 from smalldata_tools.utilities import printMsg, checkDet
 from smalldata_tools.SmallDataUtils import setParameter, getUserData, getUserEnvData
 from smalldata_tools.SmallDataUtils import defaultDetectors, detData
+from smalldata_tools.SmallDataPipeline import EventPrefetcher, AsyncWriter, DetectorPool, LockedPsana, lockPsanaCalls
+from smalldata_tools.SmallDataPreselection import EventPreselection
+from smalldata_tools.SmallDataSharedMem import SharedConstants
+from smalldata_tools.SmallDataGather import GatherController
+from smalldata_tools.SmallDataRagged import RaggedWriter, raggedFileName, eventTime
+from smalldata_tools.SmallDataOutputPolicy import OutputPolicy, repack, compressions
 from smalldata_tools.SmallDataDefaultDetector import lcls2_epicsDetector, genlcls2Detector
 from smalldata_tools.DetObject_lcls2 import DetObject_lcls2
 from smalldata_tools.ana_funcs.roi_rebin import ROIFunc, spectrumFunc, projectionFunc, sparsifyFunc, imageFunc
@@ -259,6 +272,17 @@ parser.add_argument("--wait", help="wait for a file to appear", action='store_tr
 parser.add_argument("--rawFim", help="save raw Fim data", action='store_true', default=False)
 parser.add_argument("--nohsd", help="dont save HSD data", action='store_true', default=False)
 parser.add_argument("--nosum", help="dont save sums", action='store_true', default=False)
+parser.add_argument('--pipeline', help='read ahead & write events in background threads', action='store_true', default=False)
+parser.add_argument('--prefetch_depth', help='number of events to read ahead in pipeline mode', type=int, default=4)
+parser.add_argument('--compression', help='repack the output with chunking & compression (%s)'%(', '.join(compressions)), type=str, default=None)
+parser.add_argument('--quantize', help='store datasets as photon counts, e.g. epix/ROI_0_area:150 (name pattern:ADU per photon)', nargs='+', default=[])
+parser.add_argument('--columnar', help='write ragged data (e.g. sparsify w/o nData) to columnar files', action='store_true', default=False)
+parser.add_argument('--adaptive_gather', help='adapt the gather interval to the data size & rate', action='store_true', default=False)
+parser.add_argument('--gather_max_mb', help='adaptive gather: maximum MB held between gathers', type=float, default=512.)
+parser.add_argument('--gather_max_seconds', help='adaptive gather: maximum time between gathers', type=float, default=60.)
+parser.add_argument('--det_threads', help='number of threads processing the area detectors of an event (psana calls & calibrations done by psana are serialized)', type=int, default=1)
+parser.add_argument('--inner_threads', help='with det_threads: threads of numpy/scipy/numba per detector', type=int, default=1)
+parser.add_argument('--shared_constants', help='keep detector constants in node shared memory', action='store_true', default=False)
 args = parser.parse_args()
 
 logger.debug('Args to be used for small data run: {0}'.format(args))
@@ -381,6 +405,18 @@ thisrun = next(ds.runs())
 # Generate smalldata object
 print('Opening the h5file %s, gathering at %d'%(h5_f_name,args.gather_interval))
 small_data = ds.smalldata(filename=h5_f_name, batch_size=args.gather_interval)
+ragged_writer = None
+if args.columnar:
+    ragged_writer = RaggedWriter(raggedFileName(h5_f_name, rank))
+output_policy = None
+if args.compression is not None or len(args.quantize)>0:
+    output_policy = OutputPolicy(compression=args.compression,
+                                 quantize={ q.split(':')[0]: float(q.split(':')[1]) for q in args.quantize })
+gather_ctl = None
+if args.adaptive_gather:
+    gather_ctl = GatherController(interval=args.gather_interval, maxMB=args.gather_max_mb,
+                                  maxSeconds=args.gather_max_seconds)
+    gather_ctl.attach(small_data, ds)
 print('smalldata file has been created on rank %d'%rank)
 
 # Not sure why, but here
@@ -450,38 +486,95 @@ if args.full:
     except:
         pass
 
-event_iter = thisrun.events()
+if args.shared_constants:
+    # one copy of pedestals, masks, geometry,... per node instead of per rank
+    shared_constants = SharedConstants()
+    shared_constants.shareDets(dets)
+
+presel = EventPreselection(preselCuts, funcs=preselFuncs)
+
+# psana is not thread safe: all psana calls (event reading, default detectors, detector
+# data & writing) are serialized with this lock, the detector functions run in parallel.
+# With det_threads, only the psana calls inside of getData hold it (lockPsanaCalls).
+psana_lock = threading.RLock()
+
+def process_det(det, evt, passed):
+    """ data, functions & sums of one area detector, returns its entries of userDict """
+    detDict = {}
+    try:
+        #this should be a plain dict. Really.
+        if det_pool is not None:
+            det.getData(LockedPsana(evt, psana_lock))
+        else:
+            with psana_lock:
+                det.getData(evt)
+        presel.processFuncs(det, passed)
+        detDict[det._name]=getUserData(det)
+        try:
+            envData=getUserEnvData(det)
+            if len(envData.keys())>0:
+                detDict[det._name+'_env']=envData
+        except:
+            pass
+        det.processSums()
+    except:
+        pass
+    return detDict
+
+# process the area detectors of an event in parallel threads
+det_pool = None
+if args.det_threads > 1 and len(dets) > 1:
+    det_pool = DetectorPool(min(args.det_threads, len(dets)), innerThreads=args.inner_threads)
+    for det in dets:
+        lockPsanaCalls(det, psana_lock)
+    if rank==0: logger.info('Processing {0} detectors in {1} threads'.format(len(dets), det_pool.nThreads))
+
+if args.pipeline:
+    # read the next events & default detectors while the area detectors are processed,
+    # hand the results to small_data in a writer thread.
+    def write_event(evt, det_data, userDict):
+        if det_data is not None:
+            small_data.event(evt, det_data)
+        small_data.event(evt, userDict)
+    event_iter = EventPrefetcher(thisrun.events(), depth=args.prefetch_depth, lock=psana_lock,
+                                 prepare=lambda evt: detData(default_dets, evt))
+    event_writer = AsyncWriter(write_event, depth=4*args.prefetch_depth, lock=psana_lock)
+else:
+    event_iter = ((evt, None) for evt in thisrun.events())
+    event_writer = None
 
 evt_num=-1 #set this to default until I have a useable rank for printing updates...
 if rank==0: print('And now the event loop....')
-for evt_num, evt in enumerate(event_iter):
+for evt_num, (evt, det_data) in enumerate(event_iter):
 
-    det_data = detData(default_dets, evt)
-    if det_data is not None:
-        small_data.event(evt, det_data)
+    if event_writer is None:
+        det_data = detData(default_dets, evt)
+        if det_data is not None:
+            small_data.event(evt, det_data)
 
     #detector data using DetObject 
     userDict = {}
-    for det in dets:
-        try:
-            #this should be a plain dict. Really.
-            det.getData(evt)
-            det.processFuncs()
-            userDict[det._name]=getUserData(det)
-            #print('userdata ',det)
-            try:
-                envData=getUserEnvData(det)
-                if len(envData.keys())>0:
-                    userDict[det._name+'_env']=envData
-            except:
-                pass
-            det.processSums()
-            #print(userDict[det._name])
-        except:
-            pass
-            
+    passed = presel.passes(det_data)
+    if len(presel.cuts)>0:
+        userDict['preselection'] = {'passed': int(passed)}
+    if det_pool is not None:
+        detDicts = det_pool.map(process_det, dets, evt, passed)
+    else:
+        detDicts = [process_det(det, evt, passed) for det in dets]
+    for detDict in detDicts:
+        userDict.update(detDict)
+
     #hits = findHits(hsd.evt.dat)
-    small_data.event(evt,userDict)
+    if ragged_writer is not None:
+        ragged_writer.event(eventTime(evt), userDict)
+    if event_writer is None:
+        small_data.event(evt,userDict)
+    else:
+        event_writer.put(evt, det_data, userDict)
+    if gather_ctl is not None:
+        gather_ctl.nextEvent()
+    if evt_num==0:
+        logger.info('Time to first event: {0:.2f} s'.format(time.time()-start_job))
 
 
     #the ARP will pass run & exp via the enviroment, if I see that info, the post updates
@@ -498,6 +591,14 @@ for evt_num, evt in enumerate(event_iter):
         else:
             if rank==0: print('Processed evt %d'%evt_num)
 
+if event_writer is not None:
+    event_iter.close()
+    event_writer.close()
+if det_pool is not None:
+    det_pool.close()
+if ragged_writer is not None:
+    ragged_writer.close()
+
 print('Sums:')
 sumDict={'Sums': {}}
 for det in dets:
@@ -509,6 +610,16 @@ for det in dets:
             print('Problem with data sum for %s and key %s'%(det._name,key))
 if len(sumDict['Sums'].keys())>0 and small_data.summary:
     small_data.save_summary(sumDict)
+if len(presel.cuts)>0:
+    preselSum = presel.summary()
+    preselDict = {'Preselection': {k: small_data.sum(np.array(v)) for k,v in preselSum.items()}}
+    if small_data.summary:
+        small_data.save_summary(preselDict)
+    logger.info('rank {0}: {1} of {2} events passed the pre-selection'.format(rank, preselSum['nPassed'], preselSum['nEvents']))
+if gather_ctl is not None:
+    gatherDict = {'GatherControl': gather_ctl.history()}
+    if small_data.summary:
+        small_data.save_summary(gatherDict)
 
 userDataCfg={}
 for det in default_dets:
@@ -521,6 +632,12 @@ for det in dets:
         userDataCfg[det._name] = det.params_as_dict()
     except:
         userDataCfg[det.name] = det.params_as_dict()
+if len(presel.cuts)>0:
+    userDataCfg['preselection'] = presel.params_as_dict()
+if gather_ctl is not None:
+    userDataCfg['gather_control'] = gather_ctl.params_as_dict()
+if output_policy is not None:
+    userDataCfg['output_policy'] = output_policy.params_as_dict()
 Config={'UserDataCfg':userDataCfg}
 #if rank==0: print(Config)
 if small_data.summary:
@@ -539,6 +656,11 @@ try:
 except:
     small_data.done()
     pass
+if output_policy is not None:
+    # wait until the file has been written
+    MPI.COMM_WORLD.Barrier()
+    if rank==0:
+        repack(h5_f_name, output_policy)
 
 if (int(os.environ.get('RUN_NUM', '-1')) > 0):
     if size > 2 and rank == 2:
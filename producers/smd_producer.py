@@ -13,6 +13,7 @@ import os
 import logging 
 import requests
 import sys
+import threading
 from glob import glob
 from PIL import Image
 from requests.auth import HTTPBasicAuth
@@ -58,6 +59,12 @@ ttCalib=[]
 #decide which analog input to save & give them nice names
 #aioParams=[[1],['laser']]
 aioParams=[]
+#pre-selection: expensive functions (droplet, photon, azav, autocorrelation) are only run
+#on events passing these cuts on the default detectors, the others get fill values.
+#preselCuts=[['lightStatus/xray',0.5,1.5], ['ipm2/sum',0.05,10.]]
+preselCuts=[]
+#function classes or names to skip, None: use default list in SmallDataPreselection
+preselFuncs=None
 ########################################################## 
 ##
 ## <-- User Input end
@@ -183,10 +190,18 @@ print(fpathup)
 from smalldata_tools.utilities import printMsg, checkDet
 from smalldata_tools.SmallDataUtils import setParameter, getUserData, getUserEnvData
 from smalldata_tools.SmallDataUtils import defaultDetectors, detData
+from smalldata_tools.SmallDataPipeline import EventPrefetcher, AsyncWriter, set_current_event, DetectorPool, LockedPsana, lockPsanaCalls
+from smalldata_tools.SmallDataPreselection import EventPreselection
+from smalldata_tools.SmallDataSharedMem import SharedConstants
+from smalldata_tools.SmallDataGather import GatherController
+from smalldata_tools.SmallDataRagged import RaggedWriter, raggedFileName, eventTime
+from smalldata_tools.SmallDataOutputPolicy import OutputPolicy, repack, compressions
+from smalldata_tools.SmallDataCheckpoint import ProducerCheckpoint
 from smalldata_tools.SmallDataDefaultDetector import epicsDetector, eorbitsDetector
 from smalldata_tools.SmallDataDefaultDetector import bmmonDetector, ipmDetector
 from smalldata_tools.SmallDataDefaultDetector import encoderDetector, adcDetector
 from smalldata_tools.DetObject import DetObject
+from smalldata_tools.DetObjectCache import ConstantsCache, setDefaultCache
 from smalldata_tools.ana_funcs.roi_rebin import ROIFunc, spectrumFunc, projectionFunc, sparsifyFunc, imageFunc
 from smalldata_tools.ana_funcs.waveformFunc import getCMPeakFunc, templateFitFunc
 from smalldata_tools.ana_funcs.photons import photonFunc
@@ -234,8 +249,26 @@ parser.add_argument('--image', help='save everything as image (use with care)',
 parser.add_argument('--tiff', help='save all images also as single tiff (use with even more care)', action='store_true', default=False)
 parser.add_argument("--postRuntable", help="postTrigger for seconday jobs", action='store_true', default=True)
 parser.add_argument("--wait", help="wait for a file to appear", action='store_true', default=False)
+parser.add_argument('--pipeline', help='read ahead & write events in background threads', action='store_true', default=False)
+parser.add_argument('--prefetch_depth', help='number of events to read ahead in pipeline mode', type=int, default=4)
+parser.add_argument('--det_threads', help='number of threads processing the area detectors of an event (psana calls & calibrations done by psana are serialized)', type=int, default=1)
+parser.add_argument('--inner_threads', help='with det_threads: threads of numpy/scipy/numba per detector', type=int, default=1)
+parser.add_argument('--shared_constants', help='keep detector constants in node shared memory', action='store_true', default=False)
+parser.add_argument('--checkpoint', help='checkpoint the job, a restarted job resumes & merges the partial files', action='store_true', default=False)
+parser.add_argument('--checkpoint_interval', help='minimum time between checkpoints in seconds', type=float, default=300.)
+parser.add_argument('--compression', help='repack the output with chunking & compression (%s)'%(', '.join(compressions)), type=str, default=None)
+parser.add_argument('--quantize', help='store datasets as photon counts, e.g. epix/ROI_0_area:150 (name pattern:ADU per photon)', nargs='+', default=[])
+parser.add_argument('--columnar', help='write ragged data (e.g. sparsify w/o nData) to columnar files', action='store_true', default=False)
+parser.add_argument('--adaptive_gather', help='adapt the gather interval to the data size & rate', action='store_true', default=False)
+parser.add_argument('--gather_max_mb', help='adaptive gather: maximum MB held between gathers', type=float, default=512.)
+parser.add_argument('--gather_max_seconds', help='adaptive gather: maximum time between gathers', type=float, default=60.)
+parser.add_argument('--const_cache', help='directory of the on-disk cache of detector constants', type=str, default=None)
+parser.add_argument('--const_cache_size', help='size limit of the constants cache in GB', type=float, default=20.)
 args = parser.parse_args()
 logger.debug('Args to be used for small data run: {0}'.format(args))
+if args.checkpoint and args.pipeline:
+    # the checkpoint runs in the writer thread, the sums would include events not written yet
+    parser.error('--checkpoint can not be combined with --pipeline')
 
 ###### Helper Functions ##########
 
@@ -336,7 +369,27 @@ except Exception as e:
     sys.exit()
 
 # Generate smalldata object
-small_data = ds.small_data(h5_f_name, gather_interval=args.gather_interval)
+checkpoint = None
+if args.checkpoint:
+    # each (re)start writes a part file at every gather, merged into h5_f_name at the end
+    checkpoint = ProducerCheckpoint(h5_f_name, interval=args.checkpoint_interval)
+    small_data = ds.small_data(checkpoint.partName, gather_interval=args.gather_interval, save_on_gather=True)
+else:
+    small_data = ds.small_data(h5_f_name, gather_interval=args.gather_interval)
+ragged_writer = None
+if args.columnar:
+    ragged_writer = RaggedWriter(raggedFileName(h5_f_name, ds.rank, part=(checkpoint.segment if checkpoint is not None else None)))
+output_policy = None
+if args.compression is not None or len(args.quantize)>0:
+    output_policy = OutputPolicy(compression=args.compression,
+                                 quantize={ q.split(':')[0]: float(q.split(':')[1]) for q in args.quantize })
+gather_ctl = None
+if args.adaptive_gather:
+    gather_ctl = GatherController(interval=args.gather_interval, maxMB=args.gather_max_mb,
+                                  maxSeconds=args.gather_max_seconds)
+    gather_ctl.attach(small_data, ds)
+if checkpoint is not None:
+    checkpoint.attach(small_data)
 
 # Not sure why, but here
 if ds.rank is 0:
@@ -368,10 +421,22 @@ elif len(epicsPV)>0:
 default_dets.append(eorbitsDetector())
 default_det_aliases = [det.name for det in default_dets]
 
+shared_constants = None
+if args.shared_constants:
+    # one copy of pedestals, masks, geometry,... per node instead of per rank
+    shared_constants = SharedConstants()
 if not args.default:
-    dets = define_dets(args.run)
+    if args.const_cache is not None:
+        setDefaultCache(ConstantsCache(args.const_cache, maxGB=args.const_cache_size))
+    if shared_constants is not None:
+        # constants are loaded on the first rank of each node only
+        dets = shared_constants.loadDets(define_dets, args.run)
+    else:
+        dets = define_dets(args.run)
 else:
     dets = []
+if checkpoint is not None:
+    checkpoint.sumsFunc = lambda: {'%s_%s'%(det._name, key): value for det in dets for key, value in det.storeSum().items()}
 
 det_presence={}
 if args.full:
@@ -431,6 +496,9 @@ if args.full:
         except:
             pass
 
+if shared_constants is not None:
+    shared_constants.shareDets(dets)
+
 userDataCfg={}
 for det in default_dets:
     if det.name=='tt' and len(ttCalib)>0:
@@ -442,6 +510,13 @@ for det in dets:
         userDataCfg[det._name] = det.params_as_dict()
     except:
         userDataCfg[det.name] = det.params_as_dict()
+presel = EventPreselection(preselCuts, funcs=preselFuncs)
+if len(presel.cuts)>0:
+    userDataCfg['preselection'] = presel.params_as_dict()
+if gather_ctl is not None:
+    userDataCfg['gather_control'] = gather_ctl.params_as_dict()
+if output_policy is not None:
+    userDataCfg['output_policy'] = output_policy.params_as_dict()
 Config={'UserDataCfg':userDataCfg}
 small_data.save(Config)
 
@@ -450,39 +525,96 @@ if args.tiff:
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
 
+# psana is not thread safe: all psana calls (event reading, default detectors, detector
+# data & writing) are serialized with this lock, the detector functions run in parallel.
+# With det_threads, only the psana calls inside of getData hold it (lockPsanaCalls).
+psana_lock = threading.RLock()
+
+def process_det(det, evt, passed):
+    """ data, functions & sums of one area detector, returns its entries of userDict """
+    detDict = {}
+    try:
+        #this should be a plain dict. Really.
+        if det_pool is not None:
+            det.getData(LockedPsana(evt, psana_lock))
+        else:
+            with psana_lock:
+                det.getData(evt)
+        presel.processFuncs(det, passed)
+        detDict[det._name]=getUserData(det)
+        try:
+            envData=getUserEnvData(det)
+            if len(envData.keys())>0:
+                detDict[det._name+'_env']=envData
+        except:
+            pass
+        det.processSums()
+    except:
+        # handle when sum is bad for all shots on a rank (rare, but happens)
+        for key in det._storeSum.keys():
+            if det._storeSum[key] is None:
+                det._storeSum[key] = 0
+            else:
+                det._storeSum[key] += 0
+    return detDict
+
+# process the area detectors of an event in parallel threads
+det_pool = None
+if args.det_threads > 1 and len(dets) > 1:
+    det_pool = DetectorPool(min(args.det_threads, len(dets)), innerThreads=args.inner_threads)
+    for det in dets:
+        lockPsanaCalls(det, psana_lock)
+    logger.info('Processing {0} detectors in {1} threads'.format(len(dets), det_pool.nThreads))
+
 max_iter = args.nevents / ds.size
-for evt_num, evt in enumerate(ds.events()):
+if args.pipeline:
+    # read the next events & default detectors while the area detectors are processed,
+    # hand the results to small_data in a writer thread.
+    def write_event(evt, det_data, userDict):
+        set_current_event(ds, evt)
+        small_data.event(det_data)
+        small_data.event(userDict)
+    event_iter = EventPrefetcher(ds.events(), depth=args.prefetch_depth, lock=psana_lock,
+                                 prepare=lambda evt: detData(default_dets, evt))
+    event_writer = AsyncWriter(write_event, depth=4*args.prefetch_depth, lock=psana_lock)
+else:
+    event_iter = ((evt, None) for evt in ds.events())
+    event_writer = None
+
+for evt_num, (evt, det_data) in enumerate(event_iter):
     if evt_num > max_iter:
         break
+    if checkpoint is not None and checkpoint.isDone(evt_num):
+        continue
 
-    det_data = detData(default_dets, evt)
-    small_data.event(det_data)
+    if event_writer is None:
+        det_data = detData(default_dets, evt)
+        small_data.event(det_data)
 
     #detector data using DetObject 
     userDict = {}
-    for det in dets:
-        try:
-            #this should be a plain dict. Really.
-            det.getData(evt)
-            det.processFuncs()
-            userDict[det._name]=getUserData(det)
-            try:
-                envData=getUserEnvData(det)
-                if len(envData.keys())>0:
-                    userDict[det._name+'_env']=envData
-            except:
-                pass
-            det.processSums()
-#             print(userDict[det._name])
-        except:
-            # handle when sum is bad for all shots on a rank (rare, but happens)
-            for key in det._storeSum.keys():
-                if det._storeSum[key] is None:
-                    det._storeSum[key] = 0
-                else:
-                    det._storeSum[key] += 0
-
-    small_data.event(userDict)
+    passed = presel.passes(det_data)
+    if len(presel.cuts)>0:
+        userDict['preselection'] = {'passed': int(passed)}
+    if det_pool is not None:
+        detDicts = det_pool.map(process_det, dets, evt, passed)
+    else:
+        detDicts = [process_det(det, evt, passed) for det in dets]
+    for detDict in detDicts:
+        userDict.update(detDict)
+
+    if ragged_writer is not None:
+        ragged_writer.event(eventTime(evt), userDict)
+    if checkpoint is not None:
+        userDict['evt_idx'] = checkpoint.globalIdx(evt_num)
+    if event_writer is None:
+        small_data.event(userDict)
+    else:
+        event_writer.put(evt, det_data, userDict)
+    if gather_ctl is not None:
+        gather_ctl.nextEvent()
+    if evt_num==0:
+        logger.info('Time to first event: {0:.2f} s'.format(time.time()-start_job))
 
     if args.tiff:
         for key in userDict:
@@ -516,14 +648,31 @@ for evt_num, evt in enumerate(ds.events()):
             elif ds.rank == ds.size-1:
                 print('Current Event / rank :', evt_num+1)
 
+if event_writer is not None:
+    event_iter.close()
+    event_writer.close()
+if det_pool is not None:
+    det_pool.close()
+if ragged_writer is not None:
+    ragged_writer.close()
+
 sumDict={'Sums': {}}
 for det in dets:
     for key in det.storeSum().keys():
         sumData=small_data.sum(det.storeSum()[key])
+        if checkpoint is not None:
+            sumData = checkpoint.addPrevious('%s_%s'%(det._name, key), sumData)
         sumDict['Sums']['%s_%s'%(det._name, key)]=sumData
 if len(sumDict['Sums'].keys())>0:
 #     print(sumDict)
     small_data.save(sumDict)
+if len(presel.cuts)>0:
+    preselSum = presel.summary()
+    preselDict = {'Preselection': {k: small_data.sum(np.array(v)) for k,v in preselSum.items()}}
+    small_data.save(preselDict)
+    logger.info('rank {0}: {1} of {2} events passed the pre-selection'.format(ds.rank, preselSum['nPassed'], preselSum['nEvents']))
+if gather_ctl is not None:
+    small_data.save({'GatherControl': gather_ctl.history()})
 
 end_prod_time = datetime.now().strftime('%m/%d/%Y %H:%M:%S')
 end_job = time.time()
@@ -534,6 +683,10 @@ if ds.rank==0:
 #finishing up here....
 logger.debug('rank {0} on {1} is finished'.format(ds.rank, hostname))
 small_data.save()
+if checkpoint is not None:
+    checkpoint.finish()
+if output_policy is not None and ds.rank==0:
+    repack(h5_f_name, output_policy)
 if (int(os.environ.get('RUN_NUM', '-1')) > 0):
     if ds.size > 1:
         if ds.rank == 0:
@@ -16,8 +16,13 @@ from smalldata_tools.utilities_plotting import hv_3dimage
 from smalldata_tools.utilities import E2lam
 from smalldata_tools.utilities import dictToHdf5
 from smalldata_tools.utilities import image_from_dxy
+from smalldata_tools.cube.cube_pyramid import CubePyramid, downsample, isStd
 import smalldata_tools.ana_funcs.azimuthalBinning as ab
 import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+from concurrent.futures import ThreadPoolExecutor
+import h5py
 from bokeh.io import show
 import holoviews as hv
 #plot functions: 3-d plotting, fix origin.
@@ -26,10 +31,84 @@ import holoviews as hv
 
 from smalldata_tools.utilities_plotting import cmaps
 
+class _CubeArray(BackendArray):
+    """ variable of a cube file, only the requested part is read when it is accessed """
+    def __init__(self, fname, key, fileShape, dtype):
+        self.fname = fname
+        self.key = key
+        #size 1 axes are squeezed like for the loaded data
+        self._squeezed = [ax for ax in range(1, len(fileShape)) if fileShape[ax]==1]
+        self.shape = tuple([n for ax, n in enumerate(fileShape) if ax not in self._squeezed])
+        self.dtype = np.dtype(dtype)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self.read)
+
+    def read(self, key):
+        key = list(key)
+        for ax in self._squeezed:
+            key.insert(ax, 0)
+        with h5py.File(self.fname, 'r') as f:
+            return f[self.key][tuple(key)]
+
+class _SummedArray(BackendArray):
+    """
+    sum of a variable over runs, computed when it is accessed: the requested part is
+    summed in blocks of bins, run by run (or nParallel runs at a time with a pool)
+    """
+    def __init__(self, arrays, pool=None, nParallel=1, blockBytes=256*1024*1024):
+        self.arrays = arrays
+        self.shape = arrays[0].shape
+        self.dtype = np.result_type(*[array.dtype for array in arrays])
+        self._pool = pool
+        self._nParallel = nParallel if pool is not None else 1
+        rowBytes = max(1, int(np.prod(self.shape[1:]))*self.dtype.itemsize)
+        self._blockBins = max(1, blockBytes//rowBytes)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self.read)
+
+    def _sum(self, key):
+        total = None
+        for start in range(0, len(self.arrays), self._nParallel):
+            batch = self.arrays[start:start+self._nParallel]
+            if self._pool is not None:
+                parts = self._pool.map(lambda array: array.read(key), batch)
+            else:
+                parts = (array.read(key) for array in batch)
+            for part in parts:
+                total = part.astype(self.dtype) if total is None else total+part
+        return total
+
+    def read(self, key):
+        if not isinstance(key[0], slice):
+            return self._sum(key)
+        start, stop, step = key[0].indices(self.shape[0])
+        rows = range(start, stop, step)
+        if step<0 or len(rows)<=self._blockBins:
+            return self._sum(key)
+        out = None
+        for iRow in range(0, len(rows), self._blockBins):
+            lastRow = rows[min(iRow+self._blockBins, len(rows))-1]
+            block = self._sum((slice(rows[iRow], lastRow+1, step),)+tuple(key[1:]))
+            if out is None:
+                out = np.empty((len(rows),)+block.shape[1:], dtype=block.dtype)
+            out[iRow:iRow+block.shape[0]] = block
+        return out
+
 class CubeAna(object):
-    def __init__(self, expname='', run=0, dirname='', cubeName='', cubeDict=None, plotWith='matplotlib', debug=False):
+    def __init__(self, expname='', run=0, dirname='', cubeName='', cubeDict=None, plotWith='matplotlib', debug=False, maxLoadSize=None, lazy=False, sumThreads=1):
         if debug: print('DEBUG INIT; ',expname, run)
         self._fields={}
+        #lazy: cube data is read from the files when it is used, the sum of the runs is computed on access
+        self._lazy=lazy
+        self._runArrays={}
+        self._sumPool = ThreadPoolExecutor(sumThreads) if sumThreads>1 else None
+        self._sumThreads=sumThreads
+        #variables larger than this are not loaded, they are read from the pyramid of the cube file
+        self._maxLoadSize=maxLoadSize
+        self._lazyVars={}
+        self._pyramids={}
         self._expname=expname
         self._initrun=run
         self._offStr='_off' #string to distinguish 'off' cube data.
@@ -57,6 +136,7 @@ class CubeAna(object):
 
         self._fname=''
         allFiles = glob.glob('%s/Cube_%s_Run%03d_*.h5'%(self._dirname,self._expname,run))
+        allFiles = [thisFile for thisFile in allFiles if not thisFile.endswith('_pyramid.h5')]
         if cubeName != '':
             for thisFile in allFiles:
                 if thisFile.find(cubeName)>=0:
@@ -98,8 +178,12 @@ class CubeAna(object):
             thisXrdata = None
             return None
         self._cubeDict = { "Run%03d"%run: thisXrdata}
-        self._cubeSumDict = thisXrdata.copy(deep=True)
-        self._cubeExtendDict = thisXrdata.copy(deep=True)
+        if self._lazy and self._inDict is None:
+            self._cubeSumDict = self._summedCube()
+            self._cubeExtendDict = None
+        else:
+            self._cubeSumDict = thisXrdata.copy(deep=True)
+            self._cubeExtendDict = thisXrdata.copy(deep=True)
         self._variableDefs={} #dictionary of variable definitions: key is name, value is list of [varname, ROI]
 
     def _getXarrayDims(self,key,dataShape):
@@ -180,8 +264,10 @@ class CubeAna(object):
         else:
             return fonName
 
-    def _xrFromRun(self, run):
-        fname = self._filenameFromRun(run)
+    def _xrFromRun(self, run, offEvents=False):
+        fname = self._filenameFromRun(run, offEvents)
+        runKey = "Run%03d%s"%(run, self._offStr if offEvents else '')
+        self._runArrays[runKey] = {}
         cubeTable=tables.open_file(fname,'r')
         self._bins = cubeTable.get_node('/binVar_bins').read()
         thisXrdata = xr.DataArray(self._bins, coords={'bins': self._bins}, dims=('bins'), name='Bins')
@@ -220,13 +306,156 @@ class CubeAna(object):
                 if self._debug:
                     print('_xrFromRun - data for %s is not of the right shape: '%(key), dataShape)
                 continue
+            if self._maxLoadSize is not None and np.prod(dataShape)>self._maxLoadSize:
+                if self._debug: print('_xrFromRun - do not load %s, use pyramid: '%(key), dataShape)
+                self._lazyVars[tArrName] = dataShape
+                continue
             if self._debug: print('_xrFromRun - getDims: ',key, dataShape)
             dataShape,coords, dims = self._getXarrayDims(key, dataShape)
             if self._debug: print('_xrFromRun - gotDims: ',key, dataShape, coords, dims )
-            thisXrdata = xr.merge([thisXrdata, xr.DataArray(cubeTable.get_node(key).read().squeeze(), coords=coords, dims=dims,name=tArrName) ])
+            if self._lazy:
+                self._runArrays[runKey][tArrName] = _CubeArray(fname, key, cubeTable.get_node(key).shape, cubeTable.get_node(key).dtype)
+                thisData = indexing.LazilyIndexedArray(self._runArrays[runKey][tArrName])
+            else:
+                thisData = cubeTable.get_node(key).read().squeeze()
+            thisXrdata = xr.merge([thisXrdata, xr.DataArray(thisData, coords=coords, dims=dims,name=tArrName) ])
             #print 'data has been added for ',key, dataShape
+        cubeTable.close()
         return thisXrdata
 
+    def _summedCube(self):
+        """ cube summed over the runs (off runs as <var>_off), the variables are summed when they are accessed """
+        thisXrdata = xr.DataArray(self._bins, coords={'bins': self._bins}, dims=('bins'), name='Bins')
+        for offEvents in [False, True]:
+            runKeys = sorted([k for k in self._cubeDict.keys() if k.endswith(self._offStr)==offEvents])
+            if len(runKeys)==0:
+                continue
+            firstCube = self._cubeDict[runKeys[0]]
+            for k in self._runArrays[runKeys[0]].keys():
+                arrays = []
+                for runKey in runKeys:
+                    if k not in self._runArrays[runKey] or self._runArrays[runKey][k].shape!=firstCube[k].shape:
+                        print('%s of %s does not match the first run, will not add it'%(k, runKey))
+                        continue
+                    arrays.append(self._runArrays[runKey][k])
+                summed = indexing.LazilyIndexedArray(_SummedArray(arrays, pool=self._sumPool, nParallel=self._sumThreads))
+                sumName = '%s%s'%(k, self._offStr) if offEvents else k
+                thisXrdata = xr.merge([thisXrdata, xr.DataArray(summed, coords=firstCube[k].coords, dims=firstCube[k].dims, name=sumName)])
+        return thisXrdata
+
+    def sumRuns(self, variables=None, runKey=None):
+        """ read the requested variables of the summed cube (or of one run) into memory, returns a Dataset """
+        cubeDict = self._cubeSumDict if runKey is None else self._cubeDict[runKey]
+        if variables is None:
+            variables = [k for k in cubeDict.data_vars.keys()]
+        return cubeDict[variables].load()
+
+    def _pyramid(self, runKey):
+        """ pyramid of the cube file of a run (key: Run%03d, with _off for off events), None w/o cube file """
+        if runKey not in self._pyramids:
+            offEvents = runKey.endswith(self._offStr)
+            fname = self._filenameFromRun(int(runKey[3:].replace(self._offStr,'')), offEvents)
+            self._pyramids[runKey] = CubePyramid(fname) if path.isfile(fname) else None
+        return self._pyramids[runKey]
+
+    def _pyramidRuns(self, runKey=None):
+        """ pyramids of a run or of all runs of the summed cube, None if not all runs come from cube files """
+        if self._inDict is not None:
+            return None
+        if runKey is None:
+            runKeys = [k for k in self._cubeDict.keys() if not k.endswith(self._offStr)]
+        else:
+            runKeys = [runKey]
+        pyramids = [self._pyramid(k) for k in runKeys]
+        if len(pyramids)==0 or None in pyramids:
+            return None
+        return pyramids
+
+    def _inPyramids(self, pyramids, sig):
+        """ True if sig is in the cube files of the pyramids, variables made from the loaded cube (e.g. makeImg) are not """
+        return pyramids is not None and all([sig in pyramid.shapes for pyramid in pyramids])
+
+    def readLevel(self, sig, binFactor=1, spatialFactor=1, runKey=None, binSel=None):
+        """
+        cube variable downsampled by binFactor along the bins & spatialFactor along the
+        other axes (summed over the runs if runKey is None). Only this level is read,
+        it is built & stored next to the cube file the first time it is needed.
+        binSel: bins of the level to read (index or slice)
+        """
+        pyramids = self._pyramidRuns(runKey)
+        if pyramids is None:
+            print('readLevel needs the cube files of the runs, return')
+            return None
+        data = None
+        for pyramid in pyramids:
+            if sig not in pyramid.shapes:
+                print('could not find %s in %s, return'%(sig, pyramid.cubeFile))
+                return None
+            thisData = pyramid.read(sig, binFactor, spatialFactor, binSel)
+            data = thisData if data is None else data+thisData
+        #squeeze like the loaded data
+        fileShape = pyramids[0].shapes[sig]
+        binAxis = 0 if isinstance(binSel, (int, np.integer)) else 1
+        return np.squeeze(data, axis=tuple([ax-1+binAxis for ax in range(1, len(fileShape)) if fileShape[ax]==1]))
+
+    def _reducedFromPyramid(self, aimShape=None, aimSize=4000000, runKey=None):
+        pyramids = self._pyramidRuns(runKey)
+        if pyramids is None:
+            return None
+        pyramid = pyramids[0]
+        cubeDict = self._cubeSumDict if runKey is None else self._cubeDict[runKey]
+        variables = [k for k in pyramid.variables() if k in cubeDict.variables or k in self._lazyVars]
+        if 'nEntries' not in variables:
+            return None
+        maxBins = aimShape[0] if aimShape is not None else None
+        #same bins for all variables: as many as the largest variable allows
+        maxVar = sorted(variables, key=lambda k: pyramid.size(k))[-1]
+        binFactor = pyramid.pickLevel(maxVar, aimSize, maxBins=maxBins)[0]
+        if binFactor==1 and pyramid.size(maxVar)<=aimSize and len(self._lazyVars)==0:
+            return cubeDict
+        bins = pyramid.bins(binFactor)
+        if self._debug: print('reduced cube from pyramid: bins downsampled by ',binFactor)
+        newXr = xr.DataArray(self.readLevel('nEntries', binFactor, 1, runKey), coords={'bins': bins}, dims=('bins'),name='nEntries')
+        for thisVar in variables:
+            if thisVar=='nEntries':
+                continue
+            spatialFactor = pyramid.factors[-1]
+            for factor in pyramid.factors:
+                if pyramid.size(thisVar, binFactor, factor)<=aimSize:
+                    spatialFactor = factor
+                    break
+            dataShape, coords, dims = self._getXarrayDims(thisVar, pyramid.shape(thisVar, binFactor, spatialFactor))
+            coords['bins'] = bins
+            newXr = xr.merge([newXr, xr.DataArray(self.readLevel(thisVar, binFactor, spatialFactor, runKey), coords=coords, dims=dims,name=thisVar)])
+        #variables made from the loaded cube (makeImg, applyAzav) are not in the cube files: downsample them the same way
+        for thisVar in cubeDict.data_vars:
+            if thisVar in variables or cubeDict[thisVar].dims[0]!='bins':
+                continue
+            if thisVar=='Bins':
+                newXr = xr.merge([newXr, xr.DataArray(bins, coords={'bins': bins}, dims=('bins'), name='Bins')])
+                continue
+            newXr = xr.merge([newXr, self._downsampleVar(cubeDict[thisVar], pyramid, binFactor, bins, aimSize)])
+        return newXr
+
+    def _downsampleVar(self, var, pyramid, binFactor, bins, aimSize):
+        """ in-memory variable downsampled like the pyramid levels: by binFactor along the bins, the other axes for aimSize """
+        average = isStd(var.name)
+        data = downsample(np.nan_to_num(np.asarray(var.data, dtype=float)), binFactor, range(pyramid.nBinDims), average=average)
+        spatialAxes = list(range(pyramid.nBinDims, data.ndim))
+        spatialFactor = pyramid.factors[-1]
+        for factor in pyramid.factors:
+            if np.prod([-(-n//factor) if ax in spatialAxes else n for ax, n in enumerate(data.shape)])<=aimSize:
+                spatialFactor = factor
+                break
+        data = downsample(data, spatialFactor, spatialAxes, average=average)
+        coords = {}
+        for ax, dim in enumerate(var.dims):
+            if dim=='bins':
+                coords[dim] = bins
+            elif dim in var.coords:
+                coords[dim] = var.coords[dim].values[::binFactor if ax<pyramid.nBinDims else spatialFactor]
+        return xr.DataArray(data, coords=coords, dims=var.dims, name=var.name)
+
     def _reduceData(self, inArray, sigROI=None):
         if sigROI is None or inArray is None:
             return inArray
@@ -350,9 +579,9 @@ class CubeAna(object):
                             flatShp.append(dim)
                         flatShp = tuple(flatShp)
                         data = data.reshape(flatShp)
-                    azData=[]
-                    for image in data:
-                        azData.append(self.__dict__[azavName].doCake(image))
+                    #all bins with one sparse binning matrix, in blocks of bins
+                    blockBins = max(1, 256*1024*1024//max(1, data[0].nbytes))
+                    azData = np.concatenate([self.__dict__[azavName].doCakeBatch(data[start:start+blockBins]) for start in range(0, data.shape[0], blockBins)])
                     if self._debug: print('applyAzAv: azData ',len(azData), np.array(azData[0]).shape)
                     if len(binShp)>1:
                         newShp=list(binShp)
@@ -402,10 +631,16 @@ class CubeAna(object):
 
     def Keys(self, name=None, img=False):
         keys=[]
-        for key in self._cubeDict[self._cubeDict.keys()[0]].variables:
+        for key in self._cubeDict[list(self._cubeDict.keys())[0]].variables:
             if name is not None and key.find(name)<0:
                 continue
-            if img and len(self._cubeDict[self._cubeDict.keys()[0]][key].shape)<3:
+            if img and len(self._cubeDict[list(self._cubeDict.keys())[0]][key].shape)<3:
+                continue
+            keys.append(key)
+        for key, dataShape in self._lazyVars.items():
+            if (name is not None and key.find(name)<0) or key in keys:
+                continue
+            if img and len(dataShape)<3:
                 continue
             keys.append(key)
         return keys
@@ -415,7 +650,11 @@ class CubeAna(object):
         if not path.isfile(fname):
             print('Could not find file for run %d for cube %s, looked for: %s'%(run, self._cubeName, fname))
             return            
-        thisXrdata = self._xrFromRun(run)
+        thisXrdata = self._xrFromRun(run, offEvents)
+        if self._lazy:
+            self._cubeDict["Run%03d%s"%(run, self._offStr if offEvents else '')] = thisXrdata
+            self._cubeSumDict = self._summedCube()
+            return
         if not offEvents:
             self._cubeDict["Run%03d"%run] = thisXrdata
             for k in self._cubeSumDict.variables:
@@ -563,7 +802,8 @@ class CubeAna(object):
         return None
 
     #change this: do not use what typically contains ROI to pick slice, add explicit value.
-    def plotCubeImage(self, run=None, sig=None, plotWith=None, plotLog=False, plot3d=False, sigIdx=None, useHoloviews=True, normIdx=None):
+    #aimSize: maximum size of the plotted data, larger cubes are read from a downsampled level of their pyramid.
+    def plotCubeImage(self, run=None, sig=None, plotWith=None, plotLog=False, plot3d=False, sigIdx=None, useHoloviews=True, normIdx=None, aimSize=4000000, usePyramid=True):
         if plotWith==None:
             plotWith=self._plotWith
         runKey = None
@@ -599,11 +839,27 @@ class CubeAna(object):
             sig = sig[0]
         else:
             sigROI=None
-        if sig not in cubeDict.variables:
+        pyramids = self._pyramidRuns(runKey) if usePyramid else None
+        if sig not in cubeDict.variables and (pyramids is None or sig not in self._lazyVars):
             print('could not find sig, return'); return
 
         if not plot3d:
-            if sigIdx is not None:
+            levels = None
+            if self._inPyramids(pyramids, sig):
+                #one bin at full bin resolution, the sum of all bins from the level needed for aimSize
+                if sigIdx is not None:
+                    levels = (1, pyramids[0].pickLevel(sig, aimSize, maxBins=pyramids[0].nBins, perBin=True)[1])
+                else:
+                    levels = pyramids[0].pickLevel(sig, aimSize)
+                #small enough: use the data in memory
+                if levels==(1,1) and sig in cubeDict.variables:
+                    levels = None
+            if levels is not None:
+                binFactor, spatialFactor = levels
+                data2plot = self.readLevel(sig, binFactor, spatialFactor, runKey, binSel=sigIdx)
+                if sigIdx is None:
+                    data2plot = data2plot.sum(axis=0)
+            elif sigIdx is not None:
                 data2plot=cubeDict[sig].data[sigIdx]
             else:
                 data2plot=cubeDict[sig].data.sum(axis=0)
@@ -619,12 +875,12 @@ class CubeAna(object):
             return
             
         if useHoloviews:
-            return self._inspectCube(run=run, sig=sig, sigIdx=sigIdx, plotLog=plotLog, normIdx=normIdx, useHoloviews=True, plotLowHighPercentile=True)
+            return self._inspectCube(run=run, sig=sig, sigIdx=sigIdx, plotLog=plotLog, normIdx=normIdx, useHoloviews=True, plotLowHighPercentile=True, aimSize=aimSize, usePyramid=usePyramid)
         else:
-            self._inspectCube(run=run, sig=sig, sigIdx=sigIdx, plotLog=plotLog, normIdx=normIdx, useHoloviews=False, plotLowHighPercentile=True)
+            self._inspectCube(run=run, sig=sig, sigIdx=sigIdx, plotLog=plotLog, normIdx=normIdx, useHoloviews=False, plotLowHighPercentile=True, aimSize=aimSize, usePyramid=usePyramid)
 
     #change this: do not use what typically contains ROI to pick slice, add explicit value.
-    def _inspectCube(self, run=None, sig=None, sigIdx=None, normIdx=None, plotWith=None, useHoloviews=False, plotLowHighPercentile=True, plotLog=False):
+    def _inspectCube(self, run=None, sig=None, sigIdx=None, normIdx=None, plotWith=None, useHoloviews=False, plotLowHighPercentile=True, plotLog=False, aimSize=4000000, usePyramid=True):
         if plotWith==None:
             plotWith=self._plotWith
             if plotWith=='matplotlib':
@@ -661,17 +917,31 @@ class CubeAna(object):
             sig = sig[0]
         else:
             sigROI=None
-        if sig not in cubeDict.variables:
+        pyramids = self._pyramidRuns(runKey) if usePyramid else None
+        if sig not in cubeDict.variables and (pyramids is None or sig not in self._lazyVars):
             print('could not find sig, return'); return
 
-        bins = self._cubeSumDict['bins'].data
-        data2plot = cubeDict[sig].data
+        levels = None
+        if self._inPyramids(pyramids, sig):
+            #coarsest level needed for aimSize, the data in memory if that is small enough
+            levels = pyramids[0].pickLevel(sig, aimSize)
+            if levels==(1,1) and sig in cubeDict.variables:
+                levels = None
+        if levels is not None:
+            binFactor, spatialFactor = levels
+            bins = pyramids[0].bins(binFactor)
+            data2plot = self.readLevel(sig, binFactor, spatialFactor, runKey)
+        else:
+            bins = self._cubeSumDict['bins'].data
+            data2plot = cubeDict[sig].data
         if sigROI is not None:
             data2plot = self._reduceData(data2plot, sigROI).copy() #apply ROI
         
         if normIdx is not None:
             if isinstance(normIdx, basestring):
-                if normIdx in cubeDict.keys():
+                if levels is not None and self._inPyramids(pyramids, normIdx):
+                    normIdx = self.readLevel(normIdx, binFactor, 1, runKey)
+                elif normIdx in cubeDict.keys():
                     normIdx = self._cubeSumDict[normIdx].data
                 else:
                     print('normIdx %s not in cube, options are: '%normIdx, cubeDict.keys())
@@ -715,8 +985,13 @@ class CubeAna(object):
             #print 'put code from notebook here?'
 
 
-    def getReducedCube(self, aimShape=None, aimSize=4000000, runKey = None):
+    def getReducedCube(self, aimShape=None, aimSize=4000000, runKey = None, usePyramid=True):
         print('make reduced data')
+        #read the needed levels of the pyramids of the cube files if possible
+        if usePyramid:
+            reducedCube = self._reducedFromPyramid(aimShape=aimShape, aimSize=aimSize, runKey=runKey)
+            if reducedCube is not None:
+                return reducedCube
         if runKey is None:
             cubeDict = self._cubeSumDict
         else:
@@ -795,9 +1070,9 @@ class CubeAna(object):
         return newXr
 
 
-    def plotReducedCube(self, sig=None, i0='nEntries', inCube=None, aimShape=None, aimSize=4000000, runKey = None):
+    def plotReducedCube(self, sig=None, i0='nEntries', inCube=None, aimShape=None, aimSize=4000000, runKey = None, usePyramid=True):
         if inCube is None:
-            inCube = self.getReducedCube(aimShape=aimShape, aimSize=aimSize, runKey=runKey)
+            inCube = self.getReducedCube(aimShape=aimShape, aimSize=aimSize, runKey=runKey, usePyramid=usePyramid)
             
         #now get possible images.
         if sig is not None:
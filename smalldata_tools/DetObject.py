@@ -1,11 +1,13 @@
 import os
 import copy
+import time
 import numpy as np
 import tables
 
 from smalldata_tools.utilities import cm_epix
 from smalldata_tools.utilities import cm_uxi
 from smalldata_tools.read_uxi import getDarks
+from smalldata_tools.DetObjectCache import getDefaultCache, CachedDetector
 from future.utils import iteritems
 from mpi4py import MPI
 rank = MPI.COMM_WORLD.Get_rank()
@@ -109,6 +111,10 @@ class DetObjectFunc(object):
 
 def DetObject(srcName, env, run, **kwargs):
     print('Getting the detector for: ',srcName)
+    #cache for constants (see DetObjectCache), def: cache set by setDefaultCache or SMALLDATA_CONST_CACHE
+    constCache = kwargs.pop('constCache', None)
+    if constCache is None:
+        constCache = getDefaultCache()
     det = None
     try:
         det = psana.Detector(srcName)
@@ -159,7 +165,15 @@ def DetObject(srcName, env, run, **kwargs):
     else:
         cls = detector_lookup[type(det)]
 
-    return cls(det, env, run, **kwargs)
+    tStart = time.time()
+    if constCache is not None and hasattr(det,'dettype'):
+        det = constCache.wrap(det, env, run)
+    detObj = cls(det, env, run, **kwargs)
+    if isinstance(det, CachedDetector):
+        det.done()
+        if rank==0:
+            print('Constants for %s: %d from cache, %d new, setup took %.2f s'%(srcName, det._entry.hits, det._entry.misses, time.time()-tStart))
+    return detObj
     ##should throw an exception here.
     #return None
 
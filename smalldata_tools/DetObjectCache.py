@@ -0,0 +1,268 @@
+"""
+Local on-disk cache of the detector constants used when building DetObjects.
+
+DetObject fetches pedestals, rms, gain, masks and the geometry through psana for
+each detector on every rank of every job. With a cache, the results of these
+calls are stored as .npy files and memory-mapped (copy-on-write) by later jobs.
+
+An entry is valid for an experiment, detector and the set of calibration files
+that apply to the run (their run ranges, sizes & modification times), so runs
+sharing the same constants share the entry and a new pedestal invalidates it.
+If no calibration files can be found (e.g. constants from the calibration
+database), the entry is only valid for the run itself.
+
+The cache is bounded in size, least recently used entries are removed first.
+
+usage:
+    setDefaultCache(ConstantsCache('/path/to/cache', maxGB=20))
+    det = DetObject('jungfrau1M', env, run)  #uses the default cache
+or set the environment variable SMALLDATA_CONST_CACHE to the cache directory.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+from glob import glob
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+cacheVersion = 1
+#psana.Detector methods returning constants (first argument is the run)
+cachedMethods = ['pedestals', 'rms', 'gain', 'gain_mask', 'common_mode', 'status', 'offset',
+                 'mask', 'coords_x', 'coords_y', 'coords_z', 'indexes_xy', 'image']
+
+_defaultCache = None
+
+def setDefaultCache(cache):
+    """ cache used by DetObject if no constCache is passed, None to disable """
+    global _defaultCache
+    _defaultCache = cache
+
+def getDefaultCache():
+    global _defaultCache
+    if _defaultCache is None and os.environ.get('SMALLDATA_CONST_CACHE', '')!='':
+        _defaultCache = ConstantsCache(os.environ['SMALLDATA_CONST_CACHE'])
+    return _defaultCache
+
+def _hashArgs(args, kwargs):
+    h = hashlib.blake2b(digest_size=8)
+    for arg in list(args)+sorted(kwargs.items()):
+        if isinstance(arg, tuple) and len(arg)==2 and isinstance(arg[0], str):
+            h.update(arg[0].encode())
+            arg = arg[1]
+        if isinstance(arg, np.ndarray):
+            h.update(str((arg.shape, arg.dtype.str)).encode())
+            h.update(np.ascontiguousarray(arg).view(np.uint8).data)
+        else:
+            h.update(repr(arg).encode())
+    return h.hexdigest()
+
+def _dumpJson(fname, obj):
+    with open(fname, 'w') as f:
+        json.dump(obj, f, indent=1)
+
+def _saveNpy(fname, arr):
+    #np.save appends .npy to file names without it, pass a file object
+    with open(fname, 'wb') as f:
+        np.save(f, arr)
+
+def _runRange(fname):
+    """ run range of a psana calibration file name: 12-end.data -> (12, None) """
+    try:
+        begin, end = os.path.basename(fname).split('.')[0].split('-')
+        return int(begin), (None if end=='end' else int(end))
+    except ValueError:
+        return None
+
+class CacheEntry(object):
+    """ constants of one detector for a range of runs, one file per call """
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        infoFile = os.path.join(path, 'entry.json')
+        if not os.path.isfile(infoFile):
+            self._writeAtomic(infoFile, lambda fname: _dumpJson(fname, info))
+        else:
+            #mark as used for the eviction
+            os.utime(infoFile, None)
+
+    def _writeAtomic(self, fname, writeFunc):
+        tmpName = '%s.tmp%d'%(fname, os.getpid())
+        writeFunc(tmpName)
+        os.replace(tmpName, fname)
+
+    def _saveArray(self, fname, arr):
+        self._writeAtomic(fname, lambda tmpName: _saveNpy(tmpName, arr))
+
+    def get(self, key):
+        """ returns (True, value) if the key is in the cache, (False, None) otherwise """
+        npyFile = os.path.join(self.path, key+'.npy')
+        jsonFile = os.path.join(self.path, key+'.json')
+        try:
+            if os.path.isfile(npyFile):
+                return True, np.load(npyFile, mmap_mode='c')
+            if os.path.isfile(jsonFile):
+                with open(jsonFile) as f:
+                    desc = json.load(f)
+                if desc['type']=='none':
+                    return True, None
+                if desc['type']=='value':
+                    return True, desc['value']
+                if desc['type']=='tuple':
+                    return True, tuple([np.load(os.path.join(self.path, '%s_%d.npy'%(key,i)), mmap_mode='c') for i in range(desc['n'])])
+        except Exception as e:
+            logger.warning('Could not read {0} from constants cache: {1}'.format(key, e))
+        return False, None
+
+    def put(self, key, value):
+        """ store value if it can be cached: arrays, tuples of arrays, None & simple values """
+        try:
+            if isinstance(value, np.ndarray) and not isinstance(value, np.ma.masked_array) and not value.dtype.hasobject:
+                self._saveArray(os.path.join(self.path, key+'.npy'), value)
+            elif value is None:
+                desc = {'type': 'none'}
+            elif isinstance(value, (tuple, list)) and len(value)>0 and all([isinstance(v, np.ndarray) for v in value]):
+                for i,v in enumerate(value):
+                    self._saveArray(os.path.join(self.path, '%s_%d.npy'%(key,i)), np.asarray(v))
+                desc = {'type': 'tuple', 'n': len(value)}
+            elif isinstance(value, (bool, int, float, str)):
+                desc = {'type': 'value', 'value': value}
+            else:
+                return
+            if not isinstance(value, np.ndarray):
+                self._writeAtomic(os.path.join(self.path, key+'.json'), lambda fname: _dumpJson(fname, desc))
+        except Exception as e:
+            logger.warning('Could not write {0} to constants cache: {1}'.format(key, e))
+
+class CachedDetector(object):
+    """
+    wraps a psana Detector: calls of cachedMethods with the run as first argument are
+    answered from the cache entry until done() is called (end of DetObject construction).
+    All other attributes are passed to the psana detector.
+    """
+    def __init__(self, det, entry):
+        self.__dict__['_det'] = det
+        self.__dict__['_entry'] = entry
+        self.__dict__['_active'] = True
+
+    def __getattr__(self, name):
+        attr = getattr(self._det, name)
+        if not self._active or name not in cachedMethods or not callable(attr):
+            return attr
+        entry = self._entry
+        def cachedCall(*args, **kwargs):
+            if len(args)==0 or not isinstance(args[0], (int, np.integer)):
+                return attr(*args, **kwargs)
+            key = name if (len(args)==1 and len(kwargs)==0) else '%s_%s'%(name, _hashArgs(args[1:], kwargs))
+            found, value = entry.get(key)
+            if found:
+                entry.hits += 1
+                return value
+            entry.misses += 1
+            value = attr(*args, **kwargs)
+            entry.put(key, value)
+            return value
+        return cachedCall
+
+    def __setattr__(self, name, value):
+        setattr(self._det, name, value)
+
+    def done(self):
+        """ stop using the cache, e.g. for images of event data """
+        self.__dict__['_active'] = False
+
+class ConstantsCache(object):
+    """
+    parameters: cacheDir: directory of the cache (def: ~/.cache/smalldata_tools/constants)
+                maxGB: size limit, least recently used entries are removed beyond this
+    """
+    def __init__(self, cacheDir=None, maxGB=20.):
+        if cacheDir is None:
+            cacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'smalldata_tools', 'constants')
+        self.cacheDir = cacheDir
+        self.maxBytes = maxGB*1024**3
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+    def calibFiles(self, env, srcName, run):
+        """ calibration files (of all types) that apply to this run for this detector """
+        try:
+            calibDir = env.calibDir()
+        except Exception:
+            return []
+        files = []
+        for typeDir in sorted(glob(os.path.join(calibDir, '*', srcName, '*'))):
+            best = None
+            for fname in glob(os.path.join(typeDir, '*.data')):
+                runRange = _runRange(fname)
+                if runRange is None or runRange[0]>run or (runRange[1] is not None and runRange[1]<run):
+                    continue
+                if best is None or runRange[0]>best[1][0]:
+                    best = (fname, runRange)
+            if best is not None:
+                stat = os.stat(best[0])
+                files.append([os.path.relpath(best[0], calibDir), best[1][0], best[1][1], stat.st_size, int(stat.st_mtime)])
+        return files
+
+    def entry(self, env, det, run):
+        """ cache entry for this detector & run """
+        try:
+            exp = env.experiment()
+        except Exception:
+            exp = 'unknown'
+        srcName = str(det.source).replace('DetInfo(','').replace(')','')
+        alias = getattr(det, 'alias', srcName)
+        files = self.calibFiles(env, srcName, run)
+        if len(files)>0:
+            runBegin = max([f[1] for f in files])
+            runEnds = [f[2] for f in files if f[2] is not None]
+            runEnd = min(runEnds) if len(runEnds)>0 else None
+        else:
+            runBegin, runEnd = run, run
+        info = {'version': cacheVersion, 'experiment': exp, 'detector': alias, 'source': srcName,
+                'dettype': getattr(det, 'dettype', -1), 'runBegin': runBegin, 'runEnd': runEnd,
+                'calibFiles': files}
+        key = hashlib.blake2b(json.dumps(info, sort_keys=True).encode(), digest_size=8).hexdigest()
+        path = os.path.join(self.cacheDir, '%s_%s_r%s-%s_%s'%(exp, alias, runBegin, 'end' if runEnd is None else runEnd, key))
+        isNew = not os.path.isdir(path)
+        entry = CacheEntry(path, info)
+        if isNew:
+            self.evict(keep=path)
+        return entry
+
+    def wrap(self, det, env, run):
+        """ return a CachedDetector for the psana detector """
+        try:
+            return CachedDetector(det, self.entry(env, det, int(run)))
+        except Exception as e:
+            logger.warning('Constants cache not used for {0}: {1}'.format(getattr(det, 'alias', det), e))
+            return det
+
+    def entries(self):
+        """ list of (last use, size in bytes, path) of all entries """
+        entries = []
+        for path in glob(os.path.join(self.cacheDir, '*', 'entry.json')):
+            path = os.path.dirname(path)
+            try:
+                size = sum([os.path.getsize(f) for f in glob(os.path.join(path, '*'))])
+                entries.append((os.path.getmtime(os.path.join(path, 'entry.json')), size, path))
+            except OSError:
+                pass #removed by another process
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """ remove least recently used entries until the cache is below its size limit """
+        entries = self.entries()
+        totalSize = sum([e[1] for e in entries])
+        for lastUse, size, path in entries:
+            if totalSize<=self.maxBytes:
+                break
+            if path==keep:
+                continue
+            logger.info('Remove {0} from constants cache ({1:.1f} MB)'.format(os.path.basename(path), size/1024.**2))
+            shutil.rmtree(path, ignore_errors=True)
+            totalSize -= size
@@ -124,6 +124,8 @@ class DetObjectClass_lcls2(object):
             print('This event has no data to be processed for %s'%self._name)
             return 
         for func in [self.__dict__[k] for k in  self.__dict__ if isinstance(self.__dict__[k], DetObjectFunc)]:
+            if func._proc == False: # skipped, e.g. by the pre-selection
+                continue
             try:
                 retData=func.process(self.evt.dat)
                 self.evt.__dict__['_write_%s'%func._name] = retData
@@ -2,10 +2,15 @@ import numpy as np
 from matplotlib import pyplot as plt
 from scipy import sparse
 from smalldata_tools.utilities import hist2d
+from smalldata_tools.SmallDataRagged import RaggedStore, raggedFiles as findRaggedFiles
 import holoviews as hv
 
 class droplets(object):
-    def __init__(self,h5file,detName='epix',dropName='droplet', plotWith='matplotlib'):
+    """
+    raggedFiles: columnar files with the ragged droplet data (def: look for the
+                 files written next to the small data file by the producer)
+    """
+    def __init__(self,h5file,detName='epix',dropName='droplet', plotWith='matplotlib', raggedFiles=None):
         self._detName=detName
         self._dropName=dropName
         if self._dropName[-1]!='_':
@@ -13,6 +18,8 @@ class droplets(object):
         self._h5 = h5file
         self._h5dir = self._h5.get_node('/'+self._detName)
         self._plotWith=plotWith
+        self._raggedFiles=raggedFiles
+        self._raggedStore=None
 
     def set_plotWith(self, plotWith):
         self._plotWith=plotWith
@@ -24,7 +31,49 @@ class droplets(object):
                 keyList.append(data)
         return keyList
 
-    def fillDropArrays(self, only_XYADU=False, Filter=None):
+    def _getRaggedStore(self):
+        if self._raggedStore is not None:
+            return self._raggedStore
+        files = self._raggedFiles
+        if files is None:
+            files = findRaggedFiles(self._h5.filename)
+        if len(files)==0:
+            return None
+        evtTimes = None
+        for timeName in ['event_time', 'timestamp']:
+            if '/'+timeName in self._h5:
+                evtTimes = self._h5.get_node('/'+timeName).read()
+                break
+        self._raggedStore = RaggedStore(files, eventTimes=evtTimes)
+        return self._raggedStore
+
+    def fillRaggedArrays(self, only_XYADU=False, Filter=None, lazy=False):
+        """
+        fill droplet data from the columnar files. The values of all droplets are
+        returned as flat arrays with the event index in evtIdx, only the events
+        selected by Filter are read. lazy: do not read the data, data[ievt] returns the
+        droplets of one event.
+        """
+        store = self._getRaggedStore()
+        if store is None:
+            return []
+        XYADU_keys = ['X','Y','adu','npix','data','col','row','sparse_data','sparse_col','sparse_row','sparse_npix']
+        keys = []
+        for field in store.fields(self._detName):
+            if not field.startswith(self._dropName):
+                continue
+            keyName = field.replace(self._dropName,'',1)
+            if only_XYADU and keyName not in XYADU_keys:
+                continue
+            column = store.column(self._detName, field)
+            if lazy:
+                self.__dict__[keyName] = column
+            else:
+                self.__dict__[keyName], self.__dict__['evtIdx'] = column.read(Filter=Filter)
+            keys.append(keyName)
+        return keys
+
+    def fillDropArrays(self, only_XYADU=False, Filter=None, lazy=False):
         #get shape of detector, right now EPIX is hardcoded...
         try:
             dX = self._h5.get_node('/UserDataCfg/'+self._detName, 'iX').read().max() - self._h5.get_node('/UserDataCfg/'+self._detName, 'iX').read().min()
@@ -64,6 +113,10 @@ class droplets(object):
                     self.__dict__[keyName] = self._h5.get_node('/'+self._detName, h5Name).read()[Filter]
                 else:
                     self.__dict__[keyName] = self._h5.get_node('/'+self._detName, h5Name).read()
+        #ragged droplet data is stored in separate columnar files
+        raggedKeys = self.fillRaggedArrays(only_XYADU=only_XYADU, Filter=Filter, lazy=lazy)
+        if len(raggedKeys)>0:
+            print('read columnar data for ',raggedKeys)
 
     def flattenDropArray(self, filterArray=None):
         self.dataname=None
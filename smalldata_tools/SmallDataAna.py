@@ -12,6 +12,9 @@ addToFavoriteList function that will add self created vars (or maybe add any ROI
 from os import makedirs
 from os import path
 from os import walk
+from os import listdir
+from os import replace as os_replace
+from os import remove as os_remove
 import numpy as np
 from scipy import interpolate
 import time
@@ -19,13 +22,22 @@ import json
 import subprocess
 import socket
 from scipy import sparse
+try:
+    #filters (LZ4, bitshuffle,...) of files written with an OutputPolicy,
+    #pytables only finds them if the path is set before it is imported
+    import hdf5plugin
+    import os
+    os.environ.setdefault('HDF5_PLUGIN_PATH', hdf5plugin.PLUGIN_PATH)
+except ImportError:
+    pass
 import tables
+import h5py
 from matplotlib import gridspec
 from pylab import ginput
 from matplotlib import pyplot as plt
 from smalldata_tools.utilities import dictToHdf5, shapeFromKey_h5
 from smalldata_tools.utilities import hist2d
-from smalldata_tools.utilities import running_median_insort
+from smalldata_tools.utilities_rolling import rolling_stat
 from smalldata_tools.utilities import get_startOffIdx, get_offVar
 from smalldata_tools.utilities import getBins as util_getBins
 from smalldata_tools.utilities import printR
@@ -229,6 +241,35 @@ class Selection(object):
             self.cuts.append(cut)
         self._filter=None
 
+def getTTstr(fields):
+    """
+    names of the timetool correction & base string of the timetool variables in a run
+    necessary as naming scheme evolved over time
+    """
+    ttCorr = None
+    ttBaseStr = 'tt/'
+    if 'tt/ttCorr' in fields:
+        ttCorr = 'tt/ttCorr'
+    elif 'ttCorr/tt' in fields:
+        ttCorr = 'ttCorr/tt'
+    if not ttBaseStr+'AMPL' in fields:
+        if 'tt/XPP_TIMETOOL_AMPL'  in fields:
+            ttBaseStr = 'tt/XPP_TIMETOOL_'
+        elif 'tt/TIMETOOL_AMPL'  in fields:
+            ttBaseStr = 'tt/TIMETOOL_'
+        elif 'tt/TTSPEC_AMPL'  in fields:
+            ttBaseStr = 'tt/TTSPEC_'
+    return ttCorr, ttBaseStr
+
+def laserOffIgnoreVars(fields, ttCorr, ttBaseStr):
+    """ cuts dropped for laser off (__off) selections: laser & timetool requirements """
+    ignoreVar = ['lightStatus/laser', 'enc/lasDelay']
+    if ttCorr is not None:
+        ignoreVar.append(ttCorr)
+    if ttBaseStr+'AMPL' in fields:
+        ignoreVar += [ttBaseStr+'AMPL', ttBaseStr+'FLTPOS', ttBaseStr+'FLTPOS_PS', ttBaseStr+'FLTPOSFWHM']
+    return ignoreVar
+
 class SmallDataAna(object):
     """ 
     class to deal with data in smallData hdf5 file. 
@@ -336,6 +377,10 @@ class SmallDataAna(object):
         self._delay_ttCorr=None
         self._delay_addLxt=None
         self._delay_addEnc=None
+        self._delay_ttCalib=None
+        self._delay_interpLxt=None
+        self._delayCache={}
+        self._delayKey=None
         #define bokeh palette based on matplotlib job for consistency of matplotlib & bokeh image plots
         import matplotlib.cm as cm
         import matplotlib as pltm
@@ -344,8 +389,12 @@ class SmallDataAna(object):
         self._epicsArchive=None
 
     def __del__(self):
-        if rank==0:
-            self._writeNewData()
+        try:
+            unsaved = [key for key in self._fields.keys() if self._fields[key][2]=='mem' and key!='delay']
+        except:
+            return
+        if rank==0 and len(unsaved)>0:
+            print('derived variables were not saved, call saveNewData() to keep them: ',unsaved)
         return
 
     def _getXarrayDims(self,key,tleaf_name=None, setNevt=-1):
@@ -465,21 +514,26 @@ class SmallDataAna(object):
         elif self._fields[name][2]=='main':
             #print('add a variable from the main data to Xarray: ',name)
             self._fields[name]=[data.shape, 'inXr', 'main']
-        elif  self._fields[name][2]=='xrfile':
+        elif  self._fields[name][2] in ['xrfile', 'xrstore']:
             #print('add a variable from an netcdf to Xarray: ',name)
-            self._fields[name]=[data.shape, 'inXr', 'xrfile']
+            self._fields[name]=[data.shape, 'inXr', self._fields[name][2]]
             try:
-                testShape = self.xrData[name].data.shape
-                if (self.xrData[name].data==data).sum()!=data.shape[0]:
-                    self.xrData[name].data = data
+                xrName = name.replace('/','__')
+                testShape = self.xrData[xrName].data.shape
+                if (self.xrData[xrName].data==data).sum()!=data.size:
+                    self.xrData[xrName].data = data
                     #reset this to memory so that file will get overwritten
                     self._fields[name]=[data.shape, 'inXr', 'mem']
                 return
             except:
-                pass
+                #not loaded yet: new values unless called from _loadXarrayData
+                self._fields[name]=[data.shape, 'inXr', 'mem']
         else:
             #print('try to add a variable already present in xrData, only replace values!')
-            self.xrData[name].data = data
+            self.xrData[name.replace('/','__')].data = data
+            #inputs of the delay calculation changed: drop the memoized delays
+            if name.split('/')[0] in ['tt','ttCorr','enc','epics','scan']:
+                self._delayCache={}
             return
 
         #create new xrData to be merged
@@ -509,87 +563,174 @@ class SmallDataAna(object):
             fieldName = key.replace('__','/')
             if fieldName not in self._fields.keys():
                 print('added new data field %s to list',key)
-                self._fields[fieldName]={self.xrData[key].shape, 'inXr', 'mem'}
+                self._fields[fieldName]=[self.xrData[key].shape, 'inXr', 'mem']
 
-    def _writeNewData(self):
+    def _xrStoreName(self):
+        return '%s/xr_store_%s_Run%03d.h5'%(self.dirname,self.expname,self.run)
+
+    def saveNewData(self, keys=None):
+        """
+        write newly created or changed fields to the sidecar hdf5 file so they can be loaded 
+        in future sessions. Only fields that changed since the last save are written.
+        parameters: keys=None: list of fields to save, all changed fields if None
+        """
+        if rank==0:
+            self._writeNewData(keys=keys)
+
+    def _writeNewData(self, keys=None):
         """
-        write newly created fields to netcdf files that can be loaded in future sessions
+        write changed fields as chunked datasets to the sidecar file (vars/<key>). A field that 
+        was saved before is overwritten in place if its shape did not change, replaced otherwise.
+        The file is repacked when replaced datasets leave more than half of it unused.
         """
-        print('save derived data to be loaded next time:')
-        for key in self._fields.keys():
-            #delay is special: make sure it gets redefined on each new SmallDataAna creation 
-            #to allow to use different definitions. getDelay will be called internally w/ default params 
-            #so it needs to return the current defined variable first if applicable
-            #saving does not help performace this is a cheap calculation.
-            if key=='delay': continue 
-            if self._fields[key][2] == 'mem':
-                print('saving data for field: ',key, self._fields[key])
+        if keys is None:
+            keys = list(self._fields.keys())
+        #delay is special: make sure it gets redefined on each new SmallDataAna creation 
+        #to allow to use different definitions. getDelay will be called internally w/ default params 
+        #so it needs to return the current defined variable first if applicable
+        #saving does not help performace this is a cheap calculation.
+        dirtyKeys = [key for key in keys if key!='delay' and key in self._fields.keys() 
+                     and self._fields[key][2] == 'mem']
+        if len(dirtyKeys)==0:
+            return
+        print('save derived data to be loaded next time:',dirtyKeys)
+        try:
+            fStore = h5py.File(self._xrStoreName(), 'a')
+        except:
+            print('could not open %s to save derived data'%self._xrStoreName())
+            return
+        with fStore:
+            varGroup = fStore.require_group('vars')
+            for key in dirtyKeys:
                 data = self.getVar(key)
-                #print('DEBUG: shape ',data.shape)
-                if key[0]=='/': key = key[1:]
                 if isinstance(data, xr.DataArray):
-                    print('get xarray for ',key)
-                    new_xrData = data
-                elif isinstance(data, np.ndarray):
-                    if len(data.shape)==1:
-                        new_xrData = xr.DataArray(data, coords={'time': self._tStamp}, dims=('time'),name=key) 
-                    else:
-                        coords={'time': self._tStamp}
-                        dims = ['time']
-                        dataShape = data.shape
-                        for dim in range(len(dataShape)-1):
-                            thisDim = np.arange(0, dataShape[dim+1])
-                            dimStr = 'dim%d'%dim
-                            coords[dimStr] = thisDim
-                            dims.append(dimStr)
-                        new_xrData = xr.DataArray(data, coords=coords, dims=dims,name=name)
-                else:
+                    data = data.values
+                if not isinstance(data, np.ndarray):
                     print('was passed data which is neither xArray nor np. array. will not save ',key)
+                    continue
+                if key[0]=='/': key = key[1:]
+                storeKey = key.replace('/','__')
+                if storeKey in varGroup and varGroup[storeKey].shape==data.shape and varGroup[storeKey].dtype==data.dtype:
+                    varGroup[storeKey][...] = data
+                else:
+                    if storeKey in varGroup:
+                        del varGroup[storeKey]
+                    chunks = (min(data.shape[0], 4096),)+data.shape[1:] if data.shape[0]>0 else None
+                    varGroup.create_dataset(storeKey, data=data, chunks=chunks)
+                self._fields[key][2] = 'xrstore'
+            if 'index' in fStore:
+                del fStore['index']
+            fStore.create_dataset('index', data=np.array(sorted(varGroup.keys()), dtype=h5py.string_dtype()))
+            usedBytes = sum([varGroup[storeKey].id.get_storage_size() for storeKey in varGroup.keys()])
+        if path.getsize(self._xrStoreName()) > 2*usedBytes+1024*1024:
+            self._repackXrStore()
+        return
 
-                xrname='%s/xr_%s_%s_Run%03d.nc'%(self.dirname,key.replace('/','__'),self.expname,self.run)
-                print('data for %s is only in memory, write to file with name: %s '%(key,xrname))
-                new_xrData.to_netcdf(xrname,engine='h5netcdf')
-            return
+    def _repackXrStore(self):
+        """ copy the current fields of the sidecar file to a new file to free the space of replaced fields """
+        fname = self._xrStoreName()
+        tmpName = fname+'.repack'
+        try:
+            with h5py.File(fname, 'r') as fStore, h5py.File(tmpName, 'w') as fNew:
+                fStore.copy('vars', fNew)
+                fStore.copy('index', fNew)
+            os_replace(tmpName, fname)
+        except:
+            print('failed to repack ',fname)
+            if path.isfile(tmpName):
+                os_remove(tmpName)
+
+    def _loadXarrayData(self, key):
+        """ load a single field saved in a previous session into xrData """
+        try:
+            if self._fields[key][2] == 'xrstore':
+                with h5py.File(self._xrStoreName(), 'r') as fStore:
+                    values = fStore['vars'][key.replace('/','__')][()]
+            else:
+                fname = self._xrFiles[key]
+                with xr.open_dataset(fname, engine='h5netcdf') as add_xrDataSet:
+                    values = add_xrDataSet[key.replace('/','__')].values
+        except:
+            print('failed to read saved data for ',key)
+            return None
+        source = self._fields[key][2]
+        self.addVar(key, values)
+        self._fields[key][2] = source
+        return values
 
     def _readXarrayData(self):
-        """ read data previously saved as netcdf files for this run"""
-        for (dirpath, dirnames, filenames) in walk(self.dirname):        
-            for fname in filenames:
-                if fname.find('xr')==0 and fname.find('Run%03d'%self.run)>=0:
-                    try:
-                        add_xrDataSet = xr.open_dataset(self.dirname+'/'+fname,engine='h5netcdf')
-                        key = fname.replace('xr_','').replace('%s_Run%03d.nc'%(self.expname,self.run),'')
-                        if key[-1]=='_':key=key[:-1]
-                        if len(add_xrDataSet[key].shape)>2:
-                            continue
-                        if (len(add_xrDataSet[key].shape)==2 and add_xrDataSet[key].shape[1]<10):
-                            continue
-                        key = key.replace('__','/')
-                        self._fields[key]=[add_xrDataSet[key].shape, 'inXr', 'xrfile']
-                        values = add_xrDataSet[key].values
-                        self.addVar(key, values)
-                        #need to print(this dataset, otherwise this does not work. Why #DEBUG ME)
-                        print('found filename %s, added data for key %s '%(fname, key), add_xrDataSet[key])
-                        add_xrDataSet.close()
-                        print('closed the xarray file ')
-                    except:
-                        print('failed at xr.open_dataset for: ',self.dirname+'/'+fname)
+        """ 
+        look for data saved in previous sessions for this run. Only the index is read here, 
+        the data itself is loaded when requested.
+        """
+        self._xrFiles = {}
+        #files written by older versions: one netcdf file per variable
+        for fname in listdir(self.dirname) if path.isdir(self.dirname) else []:
+            if fname.find('xr_')==0 and fname.find('xr_store_')<0 and fname.find('Run%03d.nc'%self.run)>=0:
+                key = fname.replace('xr_','').replace('%s_Run%03d.nc'%(self.expname,self.run),'')
+                if key[-1]=='_':key=key[:-1]
+                try:
+                    with xr.open_dataset(self.dirname+'/'+fname,engine='h5netcdf') as add_xrDataSet:
+                        keyShape = add_xrDataSet[key].shape
+                except:
+                    print('failed at xr.open_dataset for: ',self.dirname+'/'+fname)
+                    continue
+                if len(keyShape)>2 or (len(keyShape)==2 and keyShape[1]<10):
+                    continue
+                key = key.replace('__','/')
+                self._fields[key]=[keyShape, 'onDisk', 'xrfile']
+                self._xrFiles[key]=self.dirname+'/'+fname
+        if not path.isfile(self._xrStoreName()):
+            return
+        try:
+            with h5py.File(self._xrStoreName(), 'r') as fStore:
+                for storeKey in fStore['index'].asstr()[()]:
+                    key = storeKey.replace('__','/')
+                    self._fields[key]=[fStore['vars'][storeKey].shape, 'onDisk', 'xrstore']
+                    print('found saved data for key %s'%key)
+        except:
+            print('failed to read index of ',self._xrStoreName())
 
 ###
 # functions to add extra variables to smallData
 ###
-    def addMedianVar(self, name='newVar', windowsize=31):
+    def addMedianVar(self, name='newVar', windowsize=31, center=False):
         """
         add a variable containing the median of the input variable to the data.
         parameters: name='newVar', windowsize=31
                     name: variable name as already present in data
                     windowsize: number of events prior to current used to calc median
+                    center: use window centered on event rather than trailing
+        """
+        self.addRollingVar(name, windowsize=windowsize, stat='median', center=center)
+
+    def addRollingVar(self, name='newVar', windowsize=31, stat='median', center=False, minPeriods=1):
+        """
+        add a variable containing a rolling statistic of a 1-d variable to the data.
+        NaNs in the input are ignored inside the window.
+        parameters: name='newVar', windowsize=31, stat='median', center=False, minPeriods=1
+                    name: variable name as already present in data
+                    windowsize: number of events in window
+                    stat: median, mean, std or quantile (e.g. 0.1 or 'q0.1')
+                    center: use window centered on event rather than trailing
+                    minPeriods: minimum number of valid events in window
+        new variable is called <stat>_<name>
         """
         dataOrg = self.getVar(name)
-        dataNew=running_median_insort(dataOrg, windowsize=windowsize)
-        medVarName = ('median_%s'%name).replace('/','_')
-        print('add variable named: ',medVarName)
-        self.addVar(medVarName, dataNew)
+        if dataOrg is None:
+            print('could not get variable %s, cannot add rolling %s'%(name, stat))
+            return
+        if len(np.squeeze(dataOrg).shape)>1:
+            print('rolling statistics only work for 1-d variables, %s has shape: '%name, dataOrg.shape)
+            return
+        dataNew = rolling_stat(np.asarray(dataOrg).flatten(), stat=stat, windowsize=windowsize, center=center, minPeriods=minPeriods)
+        if isinstance(stat, str):
+            statName = stat.replace('.','p')
+        else:
+            statName = ('q%g'%stat).replace('.','p')
+        rollVarName = ('%s_%s'%(statName, name)).replace('/','_')
+        print('add variable named: ',rollVarName)
+        self.addVar(rollVarName, dataNew)
 
     def _getStartOffIdx(self, selName, nNbr=3, overWrite=False):
         """ function to get start of the indices for neighboring off events"""
@@ -744,20 +885,7 @@ class SmallDataAna(object):
         function to determine the string for the timetool variables in the desired run
         necessary as naming scheme evolved over time
         """
-        ttCorr = None
-        ttBaseStr = 'tt/'
-        if 'tt/ttCorr' in self._fields.keys():
-            ttCorr = 'tt/ttCorr'
-        elif 'ttCorr/tt' in self._fields.keys():
-            ttCorr = 'ttCorr/tt'
-        if not ttBaseStr+'AMPL' in self._fields.keys():
-            if 'tt/XPP_TIMETOOL_AMPL'  in self._fields.keys():
-                ttBaseStr = 'tt/XPP_TIMETOOL_'
-            elif 'tt/TIMETOOL_AMPL'  in self._fields.keys():
-                ttBaseStr = 'tt/TIMETOOL_'
-            elif 'tt/TTSPEC_AMPL'  in self._fields.keys():
-                ttBaseStr = 'tt/TTSPEC_'
-        return ttCorr, ttBaseStr
+        return getTTstr(self._fields.keys())
 
     def addCut(self, varName, varmin=0, varmax=0, useFilter=None):
         """
@@ -867,15 +995,7 @@ class SmallDataAna(object):
                 return (self.Sels[useFilterBase]._filter&[self.getVar('lightStatus/laser')==1]).squeeze()
 
         if LaserReq == 0:
-            ignoreVar.append('lightStatus/laser')
-            ignoreVar.append('enc/lasDelay')
-            if self.ttCorr is not None:
-                ignoreVar.append(self.ttCorr)
-            if self.hasKey(self.ttBaseStr+'AMPL'):
-                ignoreVar.append(self.ttBaseStr+'AMPL')
-                ignoreVar.append(self.ttBaseStr+'FLTPOS')
-                ignoreVar.append(self.ttBaseStr+'FLTPOS_PS')
-                ignoreVar.append(self.ttBaseStr+'FLTPOSFWHM')
+            ignoreVar = ignoreVar+laserOffIgnoreVars(self._fields.keys(), self.ttCorr, self.ttBaseStr)
 
         filters=[]
         for thiscut in self.Sels[useFilterBase].cuts:
@@ -974,6 +1094,14 @@ class SmallDataAna(object):
             print('signal variable %s not in list'%(plotvar))
             return
 
+        #data saved in a previous session: load now.
+        if self._fields[plotvar][1]=='onDisk' and self._fields[plotvar][2] in ['xrfile', 'xrstore']:
+            if self._loadXarrayData(plotvar) is None:
+                return
+            if sigROI!=[]:
+                return self.getVar([plotvar, sigROI], useFilter=Filter, addToXarray=addToXarray)
+            return self.getVar(plotvar, useFilter=Filter, addToXarray=addToXarray)
+
         #FIX ME
         #if Filter picks > 50% of events, get all  data, add to xarray & return filtered data after
         #if Filter.sum()/Filter.shape[0]>0.25 and sigROI!=[]:
@@ -1047,26 +1175,69 @@ class SmallDataAna(object):
             vals = np.nansum(vals,axis=1)
         return vals
 
-    def setDelay(self, use_ttCorr=True, addEnc=False, addLxt=True, reset=False):
-        delay=self.getDelay(use_ttCorr=use_ttCorr, addEnc=addEnc, addLxt=addLxt, reset=reset)
+    def setDelay(self, use_ttCorr=True, addEnc=False, addLxt=True, ttCalib=None, interpLxt=False, reset=False):
+        delay=self.getDelay(use_ttCorr=use_ttCorr, addEnc=addEnc, addLxt=addLxt, ttCalib=ttCalib, interpLxt=interpLxt, reset=reset)
+
+    def _interpEpicsDelay(self, epicsVal):
+        """
+        EPICS variables are only updated at ~1Hz and stay constant in between.
+        Interpolate linearly in time between the events where the value changed.
+        """
+        epicsVal = np.asarray(epicsVal, dtype=float)
+        if epicsVal.shape[0] < 2:
+            return epicsVal
+        #events are in gather order, not time order: interpolate in time order & scatter back
+        evtTime = self._tStamp.astype(np.int64).astype(float)
+        order = np.argsort(evtTime, kind='stable')
+        sortTime = evtTime[order]
+        sortVal = epicsVal[order]
+        updIdx = np.concatenate([[0], np.nonzero(np.diff(sortVal))[0]+1])
+        if updIdx.shape[0] < 2:
+            return epicsVal
+        interpVal = np.empty_like(epicsVal)
+        interpVal[order] = np.interp(sortTime, sortTime[updIdx], sortVal[updIdx])
+        return interpVal
 
     # make delay another Xarray variable.
-    def getDelay(self, use_ttCorr=True, addEnc=False, addLxt=True, reset=False):
+    def getDelay(self, use_ttCorr=None, addEnc=None, addLxt=None, ttCalib=None, interpLxt=None, reset=False):
         """
         function to get the xray-laser delay from the data
         usage:
         getDelay(): get the delay from lxt and/or encoder stage, add the timetool correction
         getDelay(use_ttCorr=False): get the delay from lxt and/or encoder stage, NO timetool correction
         getDelay(addEnc=True): get the delay from lxt, add encoder stage and timetool correction
-        return previously define delay unless reset=True
+        getDelay(ttCalib=[a,b,c]): calculate timetool correction as polynomial of FLTPOS
+        getDelay(interpLxt=True): interpolate EPICS lxt in time between updates
+        parameters not passed keep the current definition (defaults: use_ttCorr=True, addEnc=False, addLxt=True)
+        delays are memoized for each set of parameters, return previously defined delay unless reset=True
         """
-        if 'delay' in self._fields.keys() and not reset:
+        if reset:
+            self._delayCache={}
+        #parameters not passed: use current definition
+        if use_ttCorr is None:
+            use_ttCorr = True if self._delay_ttCorr is None else self._delay_ttCorr
+        if addEnc is None:
+            addEnc = False if self._delay_addEnc is None else self._delay_addEnc
+        if addLxt is None:
+            addLxt = True if self._delay_addLxt is None else self._delay_addLxt
+        if ttCalib is None:
+            ttCalib = self._delay_ttCalib
+        if interpLxt is None:
+            interpLxt = False if self._delay_interpLxt is None else self._delay_interpLxt
+        if ttCalib is not None:
+            ttCalib = tuple(np.asarray(ttCalib).flatten().tolist())
+        delayKey = (use_ttCorr, addEnc, addLxt, ttCalib, interpLxt, self.ttCorr, self.ttBaseStr)
+
+        #delay from previous session/definition w/o memoized values.
+        if 'delay' in self._fields.keys() and not reset and self._delayKey is None and len(self._delayCache)==0:
+            return self.xrData['delay']
+        if delayKey in self._delayCache:
+            if delayKey != self._delayKey or 'delay' not in self._fields.keys():
+                self.addVar('delay', self._delayCache[delayKey])
+                self._delayKey = delayKey
+                self._delay_ttCorr, self._delay_addEnc, self._delay_addLxt, self._delay_ttCalib, self._delay_interpLxt = delayKey[:5]
             return self.xrData['delay']
         
-        self._delay_ttCorr=use_ttCorr
-        self._delay_addLxt=addLxt
-        self._delay_addEnc=addEnc
-
         ttCorrStr, ttBaseStr = self._getTTstr()
         ttCorr = np.zeros_like(self.xrData.fiducials)
         if self.ttCorr is not None:
@@ -1074,6 +1245,11 @@ class SmallDataAna(object):
         if (np.nanstd(ttCorr)==0):
             if (self.ttBaseStr+'FLTPOS_PS') in self._fields.keys():
                 ttCorr=self.getVar(self.ttBaseStr+'FLTPOS_PS')
+        if ttCalib is not None:
+            if (self.ttBaseStr+'FLTPOS') in self._fields.keys():
+                ttCorr=np.polyval(ttCalib, self.getVar(self.ttBaseStr+'FLTPOS'))
+            else:
+                print('did not find %sFLTPOS, cannot apply timetool calibration'%self.ttBaseStr)
         nomDelay=np.zeros_like(ttCorr)
         if len(nomDelay.shape) == 0:
             return None
@@ -1083,6 +1259,8 @@ class SmallDataAna(object):
             epics_delay = self.getVar('epics/lxt_ttc')
         elif self.hasKey('epics/lxt'):
             epics_delay = self.getVar('epics/lxt')
+        if interpLxt:
+            epics_delay = self._interpEpicsDelay(epics_delay)
 
         isDaqDelayScan=False
         scanVar = self.getScanName()
@@ -1140,10 +1318,8 @@ class SmallDataAna(object):
                 nomDelay=nomDelay.copy()+self.getVar('enc/lasDelay')
 
         if addLxt and scanVar!='lxt':
-            if self.hasKey('epics/lxt_ttc'):
-                nomDelay=nomDelay.copy()+self.getVar('epics/lxt_ttc')*1e12
-            elif self.hasKey('epics/lxt'):
-                nomDelay=nomDelay.copy()+self.getVar('epics/lxt')*1e12
+            if self.hasKey('epics/lxt_ttc') or self.hasKey('epics/lxt'):
+                nomDelay=nomDelay.copy()+epics_delay*1e12
 
         if use_ttCorr:
             #print('DEBUG adding ttcorr,nomdelay mean,std: ',ttCorr.mean(),nomDelay.mean(),ttCorr.std(),nomDelay.std())
@@ -1151,6 +1327,9 @@ class SmallDataAna(object):
         else:
             delay = nomDelay
 
+        self._delayCache[delayKey] = delay
+        self._delayKey = delayKey
+        self._delay_ttCorr, self._delay_addEnc, self._delay_addLxt, self._delay_ttCalib, self._delay_interpLxt = delayKey[:5]
         self.addVar('delay', delay)
         return delay
 
@@ -2391,7 +2570,43 @@ class SmallDataAna(object):
     ###
     ##########################################################################
 
-    def AvImage(self, detname='None', numEvts=100, nSkip=0, thresADU=0., thresRms=0.,useFilter=None, mean=False, std=False):
+    def _areaDataBlocks(self, detname, evtIdx, chunkSize=500):
+        """
+        generator returning the data of detname for the events in evtIdx
+        in blocks of at most chunkSize events. Data on disk is read block by block
+        so that only one block is in memory at a time.
+        """
+        node = None
+        if not (detname in self._fields.keys() and self._fields[detname][1]=='inXr'):
+            try:
+                if len(detname.split('/'))>1:
+                    node = self.fh5.get_node('/'+'/'.join(detname.split('/')[:-1]),detname.split('/')[-1])
+                else:
+                    node = self.fh5.get_node('/'+detname)
+            except:
+                node = None
+        if node is None:
+            fullData = self.getVar(detname, addToXarray=False)
+            for iBlock in range(0, evtIdx.shape[0], chunkSize):
+                yield fullData[evtIdx[iBlock:iBlock+chunkSize]]
+            return
+        for iBlock in range(0, evtIdx.shape[0], chunkSize):
+            blockIdx = evtIdx[iBlock:iBlock+chunkSize]
+            #read contiguous range if events are dense, single events otherwise
+            if (blockIdx[-1]-blockIdx[0]+1) <= 4*blockIdx.shape[0]:
+                yield node[blockIdx[0]:blockIdx[-1]+1][blockIdx-blockIdx[0]]
+            else:
+                yield np.array([node[idx] for idx in blockIdx])
+
+    def AvImage(self, detname='None', numEvts=100, nSkip=0, thresADU=0., thresRms=0.,useFilter=None, mean=False, std=False, chunkSize=500):
+        """
+        sum/average area detector data for selected events. Data is read in blocks of
+        chunkSize events, thresholds are applied per block and sum, sum of squares,
+        maximum & number of pixels above threshold are accumulated in one pass.
+        parameters: detname, numEvts=100, nSkip=0, thresADU=0., thresRms=0., useFilter=None, mean=False, std=False, chunkSize=500
+                    mean/std: store mean/standard deviation rather than sum of the events
+        the image is stored as AvImg_<...>, a dictionary of all accumulated images is returned.
+        """
         #look for detector
         if detname=='None':
             aliases=self.Keys2d()
@@ -2422,30 +2637,50 @@ class SmallDataAna(object):
         #only events requested
         if useFilter is not None:
             Filter = self.getFilter(useFilter=useFilter)
-            dataAr = self.getVar(detname,Filter)
-            dataAr = dataAr[nSkip:min(nSkip+numEvts, dataAr.shape[0])].squeeze()
+            evtIdx = np.argwhere(Filter).flatten()
         else:
-            #now look at subarray
-            dataAr = self.getVar(detname)[nSkip:min(nSkip+numEvts, self._tStamp.shape[0])].squeeze()
+            evtIdx = np.arange(self._tStamp.shape[0])
+        evtIdx = evtIdx[nSkip:nSkip+numEvts]
+        if evtIdx.shape[0]==0:
+            print('no events selected for %s, nothing to average'%detname)
+            return
 
-        #now apply threshold is requested:
+        imgSum = None
+        nEvts = 0
+        for dataBlock in self._areaDataBlocks(detname, evtIdx, chunkSize=chunkSize):
+            dataBlock = dataBlock.astype(float)
+            if imgSum is None:
+                frameShape = np.squeeze(dataBlock[0]).shape
+                imgSum = np.zeros(frameShape)
+                imgSumSq = np.zeros(frameShape)
+                imgMax = np.full(frameShape, -np.inf)
+                imgHits = np.zeros(frameShape, dtype=int)
+                if rms is not None and rms.shape!=frameShape:
+                    print('rms shape %s does not match data %s, ignore rms threshold'%(rms.shape, frameShape))
+                    rms = None
+            dataBlock = dataBlock.reshape((dataBlock.shape[0],)+frameShape)
+            #now apply threshold is requested:
+            if thresADU != 0:
+                dataBlock[dataBlock<abs(thresADU)]=0
+            if thresRms > 0 and rms is not None:
+                dataBlock[dataBlock<thresRms*rms]=0
+            imgSum += dataBlock.sum(axis=0)
+            imgSumSq += (dataBlock*dataBlock).sum(axis=0)
+            imgMax = np.maximum(imgMax, dataBlock.max(axis=0))
+            imgHits += (dataBlock>0).sum(axis=0)
+            nEvts += dataBlock.shape[0]
+
+        imgMean = imgSum/nEvts
+        imgStd = np.sqrt(np.clip(imgSumSq/nEvts - imgMean*imgMean, 0, None))
         data='AvImg_'
         if std:
-            thresDat = dataAr.mean(axis=0)
+            thresDat = imgStd
             data+='std_'
         elif mean:
-            thresDat = dataAr.std(axis=0)
+            thresDat = imgMean
             data+='mean_'
         else:
-            thresDat = np.zeros_like(dataAr[0])
-            for shot in dataAr:
-                if thresADU != 0:
-                    shot[shot<abs(thresADU)]=0
-                    #shot[shot>=abs(thresADU)]=1
-                if thresRms > 0 and rms is not None:
-                    shot[shot<thresRms*rms]=0
-                    #shot[shot>=thresRms*rms]=1
-                thresDat += shot
+            thresDat = imgSum
 
         if thresADU!=0:
             data+='thresADU%d_'%int(thresADU)
@@ -2453,6 +2688,8 @@ class SmallDataAna(object):
             data+='thresRms%d_'%int(thresRms)
         data+=detname.replace('/','_')
         self.__dict__[data]=thresDat
+        return {'sum': imgSum, 'sumSq': imgSumSq, 'max': imgMax, 'nHits': imgHits,
+                'mean': imgMean, 'std': imgStd, 'nEvents': nEvts}
         
     def getAvImage(self,detname=None, ROI=[]):
         avImages=[]
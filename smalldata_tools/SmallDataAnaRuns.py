@@ -0,0 +1,313 @@
+"""
+Lazy collection of several smallData runs.
+
+Only the file structure is scanned when the collection is created (in parallel
+over runs). Variables are read run by run when requested, selections are
+shared across all runs and binning/cubes are accumulated run by run so that
+only one run (or one block of events for area detectors) is in memory.
+"""
+from os import path
+import socket
+import numpy as np
+import h5py
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+
+from smalldata_tools.SmallDataAna import Selection, getTTstr, laserOffIgnoreVars
+from smalldata_tools.utilities import getBins as util_getBins
+from smalldata_tools.utilities import getDelay as util_getDelay
+
+def _scanRunFile(fname):
+    """ return number of events and shape/dtype of all datasets in a smallData file """
+    fields = {}
+    def _addField(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            fields[name] = [obj.shape, obj.dtype.str]
+    try:
+        with h5py.File(fname, 'r') as fh5:
+            fh5.visititems(_addField)
+    except:
+        print('could not scan file: ', fname)
+        return {'fname': fname, 'nEvts': 0, 'fields': {}, 'timeKey': None}
+    timeKey = None
+    for tKey in ['event_time', 'timestamp', 'EvtID/time']:
+        if tKey in fields:
+            timeKey = tKey
+            break
+    nEvts = fields[timeKey][0][0] if timeKey is not None else 0
+    return {'fname': fname, 'nEvts': nEvts, 'fields': fields, 'timeKey': timeKey}
+
+class SmallDataAnaRuns(object):
+    """
+    class to deal with data of several runs in smallData hdf5 files.
+    events of all runs are concatenated along one event axis, the 'run'
+    coordinate identifies the run of each event.
+    """
+    def __init__(self, expname='', runs=[], dirname='', nWorkers=8):
+        self.expname = expname
+        self.runs = [int(run) for run in runs]
+        self.hutch = self.expname[:3]
+        if dirname=='':
+            hostname = socket.gethostname()
+            if hostname.find('drp-srcf')>=0:
+                self.dirname = '/cds/data/drpsrcf/%s/%s/scratch/hdf5/smalldata'%(self.hutch,self.expname)
+            else:
+                self.dirname = '/reg/d/psdm/%s/%s/hdf5/smalldata'%(self.hutch,self.expname)
+        else:
+            self.dirname = dirname
+        self.Sels = {}
+        self._cache = {}
+        self._filters = {}
+
+        fnames = []
+        for run in self.runs:
+            fname = '%s/%s_Run%03d.h5'%(self.dirname,self.expname,run)
+            if not path.isfile(fname):
+                fname = '%s/%s_Run%04d.h5'%(self.dirname,self.expname,run)
+            fnames.append(fname)
+
+        #scan the files in parallel, only metadata is read here.
+        nWorkers = min(nWorkers, len(fnames))
+        if nWorkers > 1:
+            with ProcessPoolExecutor(max_workers=nWorkers) as executor:
+                runInfos = list(executor.map(_scanRunFile, fnames))
+        else:
+            runInfos = [_scanRunFile(fname) for fname in fnames]
+        self.runInfo = {}
+        for run, runInfo in zip(self.runs, runInfos):
+            if runInfo['nEvts']==0:
+                print('run %d has no events or could not be read, will skip it'%run)
+                continue
+            self.runInfo[run] = runInfo
+        self.runs = [run for run in self.runs if run in self.runInfo]
+        print('collected %d runs with %d events in total'%(len(self.runs), self.nEvts()))
+        self.ttCorr, self.ttBaseStr = getTTstr(self.Keys())
+
+    def nEvts(self, run=None):
+        if run is not None:
+            return self.runInfo[run]['nEvts']
+        return int(np.sum([self.runInfo[run]['nEvts'] for run in self.runs]))
+
+    def Keys(self, name=None, printKeys=False, allRuns=True):
+        """
+        return event based keys present in all (allRuns=True) or any run
+        """
+        keySets = []
+        for run in self.runs:
+            runKeys = [key for key, keyInfo in self.runInfo[run]['fields'].items()
+                       if len(keyInfo[0])>0 and keyInfo[0][0]==self.nEvts(run)]
+            keySets.append(set(runKeys))
+        if len(keySets)==0:
+            return []
+        if allRuns:
+            keys = set.intersection(*keySets)
+        else:
+            keys = set.union(*keySets)
+        keys = sorted([key for key in keys if name is None or key.find(name)>=0])
+        if printKeys:
+            for key in keys:
+                print(key)
+        return keys
+
+    def hasKey(self, inkey):
+        inkey = inkey.lstrip('/')
+        return np.all([inkey in self.runInfo[run]['fields'] for run in self.runs])
+
+    def getRunCoord(self):
+        """ run number for each event of the concatenated event axis """
+        return np.concatenate([np.ones(self.nEvts(run), dtype=int)*run for run in self.runs])
+
+    def _readRunVar(self, run, varName, evtIdx=None):
+        """ read a variable for a single run, 1-d variables are kept in memory """
+        varName = varName.lstrip('/')
+        if (run, varName) in self._cache:
+            vals = self._cache[(run, varName)]
+            return vals if evtIdx is None else vals[evtIdx]
+        if varName == 'delay':
+            import tables
+            with tables.open_file(self.runInfo[run]['fname'],'r') as fh5:
+                vals = np.asarray(util_getDelay(fh5))
+            self._cache[(run, varName)] = vals
+            return vals if evtIdx is None else vals[evtIdx]
+        if varName not in self.runInfo[run]['fields']:
+            print('variable %s not present in run %d'%(varName, run))
+            return None
+        with h5py.File(self.runInfo[run]['fname'], 'r') as fh5:
+            dset = fh5[varName]
+            if len(dset.shape)==1 or np.prod(dset.shape[1:])==1:
+                vals = dset[()].reshape(dset.shape[0])
+                self._cache[(run, varName)] = vals
+                return vals if evtIdx is None else vals[evtIdx]
+            if evtIdx is None:
+                return dset[()]
+            if evtIdx.dtype == bool:
+                evtIdx = np.argwhere(evtIdx).flatten()
+            if evtIdx.shape[0]==0:
+                return np.zeros((0,)+dset.shape[1:], dtype=dset.dtype)
+            #read contiguous range if events are dense, only the selected events otherwise
+            first, last = evtIdx.min(), evtIdx.max()
+            if (last-first+1) <= 4*evtIdx.shape[0]:
+                return dset[first:last+1][evtIdx-first]
+            uniqIdx, inverse = np.unique(evtIdx, return_inverse=True)
+            return dset[uniqIdx][inverse]
+
+    def _runDataBlocks(self, run, varName, evtIdx, chunkSize=500):
+        """ generator returning the data of varName in blocks of chunkSize selected events """
+        for iBlock in range(0, evtIdx.shape[0], chunkSize):
+            blockIdx = evtIdx[iBlock:iBlock+chunkSize]
+            yield blockIdx, self._readRunVar(run, varName, blockIdx)
+
+    def getVar(self, plotvar, useFilter=None):
+        """ concatenated variable for all runs, filtered with selection useFilter if passed """
+        vals = []
+        for run in self.runs:
+            Filter = None if useFilter is None else self.getFilter(useFilter, run=run)
+            runVals = self._readRunVar(run, plotvar, Filter)
+            if runVals is None:
+                return None
+            vals.append(runVals)
+        return np.concatenate(vals)
+
+    def getXrVar(self, plotvar, useFilter=None):
+        """ concatenated 1-d variable as xarray with 'run' coordinate """
+        vals = self.getVar(plotvar, useFilter=useFilter)
+        if vals is None:
+            return None
+        runCoord = self.getRunCoord()
+        if useFilter is not None:
+            runCoord = runCoord[self.getFilter(useFilter)]
+        return xr.DataArray(vals, coords={'run': ('event', runCoord)}, dims=('event'),
+                            name=plotvar.replace('/','__'))
+
+    def addCut(self, varName, varmin=0, varmax=0, useFilter=None):
+        """
+        add a variable to the selection shared by all runs
+        parameters: varName, varmin, varmax, useFilter (name of selection, required)
+        """
+        if useFilter is None:
+            print('you need to pass the name for the filter/selection you want to use')
+            return
+        if not self.hasKey(varName):
+            print('available keys are: ',self.Keys())
+            print('signal variable %s not in all runs'%(varName))
+            return
+        if useFilter not in self.Sels:
+            self.Sels[useFilter] = Selection()
+        self.Sels[useFilter].addCut(varName, varmin, varmax)
+        self._filters = {key: filt for key, filt in self._filters.items() if key[0].split('__')[0]!=useFilter}
+
+    def removeCut(self, varName, useFilter):
+        if useFilter not in self.Sels:
+            print('Selection with name %s does not exist, cannot remove cut'%useFilter)
+            return
+        self.Sels[useFilter].removeCut(varName)
+        self._filters = {key: filt for key, filt in self._filters.items() if key[0].split('__')[0]!=useFilter}
+
+    def printCuts(self, selName):
+        self.Sels[selName].printCuts()
+
+    def _getRunFilter(self, useFilter, run):
+        useFilterBase = useFilter.split('__')[0]
+        total_filter = np.ones(self.nEvts(run), dtype=bool)
+        if useFilterBase not in self.Sels:
+            return total_filter
+        #laser off: drop the laser & timetool requirements as SmallDataAna.getFilter
+        ignoreVar = []
+        if len(useFilter.split('__'))>1 and useFilter.split('__')[1].lower() == 'off':
+            ignoreVar = laserOffIgnoreVars(self.Keys(), self.ttCorr, self.ttBaseStr)
+        for thiscut in self.Sels[useFilterBase].cuts:
+            if thiscut[0] in ignoreVar:
+                continue
+            thisPlotvar = self._readRunVar(run, thiscut[0])
+            total_filter &= ~np.isnan(thisPlotvar)
+            if len(thiscut)==3:
+                total_filter &= (thisPlotvar > thiscut[1]) & (thisPlotvar < thiscut[2])
+            else:
+                total_filter &= (thisPlotvar != thiscut[1])
+        if len(useFilter.split('__'))>1:
+            if useFilter.split('__')[1].lower() == 'on':
+                total_filter &= (self._readRunVar(run, 'lightStatus/laser')==1)
+            elif useFilter.split('__')[1].lower() == 'off':
+                total_filter &= (self._readRunVar(run, 'lightStatus/laser')==0)
+        return total_filter
+
+    def getFilter(self, useFilter=None, run=None):
+        """ boolean array for selection useFilter for a single run or all runs concatenated """
+        if run is None:
+            return np.concatenate([self.getFilter(useFilter, run=thisRun) for thisRun in self.runs])
+        if useFilter is None:
+            return np.ones(self.nEvts(run), dtype=bool)
+        if (useFilter, run) not in self._filters:
+            self._filters[(useFilter, run)] = self._getRunFilter(useFilter, run)
+        return self._filters[(useFilter, run)]
+
+    def makeCubeData(self, binVar, bins, targetVars=[], useFilter=None, chunkSize=500, runKey=False):
+        """
+        bin the data of all runs in bins of binVar. Data is accumulated run by run
+        (in blocks of chunkSize events for multidimensional data).
+        parameters: binVar, bins, targetVars=[], useFilter=None, chunkSize=500, runKey=False
+                    bins: bin boundaries or definition as for SmallDataAna.getBins
+                    runKey: also return the number of entries per bin for each run
+        returns xarray Dataset with sum & std_ of each target variable and nEntries
+        """
+        Bins = util_getBins(bins)
+        if Bins is None:
+            print('could not define bins from: ',bins)
+            return None
+        Bins = np.asarray(Bins, dtype=float)
+        nBins = Bins.shape[0]-1
+        nEntries = np.zeros(nBins)
+        runEntries = np.zeros((len(self.runs), nBins))
+        sums = {}
+        sumSqs = {}
+        for irun, run in enumerate(self.runs):
+            binVals = self._readRunVar(run, binVar)
+            if binVals is None:
+                print('bin variable %s not in run %d, cannot make cube'%(binVar, run))
+                return None
+            Filter = self.getFilter(useFilter, run=run)
+            binIdx = np.digitize(binVals, Bins)-1
+            inBins = Filter & (binIdx>=0) & (binIdx<nBins)
+            evtIdx = np.argwhere(inBins).flatten()
+            binIdx = binIdx[evtIdx]
+            runEntries[irun] = np.bincount(binIdx, minlength=nBins)
+            nEntries += runEntries[irun]
+            if evtIdx.shape[0]==0:
+                continue
+            for tVar in targetVars:
+                for iBlock, (blockIdx, data) in enumerate(self._runDataBlocks(run, tVar, evtIdx, chunkSize=chunkSize)):
+                    data = data.astype(float)
+                    blockBins = binIdx[iBlock*chunkSize:iBlock*chunkSize+blockIdx.shape[0]]
+                    if tVar not in sums:
+                        sums[tVar] = np.zeros((nBins,)+data.shape[1:])
+                        sumSqs[tVar] = np.zeros((nBins,)+data.shape[1:])
+                    np.add.at(sums[tVar], blockBins, data)
+                    np.add.at(sumSqs[tVar], blockBins, data*data)
+
+        binCoord = 'binVar_bins'
+        cubeData = xr.Dataset({'nEntries': xr.DataArray(nEntries, coords={binCoord: Bins[:-1]}, dims=(binCoord))})
+        if runKey:
+            cubeData['nEntries_run'] = xr.DataArray(runEntries.T, coords={binCoord: Bins[:-1], 'run': self.runs}, dims=(binCoord, 'run'))
+        for tVar in sums:
+            dims = [binCoord]
+            coords = {binCoord: Bins[:-1]}
+            tName = tVar.replace('/','__')
+            for dim in range(len(sums[tVar].shape)-1):
+                dimStr = '%s_dim%d'%(tName,dim)
+                coords[dimStr] = np.arange(sums[tVar].shape[dim+1])
+                dims.append(dimStr)
+            nEnt = nEntries.reshape((nBins,)+(1,)*(len(sums[tVar].shape)-1))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = sums[tVar]/nEnt
+                std = np.sqrt(np.clip(sumSqs[tVar]/nEnt-mean*mean, 0, None))
+            cubeData[tName] = xr.DataArray(sums[tVar], coords=coords, dims=dims)
+            cubeData['std_%s'%tName] = xr.DataArray(std, coords=coords, dims=dims)
+        return cubeData
+
+    def binVar(self, binVar, bins, plotvar, useFilter=None):
+        """ average of plotvar in bins of binVar, accumulated run by run """
+        cubeData = self.makeCubeData(binVar, bins, targetVars=[plotvar], useFilter=useFilter)
+        if cubeData is None:
+            return None
+        tName = plotvar.replace('/','__')
+        return cubeData[tName]/cubeData['nEntries']
@@ -39,6 +39,7 @@ from smalldata_tools.SmallDataUtils import getUserData
 from smalldata_tools.utilities import printR
 from smalldata_tools.utilities import addToHdf5
 from smalldata_tools.utilities import rename_reduceRandomVar
+from smalldata_tools.cube.cube_postproc import makeDetFuncs, postProcessCube
 from smalldata_tools.utilities_plotting import plotImageBokeh
 from smalldata_tools.utilities_plotting import hv_image
 from smalldata_tools.utilities_plotting import hv_image_ctl
@@ -1139,7 +1140,7 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
             imCS = plt.subplot(gsCM[icm*2+1]).imshow(imgs[icm*2+1],clim=limsStd,interpolation='none',aspect='auto')
             plt.colorbar(imCS)
 
-    def makeCubeData(self, cubeName, dirname='', nEvtsPerBin=-1, offEventsCube=-1, storeMeanStd=False, onoff=2):
+    def makeCubeData(self, cubeName, dirname='', nEvtsPerBin=-1, offEventsCube=-1, storeMeanStd=False, onoff=2, splitEvents='auto', resume=True, batchPost=False):
         if self.sda is None:
             return
         if dirname=='':
@@ -1204,7 +1205,13 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
         for icut,cut in enumerate(sel.cuts):
             selString+=('Cut %i: %f < %s < %f\n'%(icut, cut[1], cut[0],cut[2]))
             
-        fout = h5py.File(outFileName, "w")
+        #continue the cube of an earlier job (bins that are done are skipped)
+        resume = resume and os.path.isfile(outFileName)
+        if resume:
+            printR(rank, 'Resume the cube in %s'%outFileName)
+        fout = h5py.File(outFileName, "a" if resume else "w")
+        if 'cubeSelection' in fout:
+            del fout['cubeSelection']
         dsetcnf = fout.create_dataset('cubeSelection', [1.], dtype='f')
         dsetcnf.attrs['cubeSelection'] = selString
 
@@ -1218,6 +1225,8 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
         
         # add small data to hdf5
         for key in cubeData.variables:
+            if key in fout:
+                del fout[key]
             addToHdf5(fout, key, cubeData[key].values)
 
         # Cube big data
@@ -1233,6 +1242,7 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
         #print('****** BINS: {}'.format(bin))
         print('****** Make big data placeholder dataset and save det config.')
         dets = []
+        newDsets = False
         for detname, detDict in zip(self.detNames, myCube.targetVarsXtc):
             det = self.__dict__[detname]
             if detDict['image']==1:
@@ -1240,7 +1250,7 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
             else:
                 det_shape = det.mask.shape
             try:
-                self.make_det_data_dset(fout, detname, det_shape, nbins)
+                newDsets = self.make_det_data_dset(fout, detname, det_shape, nbins) or newDsets
             except Exception as e:
                 logger.warning('Could not make dataset for detector {}. Exit. {}'.format(detname, e))
                 comm.Abort()
@@ -1248,6 +1258,8 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
             # save detector config
             logger.info(f'Save config for det {detname}.')
             if det.rms is not None:
+                if f'{detname}_cfg' in fout:
+                    del fout[f'{detname}_cfg']
                 grp = fout.create_group(f'{detname}_cfg')
                 if detDict['image']==0:
                     addToHdf5(grp, 'ped', det.ped)
@@ -1283,8 +1295,15 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
         print('Start binning area detectors')                
         # save_fct = lambda data=None, bin_idx=None: self.save_bin_to_h5(fout=fout, data=data, bin_idx=bin_idx)
         # sum_data = mpi_fun.bin_distribution(bins_info, func=save_fct)
-        bin_distrib = mpi_fun.Bin_distribution(bins_info, fout)
+        bin_distrib = mpi_fun.Bin_distribution(bins_info, fout, split_events=splitEvents, resume=resume, batch_post=batchPost,
+                                               config=myCube.targetVarsXtc, reset=newDsets)
         bin_distrib.distribute()
+        if batchPost:
+            #funcs are set up once & run on the stack of bin images
+            detFuncs = {}
+            for detname, detDict in zip(self.detNames, myCube.targetVarsXtc):
+                detFuncs[detname] = makeDetFuncs(self.__dict__[detname], detDict)
+            postProcessCube(fout, detFuncs)
         t3 = time.time()
 
         print("***** ALL BINS DONE AFTER {:0.2f} min. *****".format((t3-t0)/60))
@@ -1329,15 +1348,20 @@ class SmallDataAna_psana(BaseSmallDataAna_psana):
         
     @staticmethod
     def make_det_data_dset(fout, detname, det_shape, nbins):
-        """ Is that really necessary? Yes, because of empty bins! """
-        # data dset
-        dset_name = '{}_data'.format(detname)
-        shape = tuple(np.r_[nbins,det_shape])
-        dset = fout.create_dataset(dset_name, shape, dtype=float)
-        # n_in_bin dset
-        dset_name = '{}_nEntries'.format(detname)
-        dset = fout.create_dataset(dset_name, (nbins,), dtype=float)
-        return
+        """ Is that really necessary? Yes, because of empty bins! 
+        Datasets of a resumed cube are kept if they have the right shape.
+        Returns True if a dataset was (re)created: the bins done before are not in it.
+        """
+        created = False
+        for dset_name, shape in [('{}_data'.format(detname), tuple(np.r_[nbins,det_shape])),
+                                 ('{}_nEntries'.format(detname), (nbins,))]:
+            if dset_name in fout and fout[dset_name].shape==shape:
+                continue
+            if dset_name in fout:
+                del fout[dset_name]
+            dset = fout.create_dataset(dset_name, shape, dtype=float)
+            created = True
+        return created
     
     @staticmethod
     def print_me(data=None, bin_idx=None):
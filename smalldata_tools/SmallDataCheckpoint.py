@@ -0,0 +1,316 @@
+"""
+Checkpoint & resume for the psana1 smalldata producer.
+
+Each (re)start of a job is a segment writing its own part file
+(<name>_partNN.h5, written at every gather). At checkpoints, which happen
+inside a gather (when all ranks are in step), every rank stores its storeSum
+accumulators and rank 0 records the processed-event horizon of each rank:
+the global index of the last event written. psana1 hands out events round-robin,
+so rank r of a job with n ranks processes the events with index%n==r.
+
+A restarted job skips all events done by earlier segments, adds their sums to
+its own and at the end merges the part files into the final file.
+
+The sums are taken when the checkpoint happens, so all processed events need to
+be written by then: checkpoints can not be used with the pipelined event loop.
+
+usage:
+    checkpoint = ProducerCheckpoint(h5_f_name)
+    small_data = ds.small_data(checkpoint.partName, gather_interval=.., save_on_gather=True)
+    checkpoint.attach(small_data)
+    checkpoint.sumsFunc = lambda: {...}
+    for evt_num, evt in enumerate(ds.events()):
+        if checkpoint.isDone(evt_num): continue
+        ...
+        userDict['evt_idx'] = checkpoint.globalIdx(evt_num)
+        small_data.event(userDict)
+    ...
+    small_data.save()
+    checkpoint.finish()
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+import h5py
+from smalldata_tools.SmallDataPreselection import fillValue
+
+logger = logging.getLogger(__name__)
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+#groups of the small data file that are not per-event data
+summaryGroups = ['UserDataCfg', 'Sums', 'Preselection', 'GatherControl']
+
+def _writeJson(fname, obj):
+    tmpName = fname+'.tmp'
+    with open(tmpName, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmpName, fname)
+
+def _doneBy(segment, idx):
+    """ boolean array: were the events (global indices) processed by this segment """
+    horizons = np.array(segment['horizons'])
+    return idx <= horizons[idx%segment['size']]
+
+class ProducerCheckpoint(object):
+    """
+    collective: read the checkpoint state of earlier segments & start a new one
+    parameters: h5name: final small data file
+                interval: minimum time between checkpoints in seconds
+                comm: communicator of the job (def: COMM_WORLD)
+    """
+    def __init__(self, h5name, interval=300., comm=None):
+        self.h5name = h5name
+        self.interval = interval
+        if comm is None and MPI is not None:
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.rank = comm.Get_rank() if comm is not None else 0
+        self.size = comm.Get_size() if comm is not None else 1
+        self.ckptDir = os.path.join(os.path.dirname(os.path.abspath(h5name)),
+                                    '.%s_checkpoint'%os.path.basename(h5name).replace('.h5',''))
+        self.stateFile = os.path.join(self.ckptDir, 'state.json')
+        self.sumsFunc = None
+        self.horizon = -1
+        self.nCheckpoint = 0
+        self._lastCheckpoint = time.time()
+        state = None
+        if self.rank==0:
+            os.makedirs(self.ckptDir, exist_ok=True)
+            state = {'h5name': h5name, 'segments': []}
+            if os.path.isfile(self.stateFile):
+                with open(self.stateFile) as f:
+                    state = json.load(f)
+                for iSeg, segment in enumerate(state['segments']):
+                    if segment['valid'] and not self._validate(state['segments'][:iSeg], segment):
+                        print('Part file %s does not have the checkpointed events, they will be reprocessed'%segment['part'])
+                        segment['valid'] = False
+            iSeg = len(state['segments'])
+            state['segments'].append({'part': '%s_part%02d.h5'%(h5name.replace('.h5',''), iSeg),
+                                      'size': self.size, 'horizons': [-1]*self.size,
+                                      'checkpoint': 0, 'valid': True, 'complete': False})
+            _writeJson(self.stateFile, state)
+        if comm is not None:
+            state = comm.bcast(state, root=0)
+        self.state = state
+        self.segment = len(state['segments'])-1
+        self.partName = state['segments'][-1]['part']
+        self._previous = [seg for seg in state['segments'][:-1] if seg['valid'] and seg['checkpoint']>0]
+        if len(self._previous)>0 and self.rank==0:
+            print('Resuming from %d earlier segments'%len(self._previous))
+
+    def _validate(self, earlier, segment):
+        """ does the part file of a segment contain all events it has checkpointed """
+        if segment['checkpoint']==0:
+            return False
+        try:
+            with h5py.File(segment['part'], 'r') as f:
+                evtIdx = f['evt_idx'][:]
+        except Exception as e:
+            logger.warning('Could not read {0}: {1}'.format(segment['part'], e))
+            return False
+        idx = np.arange(max(segment['horizons'])+1)
+        expected = _doneBy(segment, idx)
+        for seg in earlier:
+            if seg['valid']:
+                expected &= ~_doneBy(seg, idx)
+        return np.isin(idx[expected], evtIdx).all()
+
+    def globalIdx(self, evt_num):
+        """ index of the event in the run for the evt_num-th event of this rank """
+        return evt_num*self.size+self.rank
+
+    def isDone(self, evt_num):
+        """ was this event (evt_num-th event of this rank) processed by an earlier segment """
+        idx = np.array([self.globalIdx(evt_num)])
+        for segment in self._previous:
+            if _doneBy(segment, idx)[0]:
+                return True
+        return False
+
+    def attach(self, small_data):
+        """ track the written events & checkpoint after gathers """
+        origEvent = small_data.event
+        def event(*args, **kwargs):
+            ret = origEvent(*args, **kwargs)
+            for arg in args:
+                if isinstance(arg, dict) and 'evt_idx' in arg:
+                    self.horizon = max(self.horizon, arg['evt_idx'])
+            return ret
+        small_data.event = event
+        if hasattr(small_data, '_gather'):
+            origGather = small_data._gather
+            def gather(*args, **kwargs):
+                ret = origGather(*args, **kwargs)
+                doCheckpoint = (time.time()-self._lastCheckpoint)>self.interval
+                if self.comm is not None:
+                    doCheckpoint = self.comm.bcast(doCheckpoint, root=0)
+                if doCheckpoint:
+                    self.checkpoint()
+                return ret
+            small_data._gather = gather
+        else:
+            print('small_data of type %s has no gather, will only checkpoint at the end'%type(small_data).__name__)
+
+    def _sumsName(self, segment, rank, nCheckpoint):
+        return os.path.join(self.ckptDir, 'sums_s%02d_r%03d_c%05d.npz'%(segment, rank, nCheckpoint))
+
+    def checkpoint(self, complete=False):
+        """ collective: store the sums of all ranks, then the horizons (after the data has been written) """
+        self.nCheckpoint += 1
+        sums = self.sumsFunc() if self.sumsFunc is not None else {}
+        sums = {k: np.asarray(v) for k,v in sums.items() if v is not None}
+        sumsName = self._sumsName(self.segment, self.rank, self.nCheckpoint)
+        with open(sumsName+'.tmp', 'wb') as f:
+            np.savez(f, **sums)
+        os.replace(sumsName+'.tmp', sumsName)
+        horizons = [self.horizon]
+        if self.comm is not None:
+            horizons = self.comm.allgather(self.horizon)
+        if self.rank==0:
+            segment = self.state['segments'][self.segment]
+            segment['horizons'] = [int(h) for h in horizons]
+            segment['checkpoint'] = self.nCheckpoint
+            segment['complete'] = complete
+            _writeJson(self.stateFile, self.state)
+            logger.info('Checkpoint {0}: {1} events done'.format(self.nCheckpoint, sum([h//self.size+1 for h in horizons if h>=0])))
+        if self.comm is not None:
+            self.comm.Barrier()
+        #the previous sums are not needed anymore
+        if self.nCheckpoint>1:
+            try:
+                os.remove(self._sumsName(self.segment, self.rank, self.nCheckpoint-1))
+            except OSError:
+                pass
+        self._lastCheckpoint = time.time()
+
+    def previousSums(self):
+        """ sums of the earlier segments (on rank 0, empty on other ranks) """
+        total = {}
+        if self.rank!=0:
+            return total
+        for segment in self._previous:
+            iSeg = self.state['segments'].index(segment)
+            for rank in range(segment['size']):
+                try:
+                    sums = np.load(self._sumsName(iSeg, rank, segment['checkpoint']))
+                except OSError as e:
+                    logger.warning('Missing sums of segment {0}, rank {1}: {2}'.format(iSeg, rank, e))
+                    continue
+                for key in sums.files:
+                    total[key] = total[key]+sums[key] if key in total else sums[key]
+        return total
+
+    def addPrevious(self, name, sumData):
+        """ add the sum of the earlier segments to the sum of this job (on rank 0) """
+        if self.rank!=0:
+            return sumData
+        if not hasattr(self, '_previousSums'):
+            self._previousSums = self.previousSums()
+        if name not in self._previousSums:
+            return sumData
+        if sumData is None:
+            return self._previousSums[name]
+        return sumData+self._previousSums[name]
+
+    def finish(self, merge=True, keepParts=False):
+        """ collective: last checkpoint & merge the part files into the final file on rank 0 """
+        self.checkpoint(complete=True)
+        if not merge or self.rank!=0:
+            return
+        segments = [seg for seg in self.state['segments'] if seg['valid'] and seg['checkpoint']>0]
+        mergeParts(segments, self.h5name)
+        if not keepParts:
+            for segment in self.state['segments']:
+                if os.path.isfile(segment['part']):
+                    os.remove(segment['part'])
+            shutil.rmtree(self.ckptDir, ignore_errors=True)
+
+def _perEventDatasets(f, nEvents):
+    """ names of the datasets of a part file with one entry per event """
+    names = []
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and name.split('/')[0] not in summaryGroups:
+            if len(obj.shape)>0 and obj.shape[0]==nEvents:
+                names.append(name)
+    f.visititems(visit)
+    return names
+
+def _readRows(dset, rows, blockRows):
+    """ dset[rows] for increasing rows, read in contiguous ranges of at most blockRows rows """
+    data = np.empty((rows.shape[0],)+dset.shape[1:], dtype=dset.dtype)
+    iRow = 0
+    while iRow<rows.shape[0]:
+        start = rows[iRow]
+        stop = min(start+blockRows, dset.shape[0])
+        nextRow = np.searchsorted(rows, stop, side='left')
+        data[iRow:nextRow] = dset[start:stop][rows[iRow:nextRow]-start]
+        iRow = nextRow
+    return data
+
+def mergeParts(segments, h5name, blockBytes=256*1024*1024):
+    """
+    merge the part files of the segments into h5name: events done by each segment
+    are concatenated (sorted by event_time), other data is taken from the last part.
+    Datasets are copied in blocks of at most blockBytes.
+    """
+    tstart = time.time()
+    parts = []
+    for iSeg, segment in enumerate(segments):
+        f = h5py.File(segment['part'], 'r')
+        evtIdx = f['evt_idx'][:]
+        keep = _doneBy(segment, evtIdx)
+        #events processed again after the last checkpoint of an earlier segment
+        for seg in segments[:iSeg]:
+            keep &= ~_doneBy(seg, evtIdx)
+        parts.append((f, np.nonzero(keep)[0], _perEventDatasets(f, evtIdx.shape[0])))
+    names = []
+    for f, rows, partNames in parts:
+        names += [name for name in partNames if name not in names]
+    timeName = 'event_time' if 'event_time' in names else 'evt_idx'
+    times = np.concatenate([f[timeName][:][rows] for f, rows, _ in parts])
+    order = np.argsort(times, kind='stable')
+    #part & row of each event of the merged file
+    srcPart = np.concatenate([np.full(rows.shape[0], iPart) for iPart, (_, rows, _) in enumerate(parts)])[order]
+    srcRow = np.concatenate([rows for _, rows, _ in parts])[order]
+    nEvents = order.shape[0]
+    with h5py.File(h5name+'.tmp', 'w') as fout:
+        for name in names:
+            template = [f[name] for f, _, partNames in parts if name in partNames][0]
+            dset = fout.create_dataset(name, shape=(nEvents,)+template.shape[1:], dtype=template.dtype)
+            rowBytes = max(1, int(np.prod(template.shape[1:]))*template.dtype.itemsize)
+            blockRows = max(1, blockBytes//rowBytes)
+            for start in range(0, nEvents, blockRows):
+                stop = min(start+blockRows, nEvents)
+                block = np.empty((stop-start,)+template.shape[1:], dtype=template.dtype)
+                for iPart, (f, _, partNames) in enumerate(parts):
+                    inPart = np.nonzero(srcPart[start:stop]==iPart)[0]
+                    if inPart.shape[0]==0:
+                        continue
+                    if name not in partNames:
+                        block[inPart] = fillValue(np.zeros(template.shape[1:], dtype=template.dtype))
+                        continue
+                    rows = srcRow[start:stop][inPart]
+                    rowOrder = np.argsort(rows, kind='stable')
+                    block[inPart[rowOrder]] = _readRows(f[name], rows[rowOrder], blockRows)
+                dset[start:stop] = block
+            for key, value in template.attrs.items():
+                dset.attrs[key] = value
+        #summary data & attributes from the last part
+        fLast = parts[-1][0]
+        def copySummary(name, obj):
+            if isinstance(obj, h5py.Dataset) and name not in names and name not in fout:
+                fLast.copy(obj, fout, name=name)
+        fLast.visititems(copySummary)
+        for key, value in fLast.attrs.items():
+            fout.attrs[key] = value
+    for f, _, _ in parts:
+        f.close()
+    os.replace(h5name+'.tmp', h5name)
+    print('Merged %d part files (%d events) into %s in %.1f s'%(len(parts), nEvents, h5name, time.time()-tstart))
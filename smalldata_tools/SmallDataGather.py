@@ -0,0 +1,193 @@
+"""
+Adaptive gather interval (psana1) / batch size (psana2) for the small_data output.
+
+A fixed interval is too large for detectors writing big ROIs or images for each
+event (the data of interval*nRanks events is held at once on the gathering rank)
+and too small for scalar only runs (many small gathers that cost more than the
+events). GatherController measures the bytes written per event, the time per
+event and the time spent in each gather/batch send and adjusts the interval to:
+    - keep the data held between gathers below maxMB
+    - keep the time between gathers below maxSeconds
+    - otherwise spend no more than a fraction (overhead) of the time in gathers
+The chosen intervals & measured timings are returned by history() to be saved.
+
+psana1 gathers are collective and triggered by the data source at the same event
+on all ranks: the new interval is agreed on (minimum over the ranks) inside the
+gather. psana2 batches are sent by each rank on its own.
+
+usage:
+    gather_ctl = GatherController(interval=args.gather_interval)
+    gather_ctl.attach(small_data, ds)
+    for evt in ds.events():
+        ...
+        small_data.event(userDict)
+        gather_ctl.nextEvent()
+"""
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+def dataBytes(data):
+    """ approximate size of the data passed to small_data.event """
+    if isinstance(data, dict):
+        return sum([dataBytes(v) for v in data.values()])
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, (list, tuple)):
+        try:
+            return np.asarray(data).nbytes
+        except (ValueError, TypeError):
+            return sum([dataBytes(v) for v in data])
+    if isinstance(data, (bool, int, float, np.number)):
+        return 8
+    #events & other objects are not written
+    return 0
+
+class GatherController(object):
+    """
+    parameters: interval: initial gather interval/batch size (events per rank)
+                minInterval, maxInterval: limits of the interval
+                maxMB: maximum data held between gathers (on the gathering rank for psana1)
+                maxSeconds: maximum time between gathers
+                overhead: fraction of the time that may be spent in gathers
+                maxStep: maximum factor by which the interval changes in one step
+    """
+    def __init__(self, interval=100, minInterval=5, maxInterval=10000, maxMB=512., maxSeconds=60.,
+                 overhead=0.05, maxStep=2., comm=None):
+        self.interval = int(interval)
+        self.minInterval = int(minInterval)
+        self.maxInterval = int(maxInterval)
+        self.maxMB = maxMB
+        self.maxSeconds = maxSeconds
+        self.overhead = overhead
+        self.maxStep = maxStep
+        if comm is None and MPI is not None:
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.mode = None
+        self.nRanks = 1
+        self._sd = None
+        self._ds = None
+        self.nEvents = 0
+        self._history = []
+        self._resetWindow()
+
+    def _resetWindow(self):
+        self._windowEvents = 0
+        self._windowBytes = 0
+        self._windowStart = time.time()
+        self._windowWrite = 0.
+
+    def params_as_dict(self):
+        """returns parameters as dictionary to be stored in the hdf5 file (once/file)"""
+        return {'initialInterval': self.interval, 'minInterval': self.minInterval,
+                'maxInterval': self.maxInterval, 'maxMB': self.maxMB,
+                'maxSeconds': self.maxSeconds, 'overhead': self.overhead}
+
+    def attach(self, small_data, ds=None):
+        """ wrap small_data.event (and the psana1 gather) to measure & set the interval """
+        self._sd = small_data
+        self._ds = ds
+        if ds is not None and hasattr(ds, 'global_gather_interval') and hasattr(small_data, '_gather'):
+            self.mode = 'gather'
+            self.nRanks = ds.size
+            ds.global_gather_interval = self.interval*ds.size
+            origGather = small_data._gather
+            def gather(*args, **kwargs):
+                t0 = time.time()
+                ret = origGather(*args, **kwargs)
+                self._adjust(time.time()-t0)
+                return ret
+            small_data._gather = gather
+        elif hasattr(small_data, 'batch_size'):
+            self.mode = 'batch'
+            small_data.batch_size = self.interval
+        else:
+            print('Gather interval of %s can not be changed, will only record the timing'%type(small_data).__name__)
+        origEvent = small_data.event
+        def event(*args, **kwargs):
+            t0 = time.time()
+            nBatch = len(getattr(small_data, '_batch', []))
+            ret = origEvent(*args, **kwargs)
+            dt = time.time()-t0
+            self._windowWrite += dt
+            self._windowBytes += sum([dataBytes(arg) for arg in args]) + dataBytes(kwargs)
+            if self.mode=='batch' and hasattr(small_data, '_batch') and len(small_data._batch)<nBatch:
+                self._adjust(dt)
+            return ret
+        small_data.event = event
+
+    def nextEvent(self):
+        """ call once per event after it has been passed to small_data """
+        self.nEvents += 1
+        self._windowEvents += 1
+        #psana2 without access to the batch: assume the batch was sent now
+        if self.mode=='batch' and not hasattr(self._sd, '_batch') and self._windowEvents>=self.interval:
+            self._adjust(None)
+        #nothing to adjust, but record the timing
+        elif self.mode is None and self._windowEvents>=self.interval:
+            self._adjust(None)
+
+    def _propose(self, bytesPerEvent, secondsPerEvent, gatherSeconds):
+        """ interval respecting the memory & latency bounds with the smallest gather overhead """
+        upper = self.maxInterval
+        if bytesPerEvent>0:
+            upper = min(upper, self.maxMB*1024**2/(bytesPerEvent*self.nRanks))
+        if secondsPerEvent>0:
+            upper = min(upper, self.maxSeconds/secondsPerEvent)
+        if gatherSeconds is not None and secondsPerEvent>0:
+            interval = gatherSeconds/(self.overhead*secondsPerEvent)
+        else:
+            interval = self.interval
+        #change slowly to follow the overhead, the bounds apply at once
+        interval = min(max(interval, self.interval/self.maxStep), self.interval*self.maxStep)
+        interval = min(interval, upper)
+        return int(max(self.minInterval, min(interval, self.maxInterval)))
+
+    def _adjust(self, gatherSeconds):
+        nEvt = self._windowEvents
+        elapsed = time.time()-self._windowStart
+        if gatherSeconds is not None:
+            elapsed -= gatherSeconds
+        bytesPerEvent = self._windowBytes/nEvt if nEvt>0 else 0.
+        secondsPerEvent = max(elapsed, 0.)/nEvt if nEvt>0 else 0.
+        newInterval = self.interval
+        if nEvt>0:
+            newInterval = self._propose(bytesPerEvent, secondsPerEvent, gatherSeconds)
+        if self.mode=='gather':
+            #all ranks are in the gather: agree on the interval
+            if self.comm is not None:
+                newInterval = self.comm.allreduce(newInterval, op=MPI.MIN)
+            self._ds.global_gather_interval = newInterval*self.nRanks
+        elif self.mode=='batch':
+            self._sd.batch_size = newInterval
+        self._history.append([self.nEvents, self.interval, nEvt, bytesPerEvent, secondsPerEvent,
+                              np.nan if gatherSeconds is None else gatherSeconds, self._windowWrite])
+        if newInterval!=self.interval:
+            logger.debug('Gather interval {0} -> {1} ({2:.0f} bytes/event, {3:.2g} s/event)'.format(self.interval, newInterval, bytesPerEvent, secondsPerEvent))
+        self.interval = newInterval
+        self._resetWindow()
+
+    def history(self, allRanks=True):
+        """
+        chosen intervals & timings as dictionary of arrays, one entry per gather.
+        allRanks: collect the history of all ranks (collective)
+        """
+        hist = [[self.comm.Get_rank() if self.comm is not None else 0]+h for h in self._history]
+        if allRanks and self.comm is not None:
+            hist = [h for rankHist in self.comm.allgather(hist) for h in rankHist]
+        hist = np.array(hist, dtype=float).reshape(-1, 8)
+        names = ['rank', 'nEvents', 'interval', 'windowEvents', 'bytesPerEvent', 'secondsPerEvent',
+                 'gatherSeconds', 'writeSeconds']
+        histDict = {name: hist[:,i] for i,name in enumerate(names)}
+        for name in ['rank', 'nEvents', 'interval', 'windowEvents']:
+            histDict[name] = histDict[name].astype(int)
+        histDict['finalInterval'] = np.array(self.interval)
+        return histDict
@@ -0,0 +1,188 @@
+"""
+Chunking & compression policy for the small data files.
+
+small_data writes its datasets with default chunking & no compression. An
+OutputPolicy rewrites (repacks) a finished file with chunk shapes chosen by the
+class of each dataset and fast lossless compression:
+    scalar:  one value per event -> long time-contiguous chunks (column reads)
+    trace:   1-d array per event (waveforms, projections, azav) -> chunks of many events
+    image:   >=2-d array per event (ROIs, images) -> one event per chunk
+    summary: everything else (UserDataCfg, Sums, ...) -> contiguous/compressed as is
+Calibrated ROIs can optionally be stored as photon counts (integers) instead of
+floats: values are divided by the ADU per photon & rounded, the ADU/photon is
+stored in the 'photonADU' attribute.
+
+compression (LZ4, Blosc & bitshuffle need hdf5plugin):
+    blosc:      Blosc/LZ4 with bitshuffle, also readable by pytables (SmallDataAna)
+    lz4:        LZ4 (hdf5plugin)
+    bitshuffle: bitshuffle + LZ4 (hdf5plugin)
+    gzip:       built into hdf5 (level 1 & byte shuffle), the fallback w/o hdf5plugin
+    none:       chunked only
+"""
+import os
+import time
+import fnmatch
+import logging
+import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hdf5plugin
+    #for pytables (SmallDataAna) if it is imported later
+    os.environ.setdefault('HDF5_PLUGIN_PATH', hdf5plugin.PLUGIN_PATH)
+except ImportError:
+    hdf5plugin = None
+
+compressions = ['blosc', 'lz4', 'bitshuffle', 'gzip', 'none']
+#groups of the small data file that are not per-event data
+summaryGroups = ['UserDataCfg', 'Sums', 'Preselection', 'GatherControl']
+
+class OutputPolicy(object):
+    """
+    parameters: compression: one of compressions (falls back to gzip w/o hdf5plugin)
+                scalarChunk: number of events per chunk for scalars
+                chunkBytes: target size of the chunks of traces
+                quantize: dictionary {dataset name pattern: ADU per photon} of datasets
+                          to be stored as photon counts (e.g. {'epix/ROI_0_area': 150.})
+                minBytes: datasets smaller than this are stored contiguous w/o compression
+    """
+    def __init__(self, compression='blosc', scalarChunk=65536, chunkBytes=1024*1024, quantize=None, minBytes=4096):
+        if compression is None:
+            compression = 'none'
+        if compression not in compressions:
+            print('compression %s is not known, use one of %s'%(compression, compressions))
+            compression = 'none'
+        if compression in ['blosc', 'lz4', 'bitshuffle'] and hdf5plugin is None:
+            print('hdf5plugin is not available for %s compression, will use gzip'%compression)
+            compression = 'gzip'
+        self.compression = compression
+        self.scalarChunk = scalarChunk
+        self.chunkBytes = chunkBytes
+        self.quantize = quantize if quantize is not None else {}
+        self.minBytes = minBytes
+
+    def params_as_dict(self):
+        """returns parameters as dictionary to be stored in the hdf5 file (once/file)"""
+        parList = {'compression': self.compression, 'scalarChunk': self.scalarChunk, 'chunkBytes': self.chunkBytes}
+        if len(self.quantize)>0:
+            parList['quantizeNames'] = np.array(list(self.quantize.keys())).astype(bytes)
+            parList['quantizeADU'] = np.array(list(self.quantize.values()), dtype=float)
+        return parList
+
+    def datasetClass(self, name, shape, nEvents):
+        if name.split('/')[0] in summaryGroups or len(shape)==0 or shape[0]!=nEvents:
+            return 'summary'
+        if len(shape)==1:
+            return 'scalar'
+        if len(shape)==2:
+            return 'trace'
+        return 'image'
+
+    def chunks(self, dsClass, shape, dtype):
+        itemsize = np.dtype(dtype).itemsize
+        if dsClass=='scalar':
+            return (max(1, min(shape[0], self.scalarChunk)),)
+        if dsClass=='trace':
+            nEvt = max(1, min(shape[0], self.chunkBytes//max(1, shape[1]*itemsize)))
+            return (nEvt, shape[1])
+        if dsClass=='image':
+            return (1,)+tuple(shape[1:])
+        return None
+
+    def filterArgs(self, dtype):
+        """ arguments for h5py create_dataset """
+        if self.compression=='none' or np.dtype(dtype).kind not in 'biuf':
+            return {}
+        if self.compression=='blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+        if self.compression=='lz4':
+            return dict(hdf5plugin.LZ4())
+        if self.compression=='bitshuffle':
+            return dict(hdf5plugin.Bitshuffle(cname='lz4'))
+        if self.compression=='gzip':
+            return {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+        return {}
+
+    def photonADU(self, name):
+        for pattern, adu in self.quantize.items():
+            if fnmatch.fnmatch(name, pattern):
+                return adu
+        return None
+
+    def createDataset(self, fout, name, shape, dtype, nEvents):
+        """ create an empty dataset following the policy, returns it & its class """
+        dsClass = self.datasetClass(name, shape, nEvents)
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        kwargs = {}
+        if dsClass!='summary' and nbytes>=self.minBytes and shape[0]>0:
+            kwargs = self.filterArgs(dtype)
+            kwargs['chunks'] = self.chunks(dsClass, shape, dtype)
+        return fout.create_dataset(name, shape=shape, dtype=dtype, **kwargs), dsClass
+
+def _quantize(data, adu, dtype):
+    data = np.rint(np.nan_to_num(np.asarray(data, dtype=float)/adu, nan=-1))
+    info = np.iinfo(dtype)
+    return np.clip(data, info.min, info.max).astype(dtype)
+
+def repack(fname, policy, outname=None, blockBytes=256*1024*1024):
+    """
+    rewrite a small data file following the policy (in place if outname is None).
+    Data is copied in blocks of events of at most blockBytes.
+    returns the sizes before & after.
+    """
+    tstart = time.time()
+    inPlace = outname is None
+    if inPlace:
+        outname = fname+'.repack'
+    with h5py.File(fname, 'r') as fin, h5py.File(outname, 'w') as fout:
+        nEvents = fin['event_time'].shape[0] if 'event_time' in fin else (fin['timestamp'].shape[0] if 'timestamp' in fin else -1)
+        for key, value in fin.attrs.items():
+            fout.attrs[key] = value
+        items = []
+        fin.visititems(lambda name, obj: items.append((name, obj)))
+        for name, obj in items:
+            if isinstance(obj, h5py.Group):
+                grp = fout.require_group(name)
+                for key, value in obj.attrs.items():
+                    grp.attrs[key] = value
+                continue
+            if not isinstance(obj, h5py.Dataset):
+                continue
+            dtype = obj.dtype
+            adu = policy.photonADU(name)
+            if adu is not None and dtype.kind=='f':
+                fmax = 0
+                if obj.shape!=() and obj.size>0:
+                    step = max(1, blockBytes//max(1, obj.size//obj.shape[0]*obj.dtype.itemsize))
+                    for start in range(0, obj.shape[0], step):
+                        fmax = max(fmax, np.nanmax(np.abs(obj[start:start+step])))
+                elif obj.shape==():
+                    fmax = abs(obj[()])
+                dtype = np.dtype(np.int16) if fmax/adu<np.iinfo(np.int16).max else np.dtype(np.int32)
+            elif adu is not None:
+                adu = None
+            ds, dsClass = policy.createDataset(fout, name, obj.shape, dtype, nEvents)
+            for key, value in obj.attrs.items():
+                ds.attrs[key] = value
+            if adu is not None:
+                ds.attrs['photonADU'] = adu
+            if obj.shape==() or obj.size==0:
+                if obj.shape==():
+                    ds[()] = obj[()] if adu is None else _quantize(obj[()], adu, dtype)
+                continue
+            rowBytes = max(1, obj.size//obj.shape[0]*obj.dtype.itemsize)
+            step = max(1, blockBytes//rowBytes)
+            #align the blocks with the chunks
+            if ds.chunks is not None:
+                step = max(ds.chunks[0], step//ds.chunks[0]*ds.chunks[0])
+            for start in range(0, obj.shape[0], step):
+                block = obj[start:start+step]
+                ds[start:start+step] = block if adu is None else _quantize(block, adu, dtype)
+    sizeBefore = os.path.getsize(fname)
+    sizeAfter = os.path.getsize(outname)
+    if inPlace:
+        os.replace(outname, fname)
+    print('Repacked %s (%s) in %.1f s: %.1f MB -> %.1f MB'%(fname, policy.compression, time.time()-tstart, sizeBefore/1024.**2, sizeAfter/1024.**2))
+    return sizeBefore, sizeAfter
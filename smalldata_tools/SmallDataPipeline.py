@@ -0,0 +1,240 @@
+"""
+Helpers to pipeline the event loop of the smalldata producers.
+
+EventPrefetcher reads the next events (and optionally runs a cheap
+preparation step like the default detectors) in a background thread while
+the main thread processes the area detectors. AsyncWriter hands the results
+to small_data in a second thread. Both stages use bounded queues and the
+writer is a single thread, so events are written in the order they were read.
+
+psana is not thread safe: the psana and MPI calls of the reading and writing
+stage and the detector data access of the producers (det.getData) are
+serialized with a common lock; the overlap comes from the detector functions
+(numpy) in the main thread and the DetectorPool threads.
+
+DetectorPool processes the area detectors of an event in parallel threads.
+With lockPsanaCalls, only the psana calls of getData hold the lock: the numpy
+part of the calibration (pedestal, gain, mask, common modes done in python)
+runs in parallel. Calibrations done by psana (det.calib) stay serialized.
+"""
+import os
+import sys
+import threading
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+def set_current_event(ds, evt):
+    """
+    the psana1 small_data object attaches the data to the current event of
+    the data source. As the prefetch thread is ahead, reset it before writing.
+    """
+    if hasattr(ds, '_currevt'):
+        ds._currevt = evt
+
+class EventPrefetcher(object):
+    """
+    iterate over events in a background thread, staying at most depth events ahead.
+    parameters: events: event iterator (e.g. ds.events())
+                depth: number of events to read ahead
+                lock: lock to hold while advancing the iterator
+                prepare: function called with each event in the prefetch thread,
+                         the result is returned together with the event
+    iterating returns (evt, prepared) tuples
+    """
+    def __init__(self, events, depth=4, lock=None, prepare=None):
+        self._events = iter(events)
+        self._queue = queue.Queue(maxsize=max(1,depth))
+        self._lock = lock if lock is not None else threading.Lock()
+        self._prepare = prepare
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='EventPrefetcher', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    try:
+                        evt = next(self._events)
+                    except StopIteration:
+                        break
+                    prepared = self._prepare(evt) if self._prepare is not None else None
+                if not self._put((evt, prepared)):
+                    return
+        except Exception as e:
+            logger.error('Event prefetch failed: {0}'.format(e))
+            self._put(e)
+            return
+        self._put(_STOP)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """ stop reading ahead, e.g. when leaving the event loop early """
+        self._stop.set()
+        #the reading thread might wait for new data (live mode), do not wait forever
+        self._thread.join(timeout=10)
+
+class AsyncWriter(object):
+    """
+    call write(*args) for each put(*args) in a single background thread, in order.
+    parameters: write: function writing the data of one event
+                depth: maximum number of events waiting to be written
+                lock: lock to hold while writing
+    """
+    def __init__(self, write, depth=16, lock=None):
+        self._write = write
+        self._queue = queue.Queue(maxsize=max(1,depth))
+        self._lock = lock if lock is not None else threading.Lock()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='AsyncWriter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if self._error is not None:
+                continue
+            try:
+                with self._lock:
+                    self._write(*item)
+            except Exception as e:
+                logger.error('Writing event failed: {0}'.format(e))
+                self._error = e
+
+    def put(self, *args):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(args)
+
+    def close(self):
+        """ write all remaining events and stop the writer thread """
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+def limitNumbaThreads(nThreads=1):
+    """
+    limit the threads of numba's parallel code. The limit only applies to the calling
+    thread: call it in each thread running numba code (e.g. as thread pool initializer).
+    """
+    if 'numba' not in sys.modules:
+        return
+    try:
+        sys.modules['numba'].set_num_threads(min(nThreads, sys.modules['numba'].config.NUMBA_NUM_THREADS))
+    except Exception as e:
+        logger.info('Could not limit the numba threads: {0}'.format(e))
+
+def limitInnerThreads(nThreads=1):
+    """
+    limit the threads used inside numpy/scipy (BLAS, OpenMP, FFT) & numba, e.g. when
+    the detectors of an event are processed in parallel by a DetectorPool.
+    The BLAS/OpenMP limits apply to the whole process: the libraries already loaded are
+    limited with threadpoolctl, the environment variables only apply to libraries
+    loaded later. The numba limit only applies to the calling thread.
+    """
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[var] = str(nThreads)
+    limitNumbaThreads(nThreads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        logger.warning('threadpoolctl is not available, libraries loaded already keep their number of threads')
+        return None
+    return threadpool_limits(limits=nThreads)
+
+def _isPsanaObject(obj):
+    """ objects to call holding the lock: not numbers, strings, arrays, lists,... """
+    return hasattr(obj, '__dict__') and not isinstance(obj, (type, LockedPsana)) and type(obj).__module__.split('.')[0]!='numpy'
+
+class LockedPsana(object):
+    """
+    wraps a psana object (detector, event, run): its methods are called holding lock,
+    psana objects they return or it holds are wrapped as well. Wrapped objects passed
+    as arguments are unwrapped.
+    """
+    def __init__(self, obj, lock):
+        self.__dict__['_obj'] = obj
+        self.__dict__['_lock'] = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        lock = self._lock
+        if not callable(attr):
+            return LockedPsana(attr, lock) if _isPsanaObject(attr) else attr
+        def lockedCall(*args, **kwargs):
+            args = [arg._obj if isinstance(arg, LockedPsana) else arg for arg in args]
+            kwargs = {key: (arg._obj if isinstance(arg, LockedPsana) else arg) for key, arg in kwargs.items()}
+            with lock:
+                value = attr(*args, **kwargs)
+            return LockedPsana(value, lock) if _isPsanaObject(value) else value
+        return lockedCall
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+def lockPsanaCalls(det, lock):
+    """
+    call the psana detector of a DetObject (and of DetObjects & psana objects it holds,
+    e.g. for the ghost correction) holding lock. Use with det.getData(LockedPsana(evt, lock)).
+    """
+    for name, value in list(det.__dict__.items()):
+        if name=='det' and value is not None and not isinstance(value, LockedPsana):
+            det.__dict__[name] = LockedPsana(value, lock)
+        elif hasattr(value, 'getData') and hasattr(value, 'det') and hasattr(value, '__dict__'):
+            lockPsanaCalls(value, lock)
+        elif type(value).__module__.split('.')[0] in ['psana', '_psana']:
+            det.__dict__[name] = LockedPsana(value, lock)
+
+class DetectorPool(object):
+    """
+    process the detectors of one event in a pool of threads. The numpy/scipy
+    work of getData/processFuncs releases the GIL for most of the time. The psana
+    calls of getData are serialized (lockPsanaCalls), calibrations done in psana
+    (e.g. det.calib for common_mode 30) do not run in parallel.
+    parameters: nThreads: number of threads
+                innerThreads: threads for BLAS/FFT/numba within each detector thread
+                              (None: do not change)
+    """
+    def __init__(self, nThreads=2, innerThreads=1):
+        self.nThreads = nThreads
+        self._limits = None
+        if innerThreads is not None:
+            self._limits = limitInnerThreads(innerThreads)
+            #the numba limit is per thread: set it in each thread of the pool
+            self._executor = ThreadPoolExecutor(max_workers=nThreads, thread_name_prefix='DetectorPool',
+                                                initializer=limitNumbaThreads, initargs=(innerThreads,))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=nThreads, thread_name_prefix='DetectorPool')
+
+    def map(self, func, dets, *args):
+        """ call func(det, *args) for all detectors, returns the results in order once all are done """
+        futures = [self._executor.submit(func, det, *args) for det in dets]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,163 @@
+"""
+Pre-selection of events in the producers.
+
+The cheap default detectors (lightStatus, ipm, gas detector, damage,...) are read
+first. Events failing the cuts defined on their data skip the expensive analysis
+functions (droplets, photons, azimuthal integration, autocorrelation,...). The
+results of the skipped functions are replaced by fill values (NaN for floats,
+-1 for integers, empty for ragged data) so all per-event datasets stay aligned.
+
+Cuts are given as [varName, low, high] like in SmallDataAna.addCut, the name is
+the path in the smalldata file, e.g. 'lightStatus/xray' or 'ipm2/sum'.
+"""
+import numpy as np
+import logging
+from smalldata_tools.DetObject import DetObjectFunc
+
+logger = logging.getLogger(__name__)
+
+#functions classes that are skipped by default on events failing the cuts
+expensiveFuncs = ['dropletFunc', 'droplet2Func', 'photonFunc', 'photon2', 'photon3',
+                  'azimuthalBinning', 'azav_pyfai', 'Autocorrelation']
+
+def fillValue(value, ragged=False):
+    """ value of the same type & shape as the passed value to be written for skipped events """
+    if isinstance(value, dict):
+        return { k: fillValue(v, ragged=(ragged or k.find('ragged')>=0)) for k,v in value.items() }
+    if isinstance(value, (list, tuple)):
+        value = np.array(value)
+    if isinstance(value, np.ndarray):
+        if ragged:
+            return np.zeros(0, dtype=value.dtype)
+        if np.issubdtype(value.dtype, np.floating) or np.issubdtype(value.dtype, np.complexfloating):
+            return np.full(value.shape, np.nan, dtype=value.dtype)
+        if np.issubdtype(value.dtype, np.signedinteger):
+            return np.full(value.shape, -1, dtype=value.dtype)
+        return np.zeros(value.shape, dtype=value.dtype)
+    if isinstance(value, (bool, np.bool_)):
+        return False
+    if isinstance(value, (int, np.integer)):
+        return -1
+    if isinstance(value, (float, np.floating)):
+        return np.nan
+    return value
+
+class EventPreselection(object):
+    """
+    parameters: cuts: list of [varName, low, high], events pass if low <= value <= high for all cuts
+                funcs: names of function classes or function names to skip on failing events
+    """
+    def __init__(self, cuts=None, funcs=None):
+        self.cuts = []
+        self.funcs = list(expensiveFuncs) if funcs is None else list(funcs)
+        self.nEvents = 0
+        self.nPassed = 0
+        self._templates = {}
+        self._missing = []
+        if cuts is not None:
+            for cut in cuts:
+                self.addCut(*cut)
+
+    def addCut(self, varName, varmin, varmax):
+        if varmin > varmax:
+            print('cut for %s has low > high (%s > %s), will swap them'%(varName, varmin, varmax))
+            varmin, varmax = varmax, varmin
+        self.cuts.append([varName, varmin, varmax])
+
+    def removeCut(self, varName):
+        self.cuts = [ cut for cut in self.cuts if cut[0]!=varName ]
+
+    def printCuts(self):
+        for cut in self.cuts:
+            print('%s: %s -- %s'%(cut[0], cut[1], cut[2]))
+
+    def params_as_dict(self):
+        """returns parameters as dictionary to be stored in the hdf5 file (once/file)"""
+        parList = {'funcs': np.array(self.funcs).astype(bytes)}
+        if len(self.cuts)>0:
+            parList['cutVars'] = np.array([cut[0] for cut in self.cuts]).astype(bytes)
+            parList['cutLimits'] = np.array([[cut[1], cut[2]] for cut in self.cuts], dtype=float)
+        return parList
+
+    def _getValue(self, det_data, varName):
+        """ value from nested dictionary, None if the detector is not in the data at all """
+        keys = varName.split('/')
+        if det_data is None or keys[0] not in det_data:
+            return None
+        value = det_data
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return np.nan
+            value = value[key]
+        return value
+
+    def passes(self, det_data):
+        """ evaluate the cuts on the data of the default detectors of this event """
+        self.nEvents += 1
+        passed = True
+        for varName, varmin, varmax in self.cuts:
+            value = self._getValue(det_data, varName)
+            if value is None:
+                #detector is not part of this run: ignore the cut
+                if varName not in self._missing:
+                    logger.warning('Pre-selection: {0} is not in the data, cut will be ignored'.format(varName))
+                    self._missing.append(varName)
+                continue
+            try:
+                value = float(np.asarray(value, dtype=float).squeeze())
+            except (TypeError, ValueError):
+                passed = False
+                continue
+            if not (value >= varmin and value <= varmax):
+                passed = False
+        if passed:
+            self.nPassed += 1
+        return passed
+
+    def _isSelected(self, func):
+        return type(func).__name__ in self.funcs or func._name in self.funcs
+
+    def processFuncs(self, det, passed=True):
+        """
+        det.processFuncs for events passing the cuts. For the others, the selected functions
+        are skipped & their results replaced by fill values. The first time a function is
+        seen, it is run to get the shape of the results.
+        """
+        if passed or len(self.cuts)==0:
+            det.processFuncs()
+            self._storeTemplates(det)
+            return
+        skipped = []
+        for key, func in list(det.__dict__.items()):
+            if not isinstance(func, DetObjectFunc) or not self._isSelected(func):
+                continue
+            if func._proc and (det._name, func._name) in self._templates:
+                func._proc = False
+                skipped.append(func)
+        try:
+            det.processFuncs()
+        finally:
+            for func in skipped:
+                func._proc = True
+        self._storeTemplates(det)
+        if det.evt.dat is None:
+            return
+        for func in skipped:
+            det.evt.__dict__['_write_%s'%func._name] = fillValue(self._templates[(det._name, func._name)],
+                                                                 ragged=(func._name.find('ragged')>=0))
+
+    def _storeTemplates(self, det):
+        if det.evt.dat is None:
+            return
+        for key, func in list(det.__dict__.items()):
+            if not isinstance(func, DetObjectFunc) or not self._isSelected(func):
+                continue
+            if (det._name, func._name) in self._templates or not func._proc:
+                continue
+            result = det.evt.__dict__.get('_write_%s'%func._name, None)
+            if result is not None:
+                self._templates[(det._name, func._name)] = result
+
+    def summary(self):
+        """ number of events & number of events passing the cuts (on this rank) """
+        return {'nEvents': self.nEvents, 'nPassed': self.nPassed}
@@ -0,0 +1,280 @@
+"""
+Columnar storage of ragged per-event data (sparsified images, droplets, photons).
+
+Instead of padding to a fixed length (nData) in the small data file, the ragged_*
+fields returned by the analysis functions (e.g. sparsifyFunc with nData=None) are
+written by RaggedWriter as one flat values array per field plus an offsets array:
+the values of event i are values[offsets[i]:offsets[i+1]]. Each rank writes its
+own file next to the small data file (<name>_ragged_r<rank>.h5) with the event
+times to match the events of the small data file.
+
+layout of a file:
+    /event_time                   (nEvents,)
+    /<det>/<field>/values         (nValues, ...)
+    /<det>/<field>/offsets        (nEvents+1,)
+
+RaggedStore reads the files of a run: columns return the data of one event in
+O(1) or read the values of selected events only.
+"""
+import logging
+from glob import glob
+import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
+
+raggedFormatVersion = 1
+
+def raggedFileName(h5name, rank, part=None):
+    """ name of the columnar file of a rank for a small data file (& part of a checkpointed job) """
+    if part is not None:
+        return '%s_ragged_r%03d_part%02d.h5'%(h5name.replace('.h5',''), rank, part)
+    return '%s_ragged_r%03d.h5'%(h5name.replace('.h5',''), rank)
+
+def raggedFiles(h5name):
+    """ all columnar files belonging to a small data file """
+    return sorted(glob('%s_ragged_r*.h5'%(h5name.replace('.h5',''))))
+
+def eventTime(evt):
+    """ event time as in the small data file: timestamp (LCLS-II) or sec<<32|nsec (LCLS-I) """
+    if hasattr(evt, 'timestamp'):
+        return int(evt.timestamp)
+    import psana
+    sec, nsec = evt.get(psana.EventId).time()
+    return (int(sec)<<32)|int(nsec)
+
+class RaggedWriter(object):
+    """
+    parameters: filename: file to write (created at the first flush)
+                flushEvents: number of events kept in memory before they are written
+                chunkValues: hdf5 chunk size (number of values) of the values datasets
+    """
+    def __init__(self, filename, flushEvents=100, chunkValues=65536):
+        self.filename = filename
+        self.flushEvents = flushEvents
+        self.chunkValues = chunkValues
+        self.nEvents = 0
+        self._f = None
+        self._times = []
+        self._values = {}
+        self._counts = {}
+        self._written = {}
+
+    def event(self, evtTime, userDict):
+        """
+        remove the ragged_* fields from the per-detector dictionaries of userDict
+        and buffer them. The remaining data is passed to small_data as usual.
+        """
+        self._times.append(evtTime)
+        iEvt = len(self._times)-1
+        for det, detDict in userDict.items():
+            if not isinstance(detDict, dict):
+                continue
+            for key in [k for k in detDict.keys() if k.startswith('ragged_')]:
+                value = np.asarray(detDict.pop(key))
+                if value.ndim==0:
+                    value = value.reshape(1)
+                field = (det, key.replace('ragged_','',1))
+                if field not in self._values:
+                    self._values[field] = []
+                    self._counts[field] = []
+                counts = self._counts[field]
+                #field not seen in the previous buffered events
+                counts += [0]*(iEvt-len(counts))
+                self._values[field].append(value)
+                counts.append(value.shape[0])
+        if len(self._times)>=self.flushEvents:
+            self.flush()
+        return userDict
+
+    def _open(self):
+        self._f = h5py.File(self.filename, 'w')
+        self._f.attrs['format'] = 'columnar_ragged'
+        self._f.attrs['version'] = raggedFormatVersion
+        self._f.create_dataset('event_time', shape=(0,), maxshape=(None,), dtype=np.uint64, chunks=(4096,))
+
+    def _append(self, ds, data):
+        n = ds.shape[0]
+        ds.resize(n+data.shape[0], axis=0)
+        ds[n:] = data
+
+    def _createField(self, det, field, value):
+        grp = self._f.require_group(det).create_group(field)
+        shape = value.shape[1:]
+        chunks = (max(1, self.chunkValues//max(1, int(np.prod(shape)))),)+shape
+        grp.create_dataset('values', shape=(0,)+shape, maxshape=(None,)+shape, dtype=value.dtype, chunks=chunks)
+        #events written before the field appeared have no values
+        grp.create_dataset('offsets', data=np.zeros(self.nEvents+1, dtype=np.int64), maxshape=(None,), chunks=(4096,))
+        return grp
+
+    def flush(self):
+        """ write the buffered events """
+        nNew = len(self._times)
+        if nNew==0:
+            return
+        if self._f is None:
+            self._open()
+        self._append(self._f['event_time'], np.array(self._times, dtype=np.uint64))
+        for field in list(self._values.keys()):
+            det, name = field
+            counts = self._counts[field]
+            counts += [0]*(nNew-len(counts))
+            values = [v for v in self._values[field] if v.shape[0]>0]
+            if field not in self._written:
+                if len(values)==0:
+                    continue
+                self._written[field] = self._createField(det, name, values[0])
+            grp = self._written[field]
+            offsets = grp['offsets']
+            newOffsets = offsets[-1]+np.cumsum(counts, dtype=np.int64)
+            if len(values)>0:
+                self._append(grp['values'], np.concatenate(values).astype(grp['values'].dtype, copy=False))
+            self._append(offsets, newOffsets)
+        #fields without values in these events
+        for field, grp in self._written.items():
+            if field in self._values:
+                continue
+            offsets = grp['offsets']
+            self._append(offsets, np.full(nNew, offsets[-1], dtype=np.int64))
+        self.nEvents += nNew
+        self._times = []
+        self._values = {}
+        self._counts = {}
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+class RaggedColumn(object):
+    """
+    one ragged field of a run, not read into memory.
+    column[i] returns the values of event i (index of the small data file, if its
+    event times were given to the store, else of the concatenated files).
+    """
+    def __init__(self, datasets, offsets, fileIdx, rowIdx):
+        self._datasets = datasets
+        self._offsets = offsets
+        self._fileIdx = fileIdx
+        self._rowIdx = rowIdx
+        found = [ds for ds in datasets if ds is not None]
+        self.shape = found[0].shape[1:] if len(found)>0 else ()
+        self.dtype = found[0].dtype if len(found)>0 else np.float64
+
+    def __len__(self):
+        return self._fileIdx.shape[0]
+
+    def __getitem__(self, ievt):
+        iFile, row = self._fileIdx[ievt], self._rowIdx[ievt]
+        if iFile<0 or self._datasets[iFile] is None:
+            return np.zeros((0,)+self.shape, dtype=self.dtype)
+        offsets = self._offsets[iFile]
+        return self._datasets[iFile][offsets[row]:offsets[row+1]]
+
+    def counts(self):
+        """ number of values for each event """
+        counts = np.zeros(len(self), dtype=np.int64)
+        for iFile, offsets in enumerate(self._offsets):
+            if offsets is None:
+                continue
+            sel = (self._fileIdx==iFile)
+            counts[sel] = np.diff(offsets)[self._rowIdx[sel]]
+        return counts
+
+    def read(self, Filter=None, blockValues=4*1024*1024):
+        """
+        read the values of the events selected by Filter (boolean or index array over
+        the events, def: all). Only the blocks of the files containing selected events
+        are read. returns values & the event index of each value
+        """
+        evtIdx = np.arange(len(self))
+        if Filter is not None:
+            evtIdx = evtIdx[Filter]
+        values = []
+        valueEvts = []
+        for iFile, ds in enumerate(self._datasets):
+            if ds is None:
+                continue
+            sel = evtIdx[self._fileIdx[evtIdx]==iFile]
+            if sel.shape[0]==0:
+                continue
+            rows = self._rowIdx[sel]
+            order = np.argsort(rows)
+            rows, sel = rows[order], sel[order]
+            offsets = self._offsets[iFile]
+            starts, stops = offsets[rows], offsets[rows+1]
+            iRow = 0
+            while iRow<rows.shape[0]:
+                #contiguous read of the value range of as many selected rows as fit a block
+                lastRow = np.searchsorted(stops, starts[iRow]+blockValues, side='right')
+                lastRow = max(lastRow, iRow+1)
+                blockStart, blockStop = starts[iRow], stops[lastRow-1]
+                if blockStop>blockStart:
+                    block = ds[blockStart:blockStop]
+                    lengths = stops[iRow:lastRow]-starts[iRow:lastRow]
+                    idx = np.repeat(starts[iRow:lastRow]-blockStart-np.cumsum(lengths)+lengths, lengths)+np.arange(lengths.sum())
+                    values.append(block[idx])
+                    valueEvts.append(np.repeat(sel[iRow:lastRow], lengths))
+                iRow = lastRow
+        if len(values)==0:
+            return np.zeros((0,)+self.shape, dtype=self.dtype), np.zeros(0, dtype=int)
+        values = np.concatenate(values)
+        valueEvts = np.concatenate(valueEvts)
+        order = np.argsort(valueEvts, kind='stable')
+        return values[order], valueEvts[order]
+
+class RaggedStore(object):
+    """
+    columnar ragged data of a run
+    parameters: files: columnar files (e.g. raggedFiles(h5name))
+                eventTimes: event times of the small data file to align the events with
+    """
+    def __init__(self, files, eventTimes=None):
+        self._files = [h5py.File(fname, 'r') for fname in files]
+        times = [f['event_time'][:] for f in self._files]
+        fileIdx = np.concatenate([np.full(t.shape[0], i, dtype=int) for i,t in enumerate(times)]) if len(times)>0 else np.zeros(0, dtype=int)
+        rowIdx = np.concatenate([np.arange(t.shape[0]) for t in times]) if len(times)>0 else np.zeros(0, dtype=int)
+        if eventTimes is not None:
+            eventTimes = np.asarray(eventTimes).astype(np.uint64)
+            if fileIdx.shape[0]==0:
+                fileIdx = np.full(eventTimes.shape[0], -1, dtype=int)
+                rowIdx = np.zeros(eventTimes.shape[0], dtype=int)
+            else:
+                allTimes = np.concatenate(times)
+                order = np.argsort(allTimes, kind='stable')
+                pos = np.minimum(np.searchsorted(allTimes[order], eventTimes), allTimes.shape[0]-1)
+                found = (allTimes[order][pos]==eventTimes)
+                if (~found).sum()>0:
+                    logger.info('{0} events have no columnar data'.format((~found).sum()))
+                fileIdx = np.where(found, fileIdx[order][pos], -1)
+                rowIdx = np.where(found, rowIdx[order][pos], 0)
+        self._fileIdx = fileIdx
+        self._rowIdx = rowIdx
+
+    def __len__(self):
+        return self._fileIdx.shape[0]
+
+    def dets(self):
+        return sorted(set([k for f in self._files for k in f.keys() if isinstance(f[k], h5py.Group)]))
+
+    def fields(self, det):
+        return sorted(set([k for f in self._files if det in f for k in f[det].keys()]))
+
+    def column(self, det, field):
+        datasets = []
+        offsets = []
+        for f in self._files:
+            if det in f and field in f[det]:
+                datasets.append(f[det][field]['values'])
+                offsets.append(f[det][field]['offsets'][:])
+            else:
+                datasets.append(None)
+                offsets.append(None)
+        return RaggedColumn(datasets, offsets, self._fileIdx, self._rowIdx)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
@@ -0,0 +1,327 @@
+"""
+Node-local shared memory for the constants of DetObjects.
+
+Each MPI rank builds its own DetObjects, so pedestals, gains, masks and geometry
+(and derived tables of the analysis functions, e.g. the azimuthal binning setup)
+exist once per rank. SharedConstants keeps these arrays in MPI-3 shared memory
+windows, one copy per node.
+
+loadDets builds the detectors on the first rank of each node (the leader) first.
+The constants it gets from psana are copied to shared memory and the other ranks
+of the node build their detectors with these instead of loading their own. Only
+constants the leader did not modify while building its detectors are shared this
+way, the others are loaded by each rank. shareDets then moves the remaining
+large arrays (derived constants, tables of the functions) to shared memory:
+arrays are matched by detector, attribute path, shape and dtype.
+
+usage (collective over all ranks of a node):
+    shm = SharedConstants()
+    dets = shm.loadDets(define_dets, run)
+    shm.shareDets(dets)
+Detectors only known to some of the ranks are shared among those.
+"""
+import numpy as np
+import logging
+
+from smalldata_tools.DetObjectCache import CachedDetector, getDefaultCache, setDefaultCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+#DetObject attributes holding per-pixel constants & geometry
+detConstants = ['ped', 'rms', 'gain', 'gain_mask', 'local_gain', 'mask', 'cmask', 'statusMask',
+                'pixel_status', 'offset', 'pixelGain', 'x', 'y', 'z', 'ix', 'iy']
+
+def _subFuncs(obj, path=''):
+    """ (path, function) of the analysis functions attached to a detector or function, including their subfunctions """
+    funcs = []
+    for key in sorted(obj.__dict__.keys()):
+        func = obj.__dict__[key]
+        if not hasattr(func, 'process') or not hasattr(func, '_name') or not hasattr(func, '__dict__'):
+            continue
+        funcPath = '%s%s/'%(path, key)
+        funcs.append((funcPath, func))
+        funcs += _subFuncs(func, funcPath)
+    return funcs
+
+def _shareable(arr, minBytes):
+    return isinstance(arr, np.ndarray) and not isinstance(arr, np.ma.masked_array) \
+        and not arr.dtype.hasobject and arr.nbytes>=minBytes
+
+def _unchanged(arr, copy):
+    try:
+        return np.array_equal(arr, copy, equal_nan=arr.dtype.kind in 'fc')
+    except TypeError:
+        return np.array_equal(arr, copy)
+
+class _LoaderEntry(object):
+    """
+    constants cache entry (see DetObjectCache.CachedDetector) of a detector during loadDets:
+    the leader records the psana constants, the other ranks get them from shared memory.
+    Misses go to the entry of the on-disk cache if one is set.
+    """
+    def __init__(self, shm, alias, fallback=None):
+        self._shm = shm
+        self._alias = alias
+        self._fallback = fallback
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if self._shm.nodeRank>0 and (self._alias, key) in self._shm.published:
+            return True, self._shm.published[(self._alias, key)]
+        if self._fallback is not None:
+            found, value = self._fallback.get(key)
+            if found:
+                self._shm.record((self._alias, key), value)
+                return True, value
+        return False, None
+
+    def put(self, key, value):
+        self._shm.record((self._alias, key), value)
+        if self._fallback is not None:
+            self._fallback.put(key, value)
+
+class SharedConstants(object):
+    """
+    parameters: comm: communicator to split into nodes (def: COMM_WORLD)
+                minBytes: arrays smaller than this are not shared
+    """
+    def __init__(self, comm=None, minBytes=64*1024):
+        self.minBytes = minBytes
+        self._windows = []
+        self._arrays = {}
+        self._records = {}
+        self._recording = False
+        self._cache = None
+        self.published = {}
+        self.nShared = 0
+        self.savedBytes = 0
+        if MPI is None:
+            print('mpi4py is not available, constants will not be shared')
+            self.nodeComm = None
+            self.nodeRank = 0
+            return
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        self.nodeComm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        self.nodeRank = self.nodeComm.Get_rank()
+        self.nodeSize = self.nodeComm.Get_size()
+
+    def _sharedArray(self, shape, dtype, comm):
+        """ collective: allocate shared memory on rank 0 of comm, map it on all ranks """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize if comm.Get_rank()==0 else 0
+        win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=comm)
+        buf, itemsize = win.Shared_query(0)
+        self._windows.append(win)
+        shared = np.ndarray(buffer=buf, dtype=dtype, shape=shape)
+        self._arrays[id(shared)] = shared
+        return shared
+
+    def isShared(self, arr):
+        """ True if arr (or the array it is a view of) is in one of the shared windows """
+        while isinstance(arr, np.ndarray):
+            if id(arr) in self._arrays:
+                return True
+            arr = arr.base
+        return False
+
+    def share(self, arr, comm=None):
+        """
+        collective: return a read-only shared copy of the array of rank 0 (of the node).
+        The arrays passed on the other ranks are only used to count the saved memory.
+        """
+        if comm is None:
+            comm = self.nodeComm
+        if comm is None or comm.Get_size()<2:
+            return arr
+        meta = None
+        if comm.Get_rank()==0:
+            meta = (arr.shape, arr.dtype.str)
+        meta = comm.bcast(meta, root=0)
+        shared = self._sharedArray(meta[0], meta[1], comm)
+        if comm.Get_rank()==0:
+            shared[...] = arr
+        comm.Barrier()
+        shared.flags.writeable = False
+        if comm.Get_rank()>0 and arr is not None:
+            self.savedBytes += arr.nbytes
+        self.nShared += 1
+        return shared
+
+    ###
+    # loading the detectors: DetObject calls wrap() for the psana detector when this
+    # is the default constants cache (during loadDets)
+    ###
+    def wrap(self, det, env, run):
+        """ psana detector answering the constant calls from the node leader (see DetObjectCache) """
+        fallback = None
+        if self._cache is not None:
+            try:
+                fallback = self._cache.entry(env, det, int(run))
+            except Exception as e:
+                logger.warning('Constants cache not used for {0}: {1}'.format(getattr(det, 'alias', det), e))
+        return CachedDetector(det, _LoaderEntry(self, getattr(det, 'alias', str(det)), fallback))
+
+    def record(self, recKey, value):
+        """ leader: keep a psana constant (and a copy to check it is not modified) to be shared """
+        if not self._recording or recKey in self._records:
+            return
+        if _shareable(value, self.minBytes):
+            self._records[recKey] = ((value,), (value.copy(),), False)
+        elif isinstance(value, tuple) and len(value)>0 and all([_shareable(v, 0) for v in value]):
+            self._records[recKey] = (value, tuple([v.copy() for v in value]), True)
+
+    def loadDets(self, makeDets, *args, **kwargs):
+        """
+        collective over the node: build the detectors with makeDets(*args, **kwargs) on the
+        node leader first, then on the other ranks with the psana constants of the leader.
+        returns the detectors of this rank.
+        """
+        if self.nodeComm is None or self.nodeSize<2:
+            return makeDets(*args, **kwargs)
+        self._cache = getDefaultCache()
+        setDefaultCache(self)
+        dets = []
+        error = None
+        try:
+            if self.nodeRank==0:
+                self._recording = True
+                try:
+                    dets = makeDets(*args, **kwargs)
+                except Exception as e:
+                    error = e
+                self._recording = False
+            self._publish(dets)
+            if self.nodeRank>0:
+                dets = makeDets(*args, **kwargs)
+        finally:
+            setDefaultCache(self._cache)
+            self._cache = None
+        if error is not None:
+            raise error
+        return dets
+
+    def _publish(self, dets):
+        """ collective: copy the recorded constants of the leader to shared memory """
+        meta = None
+        if self.nodeRank==0:
+            meta = []
+            for recKey, (values, copies, isTuple) in self._records.items():
+                if not all([_unchanged(v, c) for v, c in zip(values, copies)]):
+                    logger.info('{0} was modified while building the detector, not shared'.format(recKey))
+                    continue
+                meta.append((recKey, isTuple, [(v.shape, v.dtype.str) for v in copies]))
+        meta = self.nodeComm.bcast(meta, root=0)
+        replace = {}
+        for recKey, isTuple, shapes in meta:
+            shared = []
+            for ival, (shape, dtype) in enumerate(shapes):
+                arr = self._sharedArray(shape, dtype, self.nodeComm)
+                if self.nodeRank==0:
+                    values, copies, _ = self._records[recKey]
+                    arr[...] = copies[ival]
+                    replace[id(values[ival])] = arr
+                else:
+                    self.savedBytes += arr.nbytes
+                shared.append(arr)
+            self.published[recKey] = tuple(shared) if isTuple else shared[0]
+        self.nodeComm.Barrier()
+        for arr in self._arrays.values():
+            arr.flags.writeable = False
+        self.nShared += len(meta)
+        #the leader keeps the shared copies instead of its own
+        for det in dets:
+            for name, (obj, attr) in self._candidates(det, True).items():
+                if id(getattr(obj, attr, None)) in replace:
+                    setattr(obj, attr, replace[id(getattr(obj, attr))])
+        self._records = {}
+        if self.nodeRank==1:
+            logger.info('Loaded {0} constants from the node leader, {1:.1f} MB less per rank'.format(len(meta), self.savedBytes/1024.**2))
+
+    ###
+    # sharing the constants of detectors that are built already
+    ###
+    def _candidates(self, det, funcs):
+        """ attribute path: (object, attribute) of the arrays to be shared """
+        cands = {}
+        for attr in detConstants:
+            cands[attr] = (det, attr)
+        if funcs:
+            for path, func in _subFuncs(det):
+                for fattr in sorted(func.__dict__.keys()):
+                    cands[path+fattr] = (func, fattr)
+        return cands
+
+    def shareDets(self, dets, funcs=True):
+        """
+        collective over the node: share the constants of all detectors, each detector
+        among the ranks of the node that have it.
+        """
+        if self.nodeComm is None or self.nodeSize<2:
+            return
+        names = [det._name for det in dets]
+        allNames = self.nodeComm.allgather(names)
+        for name in sorted(set([n for rankNames in allNames for n in rankNames])):
+            haveDet = name in names
+            comm = self.nodeComm.Split(0 if haveDet else MPI.UNDEFINED, self.nodeRank)
+            if not haveDet:
+                continue
+            self.shareDet(dets[names.index(name)], funcs=funcs, comm=comm)
+            comm.Free()
+
+    def shareDet(self, det, funcs=True, comm=None):
+        """
+        collective: move the constants of det (and array attributes of its functions
+        if funcs is True) into node shared memory. Arrays are matched by attribute path,
+        shape and dtype, arrays already in shared memory are skipped.
+        """
+        if comm is None:
+            comm = self.nodeComm
+        if comm is None or comm.Get_size()<2:
+            return
+        cands = self._candidates(det, funcs)
+        local = {}
+        for name, (obj, attr) in cands.items():
+            arr = getattr(obj, attr, None)
+            if _shareable(arr, self.minBytes) and not self.isShared(arr):
+                local[name] = arr
+        #rank 0 decides what is shared, arrays referenced more than once are shared once
+        plan = None
+        if comm.Get_rank()==0:
+            plan = []
+            seen = {}
+            for name in sorted(local.keys()):
+                arr = local[name]
+                if id(arr) in seen:
+                    plan[seen[id(arr)]][1].append(name)
+                else:
+                    seen[id(arr)] = len(plan)
+                    plan.append([(name, arr.shape, arr.dtype.str), [name]])
+        plan = comm.bcast(plan, root=0)
+        nBefore = self.savedBytes
+        for key, users in plan:
+            matches = [uname for uname in users if uname in local
+                       and (local[uname].shape, local[uname].dtype.str)==key[1:]]
+            shared = self.share(local[matches[0]] if len(matches)>0 else None, comm)
+            for uname in users:
+                if uname not in matches:
+                    logger.warning('Shared constant {0} of {1} does not match the local array, keep local copy'.format(uname, det._name))
+                    continue
+                uobj, uattr = cands[uname]
+                setattr(uobj, uattr, shared)
+        if comm.Get_rank()==1:
+            logger.info('{0}: shared {1} arrays, {2:.1f} MB less per rank'.format(det._name, len(plan), (self.savedBytes-nBefore)/1024.**2))
+
+    def free(self):
+        """ release the shared windows, the shared arrays must not be used anymore """
+        for win in self._windows:
+            win.Free()
+        self._windows = []
+        self._arrays = {}
+        self.published = {}
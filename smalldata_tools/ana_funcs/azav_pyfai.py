@@ -39,6 +39,10 @@ class azav_pyfai(DetObjectFunc):
     azav_kwargs: dict, optional
         Additonal arguments to pass to integrate1d or integrate2d.
         See https://pyfai.readthedocs.io/en/master/api/pyFAI.html#pyFAI.azimuthalIntegrator.AzimuthalIntegrator.integrate1d
+    
+    batch_method: str, optional
+        pyFAI method for processBatch (stacks of images, e.g. the bins of a cube). Default 'csr':
+        the sparse matrix is made for the first image & reused by the integrator for the others.
     """
     
     def __init__(self, **kwargs):
@@ -68,6 +72,7 @@ class azav_pyfai(DetObjectFunc):
         # self.az_range = kwargs.pop('azimuthal_range',None)
         self._units = kwargs.pop('int_units','2th_deg') # q_A^-1, 2th_deg, r_mm
         self._azav_kwargs = kwargs.pop('azav_kwargs',{}) # additional arguments for integration
+        self.batch_method = kwargs.pop('batch_method','csr')
         return
 
     def setFromDet(self, det):
@@ -123,14 +128,24 @@ class azav_pyfai(DetObjectFunc):
         out = self._process(data)
         return out
     
-    def _process(self, data):
+    def processBatch(self, data):
+        """ process for a stack of images, the integration engine is set up once for all of them """
+        out = {}
+        for img in data:
+            if img.ndim==3:
+                img = image_from_dxy(img, self.ix, self.iy)
+            for key, value in self._process(img, method=self.batch_method).items():
+                out.setdefault(key, []).append(value)
+        return {key: np.array(value) for key, value in out.items()}
+    
+    def _process(self, data, method='cython'):
         if self.return2d:
             I, q, az = self.ai.integrate2d(data, self.npts, self.npts_az, unit=self._units, 
-                                           polarization_factor=self.pol_factor, mask=self.mask, method='cython', 
+                                           polarization_factor=self.pol_factor, mask=self.mask, method=method, 
                                            **self._azav_kwargs)
             return {'azav':I, 'q': q, 'az':az}
         else:
             q, I = self.ai.integrate1d(data, self.npts, unit=self._units, 
-                                       polarization_factor=self.pol_factor, mask=self.mask, method='cython', 
+                                       polarization_factor=self.pol_factor, mask=self.mask, method=method, 
                                        **self._azav_kwargs)
             return {'azav':I, 'q': q}
@@ -4,6 +4,7 @@ from scipy import hypot,arcsin,arccos
 import time
 import h5py
 from scipy.interpolate import griddata
+from scipy import sparse
 import smalldata_tools.utilities as util
 from smalldata_tools.DetObject import DetObjectFunc
 from mpi4py import MPI
@@ -330,8 +331,29 @@ class azimuthalBinning(DetObjectFunc):
         self.Icake = I/self.Cake_norm
         return self.Icake
 
-    def process(self, data):
-        data=data.copy()
+    def _cakeMatrix(self, applyCorrection=True):
+        """ sparse (cake bin x unmasked pixel) matrix doing the binning of doCake, made once """
+        key = '_cakeMatrix_corr' if applyCorrection else '_cakeMatrix_nocorr'
+        if getattr(self, key, None) is None:
+            nradial = self.nr if (self.rbin is not None and applyCorrection) else self.nq
+            weights = 1./self.correction.ravel() if applyCorrection else np.ones(self.Cake_idxs.shape[0])
+            nRows = max(nradial*self.nphi, int(self.Cake_idxs.max())+1)
+            matrix = sparse.csr_matrix((weights, (self.Cake_idxs, np.arange(self.Cake_idxs.shape[0]))),
+                                       shape=(nRows, self.Cake_idxs.shape[0]))
+            setattr(self, key, (matrix[:nradial*self.nphi], nradial))
+        return getattr(self, key)
+
+    def doCakeBatch(self, imgs, applyCorrection=True):
+        """ doCake for a stack of images (first axis), one sparse matrix product for all of them """
+        imgs = np.asarray(imgs, dtype=float)
+        if self.darkImg is not None: imgs = imgs-self.darkImg
+        if self.gainImg is not None: imgs = imgs/self.gainImg
+        imgs = imgs.reshape(imgs.shape[0], -1)[:, self._mask.ravel()==0]
+        matrix, nradial = self._cakeMatrix(applyCorrection)
+        I = np.asarray(matrix.dot(imgs.T)).T
+        return I.reshape(imgs.shape[0], self.nphi, nradial)/self.Cake_norm
+
+    def _threshold(self, data):
         if self.thresADU is not None:
             data[data<self.thresADU]=0.
         if self.thresADUhigh is not None:
@@ -340,7 +362,16 @@ class azimuthalBinning(DetObjectFunc):
             data[data>self.thresRms*self.rms]=0.
         if self.square:
             data=data*data
+        return data
+
+    def process(self, data):
+        data = self._threshold(data.copy())
         return {'azav': self.doCake(data)}
+
+    def processBatch(self, data):
+        """ process for a stack of images (e.g. the bins of a cube) """
+        data = self._threshold(np.array(data, dtype=float))
+        return {'azav': self.doCakeBatch(data)}
     
         
 #make this a real test class w/ assertions.
@@ -288,6 +288,8 @@ class sparsifyFunc(DetObjectFunc):
     """
     Function to sparisify a passed array (2 or 3-d input)
     nData: if passed, make output array rectangular (for storing in event based smlData)
+           otherwise, the fields are returned as ragged (written to columnar files by
+           the producers with --columnar, see SmallDataRagged)
     if a dictionary w/ data, row, col is passed, only make rectangular
     """
     def __init__(self, **kwargs):
@@ -341,7 +343,7 @@ class sparsifyFunc(DetObjectFunc):
             ret_dict['tile']=tile
             
         #now fix shape of data in dict.
-        if self.nData > 0:
+        if self.nData is not None and self.nData > 0:
             for key in ret_dict.keys():
                 if ret_dict[key].shape[0] >= self.nData:
                     ret_dict[key]=ret_dict[key][:self.nData]
@@ -351,10 +353,7 @@ class sparsifyFunc(DetObjectFunc):
                         if not self._saveintadu and key == 'data': continue
                         ret_dict[key] = ret_dict[key].astype(int)
         else:
-            ret_dict={'ragged_data':data}
-            ret_dict['ragged_row']=row
-            ret_dict['ragged_col']=col
-            ret_dict['ragged_tile']=tile
+            ret_dict={ 'ragged_%s'%key: np.asarray(value) for key,value in ret_dict.items() }
 
         subfuncResults = self.processFuncs()
         for k in subfuncResults:
@@ -1,11 +1,16 @@
 import numpy as np
 import logging
 import time
-import itertools
+import json
+import hashlib
+import threading
+from collections import deque
 
 import psana
 from smalldata_tools.DetObject import DetObject, DetObjectFunc
 from smalldata_tools.SmallDataUtils import getUserData
+from smalldata_tools.utilities import mergeMoments
+from smalldata_tools.SmallDataPipeline import AsyncWriter, EventPrefetcher
 from smalldata_tools.ana_funcs.roi_rebin import ROIFunc
 from smalldata_tools.ana_funcs.photons import photonFunc
 from smalldata_tools.ana_funcs.droplet import dropletFunc
@@ -22,70 +27,265 @@ logger = logging.getLogger()
 
 
 DUMMY = False
+# per-bin timing written to the cube file (group bin_timing)
+timing_keys = ['io', 'wait', 'compute', 'post', 'worker']
+def bin_hash(info):
+    """ hash of the events of a bin (fiducials & event times) to check bins of a resumed cube """
+    digest = hashlib.sha1()
+    for arr in info:
+        digest.update(np.ascontiguousarray(arr).tobytes())
+    return np.frombuffer(digest.digest()[:8], dtype=np.uint64)[0]
+
+def config_hash(config):
+    """ hash of the detector configuration of a cube (targetVarsXtc: det_proc, image, thresholds...) """
+    toJson = lambda obj: obj.tolist() if isinstance(obj, np.ndarray) else str(obj)
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=toJson).encode()).hexdigest()
+
 def lengthy_computation(*args):
     time.sleep(10+np.random.randint(10))
     return 1
 
 
+
 class Bin_distribution(object):
     """ Handles the distribution of the bin analysis to worker on a per bin basis. Generally should be run 
     from rank 0 in MPI.
-    Workflow: if a worker is not busy, it gets the first bin with a 'not done'
-    or 'not in progress' status. Workers' status is stored in array 'working' and the bin 
-    processing status is in 'bin_done'.
+    Workflow: the bins are sent largest first (by number of events) to keep the workers busy until
+    the end. Bins with more than split_events events are split into chunks of events processed by
+    different workers. The partial sums are merged on rank 0 and sent to a worker once more for the
+    post-processing of the summed bin (image, DetObjectFuncs).
+    Idle workers get the next job of the pending queue as soon as they return a job.
+    Jobs are sent non-blocking and the finished bins are written to file by a separate writer
+    thread, so writing a large bin does not hold back the distribution of the next jobs.
+    Workers' status is stored in the dict 'working' and the bin processing status is in 'bin_status'.
+    The completion of each bin is recorded in the file (group bin_status) as soon as it is written.
+    A job restarted on the same file only processes the bins that are not done yet, bins whose
+    events changed since (hash of the fiducials & event times) are processed again. All bins
+    are processed again if the detector configuration changed or detector datasets were
+    (re)created.
     
     Args:
         bins_info: bin-dependent parameter to pass to the worker. Typically a list of idx
             corresponding to the bin. For cube: list of fiducials and event time array.
-        func: what to do with returned results. Must accept bin_idx and data as kw argument. Generally
-            a function to write data to file.
+        file: h5 file the bins are written to.
+        write_queue: maximum number of finished bins waiting to be written (def: number of workers)
+        split_events: maximum number of events per job. 'auto': about half of the events per worker
+            (at least min_split), None or 0: do not split bins
+        min_split: minimum number of events per chunk for split_events='auto'
+        resume: skip the bins completed by an earlier job on this file
+        config: detector configuration of the cube (targetVarsXtc), bins done with another
+            configuration are not resumed
+        reset: process all bins again, e.g. if the detector datasets were (re)created
+        batch_post: the workers do not run the DetObjectFuncs on the bins, they are run on the
+            whole cube once it is written (cube_postproc.postProcessCube)
     """
     
-    def __init__(self, bins_info, file):
+    def __init__(self, bins_info, file, write_queue=None, split_events='auto', min_split=100, resume=True, batch_post=False, config=None, reset=False):
         self.bins_info = bins_info
         self.nBins = len(self.bins_info)
         logger.info('Total number of bins: {}'.format(self.nBins))
-        self.working = np.zeros((size-1, 2)) # rank currently working and bin_idx on which it is working
+        self.working = {} # rank currently working: job on which it is working
         self.bin_status = np.zeros(self.nBins) # whether bin has been processed or not. 0.5=in progress, 1=done
+        self.nEvents = np.array([len(info[0]) if len(info)>0 else 0 for info in bins_info], dtype=int)
+        if split_events=='auto':
+            split_events = max(min_split, int(np.ceil(self.nEvents.sum()/(2.*max(1, size-1)))))
+        self.split_events = split_events if split_events else None
+        self._partial = {} # bin_idx: [missing chunks, summed_data, n_in_bin, moments] of split bins
+        self.timing = [] # bin_idx, chunk, events, worker, seconds for each job
+        self.bin_timing = np.zeros((self.nBins, len(timing_keys))) # per bin, summed over the chunks
         self.file = file
+        self.write_queue = write_queue if write_queue is not None else max(1, size-1)
+        self.write_time = 0
+        self.batch_post = batch_post
+        self.nResumed = self._init_status(resume, config_hash(config), reset)
+        self.pending = deque(self._make_jobs()) # jobs not sent to a worker yet
+        return
+    
+    
+    def _init_status(self, resume, cfg_hash, reset):
+        """ per-bin completion status in the file, returns the number of bins done by an earlier job """
+        hashes = np.array([bin_hash(info) for info in self.bins_info], dtype=np.uint64)
+        grp = self.file.require_group('bin_status')
+        done = np.zeros(self.nBins, dtype=bool)
+        if resume and 'done' in grp:
+            if reset:
+                logger.warning('Detector datasets of the cube file were (re)created: process all bins again.')
+            elif grp.attrs.get('config_hash', '')!=cfg_hash:
+                logger.warning('Detector configuration of the cube changed: process all bins again.')
+            elif grp['done'].shape[0]!=self.nBins:
+                logger.warning('Cube file has {} bins, now {}: process all bins again.'.format(grp['done'].shape[0], self.nBins))
+            else:
+                wasDone = grp['done'][:].astype(bool)
+                done = wasDone&(grp['events_hash'][:]==hashes)
+                if (wasDone&~done).sum()>0:
+                    logger.warning('Events of {} completed bins changed, process them again.'.format((wasDone&~done).sum()))
+                # keep the timing of the bins done before
+                if 'bin_timing' in self.file:
+                    for ikey, key in enumerate(timing_keys):
+                        if key in self.file['bin_timing'] and self.file['bin_timing'][key].shape[0]==self.nBins:
+                            self.bin_timing[done, ikey] = self.file['bin_timing'][key][:][done]
+        for name in ['done', 'events_hash']:
+            if name in grp:
+                del grp[name]
+        grp.create_dataset('done', data=done.astype(np.int8))
+        grp.create_dataset('events_hash', data=hashes)
+        grp.attrs['config_hash'] = cfg_hash
+        self.file.flush()
+        self.bin_status[done] = 1
+        if done.sum()>0:
+            logger.info('Resume cube: {} of {} bins are done already.'.format(done.sum(), self.nBins))
+        return int(done.sum())
+    
+    
+    def _make_jobs(self):
+        """ jobs (bin_idx, chunk) ordered by decreasing number of events. chunk: None or (iChunk, nChunks) """
+        jobs = []
+        for bin_idx, nEvt in enumerate(self.nEvents):
+            if self.bin_status[bin_idx]==1:
+                continue
+            if self.split_events is not None and nEvt>self.split_events:
+                nChunks = int(np.ceil(nEvt/self.split_events))
+                jobs += [(bin_idx, (iChunk, nChunks)) for iChunk in range(nChunks)]
+            else:
+                jobs.append((bin_idx, None))
+        jobs.sort(key=lambda job: -self._job_events(*job))
+        nSplit = len(set([job[0] for job in jobs if job[1] is not None]))
+        if nSplit>0:
+            logger.info('Split {} bins into chunks of at most {} events.'.format(nSplit, self.split_events))
+        return jobs
+    
+    
+    def _chunk_range(self, bin_idx, chunk):
+        iChunk, nChunks = chunk
+        nEvt = self.nEvents[bin_idx]
+        return iChunk*nEvt//nChunks, (iChunk+1)*nEvt//nChunks
+    
+    
+    def _job_events(self, bin_idx, chunk):
+        if chunk is None:
+            return self.nEvents[bin_idx]
+        if chunk=='post':
+            return 0
+        start, stop = self._chunk_range(bin_idx, chunk)
+        return stop-start
+    
+    
+    def _write(self, bin_idx, data):
+        t0 = time.time()
+        self.save_bin_to_h5(bin_idx, data)
+        # mark the bin as done once its data is in the file
+        self.file.flush()
+        self.file['bin_status/done'][bin_idx] = 1
+        self.file.flush()
+        self.write_time += time.time()-t0
+        logger.debug('Bin {} written in {:.2f}s.'.format(bin_idx, time.time()-t0))
+    
+    
+    def _send_job(self, worker, requests):
+        bin_idx, chunk = self.pending.popleft()
+        job_info = {'bin_idx': bin_idx, 'run_funcs': not self.batch_post}
+        if chunk=='post':
+            job_info['summed'] = self._partial.pop(bin_idx)[1:]
+        elif chunk is not None:
+            # chunks of consecutive events in time (close in the xtc files)
+            start, stop = self._chunk_range(bin_idx, chunk)
+            order = np.argsort(np.asarray(self.bins_info[bin_idx][1]), kind='stable')[start:stop]
+            job_info['info'] = [np.asarray(info)[order] for info in self.bins_info[bin_idx]]
+            job_info['chunk'] = chunk
+        else:
+            job_info['info'] = [info for info in self.bins_info[bin_idx]]
+        logger.debug('Send job to rank {}: bin {}, chunk {}'.format(worker, bin_idx, chunk))
+        self.bin_status[bin_idx] = 0.5
+        self.working[worker] = (bin_idx, chunk, time.time())
+        requests.append(comm.isend(job_info, dest=worker))
         return
     
     
+    def _merge_chunk(self, bin_idx, chunk, data):
+        """ add the partial sums of a chunk, returns True once all chunks of the bin are in """
+        if bin_idx not in self._partial:
+            self._partial[bin_idx] = [chunk[1], {}, {}, {}]
+        partial = self._partial[bin_idx]
+        partial[0] -= 1
+        moments = data[3] if len(data)>3 else {}
+        for detname in data[0].keys():
+            n_a, n_b = partial[2].get(detname, 0), data[1][detname]
+            if detname in moments:
+                mom = partial[3].setdefault(detname, {})
+                mom['M2'] = mergeMoments(n_a, partial[1].get(detname, 0), mom.get('M2', 0),
+                                          n_b, data[0][detname], moments[detname]['M2'])
+                if 'nhits' in moments[detname]:
+                    mom['nhits'] = mom.get('nhits', 0)+moments[detname]['nhits']
+            partial[1][detname] = partial[1].get(detname, 0)+data[0][detname]
+            partial[2][detname] = n_a+n_b
+        return partial[0]==0
+    
+    
     def distribute(self):
-        while(not np.all(self.bin_status==1)):
-            for worker_id, at_work in enumerate(self.working):
-                if at_work[0]==0:
-                    try:
-                        bin_idx = np.argwhere(self.bin_status==0)[0][0]
-                    except Exception as e:
-                        continue
-                    job_info = {'bin_idx': bin_idx, 'info': []}
-                    for info in self.bins_info[bin_idx]:
-                        job_info['info'].append(info)
-                    logger.debug('Send job to rank {}: {}'.format(worker_id+1, len(job_info)))
-                    self.bin_status[bin_idx] = 0.5
-                    comm.send(job_info, dest=worker_id+1) # rank 0 does not do jobs
-                    self.working[worker_id,:] = [1, bin_idx]
-            # logger.debug('Working: {}'.format(self.working))
+        writer = AsyncWriter(self._write, depth=self.write_queue)
+        idle = deque(range(1, size)) # rank 0 does not do jobs
+        requests = []
+        nDone = self.nResumed
+        status = MPI.Status()
+        t_start = time.time()
+        while nDone<self.nBins:
+            while len(idle)>0 and len(self.pending)>0:
+                self._send_job(idle.popleft(), requests)
+            # the send buffers of completed requests can be freed
+            requests = [req for req in requests if not req.Test()]
 
             t1 = time.time()
-            job_done = comm.recv(source=MPI.ANY_SOURCE)
+            job_done = comm.recv(source=MPI.ANY_SOURCE, status=status)
             t2 = time.time()
-            bin_idx = job_done['idx']
-            logger.info('Bin {} received on rank 0 after {}s.'.format(bin_idx, t2-t1))
+            worker = status.Get_source()
+            bin_idx, chunk, t_sent = self.working.pop(worker)
+            idle.append(worker)
+            self.timing.append([bin_idx, -1 if chunk is None else (-2 if chunk=='post' else chunk[0]),
+                                self._job_events(bin_idx, chunk), worker, t2-t_sent])
+            for ikey, key in enumerate(timing_keys[:-1]):
+                self.bin_timing[bin_idx, ikey] += job_done.get('timing', {}).get(key, 0.)
+            self.bin_timing[bin_idx, -1] += t2-t_sent
+            logger.info('Bin {} (chunk {}) received on rank 0 after {}s.'.format(bin_idx, chunk, t2-t1))
+            
+            if chunk is not None and chunk!='post':
+                if self._merge_chunk(bin_idx, chunk, job_done['data']):
+                    # post-processing of the summed bin goes first
+                    self.pending.appendleft((bin_idx, 'post'))
+                job_done = None
+            # refill the idle worker before the bin is handed to the writer
+            if len(self.pending)>0:
+                self._send_job(idle.popleft(), requests)
+            if job_done is None:
+                continue
             
-            self.save_bin_to_h5(bin_idx, job_done['data'])
+            writer.put(bin_idx, job_done['data'])
             
             self.bin_status[bin_idx] = 1
-            worker_id = np.argwhere(self.working[:,1]==bin_idx)[0][0]
-            self.working[worker_id,0] = 0
-            logger.debug('New bin status: {}'.format(self.bin_status))
-        logger.info('**** DONE ****')
+            nDone += 1
+        MPI.Request.Waitall(requests)
+        writer.close()
+        self.save_timing_to_h5()
+        timing = np.array(self.timing).reshape(-1,5)
+        work_time = timing[timing[:,1]!=-2,4].sum()
+        logger.info('**** DONE **** {} bins in {:.1f}s, {:.1f}s writing, {:.3g}s/event on the workers.'\
+                    .format(self.nBins-self.nResumed, time.time()-t_start, self.write_time, work_time/max(1, self.nEvents.sum())))
 
         """ Send stop signal to workers """
-        for worker_id, at_work in enumerate(self.working):
-            if at_work[0]==0:
-                comm.send('done', dest=worker_id+1)
+        for worker in idle:
+            comm.send('done', dest=worker)
+        return
+    
+    
+    def save_timing_to_h5(self):
+        """ per-bin time spent reading, waiting for events, processing, post-processing & on the worker in total """
+        grp = self.file.require_group('bin_timing')
+        for ikey, key in enumerate(timing_keys):
+            if key in grp:
+                del grp[key]
+            grp.create_dataset(key, data=self.bin_timing[:,ikey])
+        if 'nEvents' not in grp:
+            grp.create_dataset('nEvents', data=self.nEvents)
+        grp.attrs['write'] = self.write_time
         return
     
     
@@ -101,9 +301,9 @@ class Bin_distribution(object):
             dset_name = f'{detname}_nEntries'
             dset = self.file[dset_name]
             dset[bin_idx] = data[1][detname]
-            # proc data
+            # proc data (incl. std & nhits)
             if data[2]:
-                for key in data[2][detname].keys():
+                for key in data[2].get(detname, {}).keys():
                     dset_name = f'{detname}_{key}'
                     dat = data[2][detname][key]
                     shape = (self.nBins,)+dat.shape
@@ -114,11 +314,16 @@ class Bin_distribution(object):
 
 
 class BinWorker(object):
-    def __init__(self, run, expname):
+    def __init__(self, run, expname, read_ahead=4):
         """ Make index-based datasource and get area detector info from root rank.
+        read_ahead: number of events fetched in a background thread while the current one is processed (0: off)
         """
         logger.debug('Initializing worker {}.'.format(rank))
         self.run = int(run)
+        self.read_ahead = read_ahead
+        # psana is not thread safe: fetching events (read-ahead thread) & getting the detector data are serialized
+        self._psana_lock = threading.Lock()
+        self.timing = dict.fromkeys(timing_keys[:-1], 0.)
         self.expname = expname
         bcast_var = None
         dsname = comm.bcast(bcast_var, root=0)
@@ -140,12 +345,15 @@ class BinWorker(object):
         self.targetVarsXtc = comm.bcast(bcast_var, root=0) # get det info from rank 0
         logger.debug('Detectors info received on rank {}. {}'.format(rank, self.targetVarsXtc))
         self.dets = []
+        self.nhits_dets = [] # detectors for which the pixel-wise hit count is stored
         for det_info in self.targetVarsXtc:
             try:
                 detname = det_info['source']
                 cm = det_info.get('common_monde',None)
                 det = DetObject(detname, self.dsIdx.env(), self.run, common_mode=cm, name=detname)
                 self.dets.append(det)
+                if det_info.get('nhits', False):
+                    self.nhits_dets.append(detname)
                 # add full ROI analysis
                 det.addFunc(ROIFunc(writeArea=True)) # add full image (always)
                 
@@ -173,21 +381,46 @@ class BinWorker(object):
                 logger.debug('Rank {} done.'.format(rank))
                 done = 1
                 continue
+            if 'summed' in job_info:
+                # post-process the merged sums of a split bin
+                logger.info('Rank {} got summed bin #{}.'.format(rank, job_info['bin_idx']))
+                summed_data, n_in_bin, moments = job_info['summed']
+                t0 = time.time()
+                summed_data, proc_data = self.process_summed_bin(summed_data, job_info['bin_idx'], n_in_bin, moments,
+                                                                 run_funcs=job_info.get('run_funcs', True))
+                self.timing = dict.fromkeys(timing_keys[:-1], 0.)
+                self.timing['post'] = time.time()-t0
+                out = summed_data, n_in_bin, proc_data
+                job_done = {'idx': job_info['bin_idx'], 'data': out, 'timing': self.timing}
+                comm.send(job_done, dest=0)
+                continue
             logger.info('Rank {} got some job. Shots in bin #{}: {}'\
                         .format(rank, job_info['bin_idx'], len(job_info['info'][0])))
             if DUMMY: # just to test things
                 out = lengthy_computation()
             else:
-                out = self.process_bin(job_info['info'], job_info['bin_idx']) 
+                # chunks of split bins are post-processed once all are summed
+                out = self.process_bin(job_info['info'], job_info['bin_idx'], post_process=job_info.get('chunk') is None,
+                                       run_funcs=job_info.get('run_funcs', True))
                 # INFO: out[0]: summed_data, out[1]: n_in_bin, out[3]: proc_data
-            job_done = {'idx': job_info['bin_idx'], 'data': out}
+            job_done = {'idx': job_info['bin_idx'], 'data': out, 'timing': self.timing}
             comm.send(job_done, dest=0)
         logger.debug('Rank {} out of while loop.'.format(rank))
         return
     
     
-    def process_bin(self, bin_info, bin_idx):
+    def process_bin(self, bin_info, bin_idx, post_process=True, run_funcs=True):
         """ bin_info[0]: fiducials, bin_info[1]: evttime
+        post_process: process the summed data (image, std, DetObjectFuncs). Else the raw sums are returned,
+            with the moments (sum of squared deviations from the mean, pixel-wise hit count) needed to 
+            merge them with other chunks of the bin.
+        run_funcs: run the DetObjectFuncs on the summed data (False: batched on the whole cube)
+        Mean & variance are accumulated with Welford's algorithm, the hit count (pixels>0 after the 
+        threshold) for the detectors with 'nhits' in their config.
+        The events are read in time order (proxy for their position in the xtc files), the next
+        read_ahead events are fetched while the functions of the current one are processed.
+        The time spent reading (io), waiting for events (wait), processing events (compute) and
+        post-processing the sums (post) is stored in self.timing.
         """
         summed_data = {}
         n_in_bin = {}
@@ -195,21 +428,63 @@ class BinWorker(object):
         for det in self.dets:
             summed_data[det._name] = 0
             n_in_bin[det._name] = 0
+        mean = {}
+        moments = {}
+        self.timing = dict.fromkeys(timing_keys[:-1], 0.)
+        
+        order = np.argsort(np.asarray(bin_info[1]), kind='stable')
+        io_time = [0.] # only updated by the reading thread, added to the timing at the end
+        def fetch_events():
+            for evtfid, evttime in zip(np.asarray(bin_info[0])[order], np.asarray(bin_info[1])[order]):
+                t0 = time.time()
+                evtt = psana.EventTime(int(evttime),int(evtfid))
+                evt = self.dsIdxRun.event(evtt)
+                io_time[0] += time.time()-t0
+                yield evt
+        if self.read_ahead>0:
+            events = EventPrefetcher(fetch_events(), depth=self.read_ahead, lock=self._psana_lock)
+        else:
+            events = ((evt, None) for evt in fetch_events())
         
         # get summed detectors data for the bin
-        for ievt, evtfid, evttime in zip(itertools.count(), bin_info[0], bin_info[1]):
-            evtt = psana.EventTime(int(evttime),int(evtfid))
-            evt = self.dsIdxRun.event(evtt)
+        event_iter = iter(events)
+        while True:
+            t0 = time.time()
+            try:
+                evt, _ = next(event_iter)
+            except StopIteration:
+                break
+            t1 = time.time()
+            self.timing['wait'] += t1-t0
             data = self.process_event(evt)
+            self.timing['compute'] += time.time()-t1
             for detname, dat in data.items():
                 if dat is None:
                     continue
                 else:
                     n_in_bin[detname]+=1
                     summed_data[detname]+=dat
+                    # Welford update of the mean & sum of squared deviations
+                    if detname not in mean:
+                        mean[detname] = np.zeros(dat.shape)
+                        moments[detname] = {'M2': np.zeros(dat.shape)}
+                        if detname in self.nhits_dets:
+                            moments[detname]['nhits'] = np.zeros(dat.shape)
+                    delta = dat-mean[detname]
+                    mean[detname] += delta/n_in_bin[detname]
+                    moments[detname]['M2'] += delta*(dat-mean[detname])
+                    if 'nhits' in moments[detname]:
+                        moments[detname]['nhits'] += (dat>0)
         
+        if self.read_ahead>0:
+            events.close()
+        self.timing['io'] += io_time[0]
+        if not post_process:
+            return summed_data, n_in_bin, {}, moments
         # post-process on the summed data in the bin
-        summed_data, proc_data = self.process_summed_bin(summed_data, bin_idx)
+        t0 = time.time()
+        summed_data, proc_data = self.process_summed_bin(summed_data, bin_idx, n_in_bin, moments, run_funcs=run_funcs)
+        self.timing['post'] = time.time()-t0
         return summed_data, n_in_bin, proc_data
     
     
@@ -218,7 +493,8 @@ class BinWorker(object):
         det_data = {}
         for det, thisDetDict in zip(self.dets, self.targetVarsXtc):
             try:
-                det.getData(evt)
+                with self._psana_lock:
+                    det.getData(evt)
                 det.processFuncs()
                 thisDetDataDict = getUserData(det)
                 img = None
@@ -236,45 +512,40 @@ class BinWorker(object):
                     img[img<thisDetDict['thresRms']*det.rms] = 0
 
                 det_data[det._name] = img # can onky handle full area ROIFunc for now
-                
-                # calculate variance (see ... for ref)
-                
-#                     if not (key=='full_area' or key.find('ROI')>=0 or key.find('photon_img')>=0):
-#                         continue
-#                     if (key=='full_area' or key.find('ROI')>=0):
-#                         if 'thresADU' in thisDetDict:
-#                             thisDetDataDict[key][thisDetDataDict[key]<thisDetDict['thresADU']]=0
-#                         elif 'thresRms' in thisDetDict:
-#                             thisDetDataDict[key][thisDetDataDict[key]<thisDetDict['thresRms']*det.rms]=0
-#                         dArray[ib%bins_per_job]=dArray[ib%bins_per_job]+thisDetDataDict[key]
-#                     else: #if key.find('photon_img')
-#                         dIArray[ib%bins_per_job]=dIArray[ib%bins_per_job]+thisDetDataDict[key]
-
-#                     x = thisDetDataDict[key]
-#                     oldM = dMArray
-#                     dMArray = dMArray + (x-dMArray)/(ievt+1)
-#                     dSArray = dSArray + (x-dMArray)*(x-oldM)
+                # mean & variance are accumulated in process_bin
             except Exception as e:
                 print('Failed to get data for this event for det {}.\n{}'.format(det._name, e))
                 det_data[det._name] = None
         return det_data
     
     
-    def process_summed_bin(self, summed_data, bin_idx):
+    def process_summed_bin(self, summed_data, bin_idx, n_in_bin=None, moments=None, run_funcs=True):
+        """ n_in_bin & moments (from process_bin): store the std (& nhits) of each det in proc_data
+        run_funcs: run the DetObjectFuncs (e.g. azimuthal averages) on the summed data
+        """
         proc_data = {}
         for det, thisDetDict in zip(self.dets, self.targetVarsXtc):
             if isinstance(summed_data[det._name],int):
                 logger.info('No data in bin {}.'.format(bin_idx))
                 summed_data[det._name] = np.nan
                 continue
+            make_image = hasattr(det, 'x') and thisDetDict['image']==1
+            if moments is not None and det._name in moments:
+                det_moments = {'std': np.sqrt(moments[det._name]['M2']/n_in_bin[det._name])}
+                if 'nhits' in moments[det._name]:
+                    det_moments['nhits'] = moments[det._name]['nhits']
+                for key, value in det_moments.items():
+                    proc_data.setdefault(det._name, {})[key] = det.det.image(self.run, value) if make_image else value
             # make full image for each det if requested
-            if hasattr(det, 'x') and thisDetDict['image']==1:
+            if make_image:
                 summed_data[det._name] = det.det.image(self.run, summed_data[det._name])
             # process the additional functions
+            if not run_funcs:
+                continue
             for func in [det.__dict__[k] for k in det.__dict__ if isinstance(det.__dict__[k], DetObjectFunc)]:
                 if isinstance(func, (ROIFunc, photonFunc, dropletFunc, droplet2Func)):
                     continue
-                proc_data[det._name] = func.process(summed_data[det._name])
+                proc_data.setdefault(det._name, {}).update(func.process(summed_data[det._name]))
                 logger.debug(f'Processed data keys: {proc_data[det._name].keys()}')
         return summed_data, proc_data
 
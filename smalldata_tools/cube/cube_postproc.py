@@ -0,0 +1,90 @@
+"""
+Batched post-processing of the summed bins of a cube.
+
+Instead of running the DetObjectFuncs of a detector (azimuthalBinning, azav_pyfai)
+on the summed image of each bin on the workers, the funcs are set up once and
+applied to the stack of bin images of the cube (<det>_data), in blocks of bins.
+Funcs with a processBatch method process the whole block at once (sparse matrix of
+azimuthalBinning, reused csr engine of pyFAI), others are called bin by bin on the
+same instance. The results are stored like the per-bin ones: <det>_<key> with one
+row per bin, NaN for empty bins.
+
+usage:
+    writer side: makeCubeData(..., batchPost=True) (letsCube --batch_post)
+    offline:     with h5py.File(cubeFile, 'a') as f:
+                     postProcessCube(f, {'Rayonix': [azimuthalBinning(...)]})
+"""
+import time
+import logging
+import numpy as np
+from smalldata_tools.ana_funcs.azimuthalBinning import azimuthalBinning
+from smalldata_tools.ana_funcs.azav_pyfai import azav_pyfai
+
+logger = logging.getLogger(__name__)
+
+# funcs that can be run on the summed bins (det_proc of the cube config)
+postProcFuncs = {'azimuthalBinning': azimuthalBinning, 'azav_pyfai': azav_pyfai}
+
+def makeDetFuncs(det, det_info):
+    """ set up the det_proc funcs of a detector of the cube config once """
+    funcs = []
+    for func_args in det_info.get('det_proc', []):
+        func_args = dict(func_args)
+        fname = func_args.pop('name')
+        if fname not in postProcFuncs:
+            print('{} can not be run on the summed bins, skip it.'.format(fname))
+            continue
+        func = postProcFuncs[fname](**func_args)
+        func._proc = False
+        func.setFromDet(det)
+        try:
+            func.setFromFunc()
+        except:
+            print('Failed to pass parameters to children of ',func._name)
+        funcs.append(func)
+    return funcs
+
+def batchProcess(func, stack):
+    """ results of func for a stack of images as arrays with the images along the first axis """
+    if hasattr(func, 'processBatch'):
+        return func.processBatch(stack)
+    out = {}
+    for img in stack:
+        for key, value in func.process(img).items():
+            out.setdefault(key, []).append(value)
+    return {key: np.array(value) for key, value in out.items()}
+
+def postProcessCube(fout, detFuncs, blockBytes=256*1024*1024):
+    """
+    run the funcs of each detector on its bin images (fout: cube file open for writing,
+    detFuncs: {detname: [funcs]}). Works on flat (in progress) and on reshaped bins,
+    the bin shape of finished cubes is the one of nEntries.
+    """
+    for detname, funcs in detFuncs.items():
+        if len(funcs)==0:
+            continue
+        tstart = time.time()
+        ds = fout['%s_data'%detname]
+        nEntries = fout['%s_nEntries'%detname][()]
+        #<det>_nEntries stay flat when the bins are reshaped: take the bins of nEntries if <det>_data has them
+        binShape = nEntries.shape
+        if 'nEntries' in fout and fout['nEntries'].size==nEntries.size and ds.shape[:fout['nEntries'].ndim]==fout['nEntries'].shape:
+            binShape = fout['nEntries'].shape
+        nEntries = nEntries.reshape(binShape)
+        detShape = ds.shape[len(binShape):]
+        rowBytes = max(1, int(np.prod(ds.shape[1:]))*ds.dtype.itemsize)
+        step = max(1, blockBytes//rowBytes)
+        for start in range(0, binShape[0], step):
+            stop = min(start+step, binShape[0])
+            stack = np.nan_to_num(ds[start:stop]).reshape((-1,)+detShape)
+            empty = nEntries[start:stop].ravel()==0
+            for func in funcs:
+                for key, value in batchProcess(func, stack).items():
+                    value = np.array(value, dtype=float)
+                    value[empty] = np.nan
+                    value = value.reshape((stop-start,)+binShape[1:]+value.shape[1:])
+                    dset = fout.require_dataset('%s_%s'%(detname, key), shape=binShape+value.shape[len(binShape):], dtype=float)
+                    dset[start:stop] = value
+        fout.flush()
+        logger.info('Post-processed {} bins of {} in {:.1f}s.'.format(int(np.prod(binShape)), detname, time.time()-tstart))
+    return
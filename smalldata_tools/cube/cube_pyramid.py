@@ -0,0 +1,189 @@
+"""
+Multiresolution pyramid of a cube file for interactive browsing.
+
+A level is the cube downsampled by a factor (2, 4, 8) along the bin axis and/or
+along the other (detector) axes. The cube holds sums, so a level sums the bins &
+pixels it combines: sums & counts stay consistent and <var>/nEntries is still the
+mean. std datasets are averaged instead. Levels are built on demand, only for the
+requested variable, block-wise from the finest level already available (the cube
+itself or a finer level) and kept in a file next to the cube (<cube>_pyramid.h5).
+The pyramid is dropped & rebuilt when the cube file changes.
+
+layout:
+    /b<binFactor>_s<spatialFactor>/<var>    variable at this level (attr complete)
+    attrs: cubeSize, cubeMtime               cube file the pyramid was built from
+
+usage:
+    pyramid = CubePyramid(cubeFileName)
+    binFactor, spatialFactor = pyramid.pickLevel('epix_data', aimSize=4000000)
+    data = pyramid.read('epix_data', binFactor, spatialFactor)
+"""
+import os
+import time
+import logging
+import numpy as np
+import h5py
+
+logger = logging.getLogger(__name__)
+
+pyramidFactors = [1, 2, 4, 8]
+
+def pyramidFileName(cubeFile):
+    return cubeFile.replace('.h5','')+'_pyramid.h5'
+
+def isStd(name):
+    return name.startswith('std_') or name.endswith('_std')
+
+def _levelName(binFactor, spatialFactor):
+    return 'b%d_s%d'%(binFactor, spatialFactor)
+
+def downsample(data, factor, axes, average=False):
+    """ sum (or average) groups of factor entries along the axes, the last group can be shorter """
+    for ax in axes:
+        nOld = data.shape[ax]
+        if factor<=1 or nOld<=1:
+            continue
+        starts = np.arange(0, nOld, factor)
+        data = np.add.reduceat(data, starts, axis=ax)
+        if average:
+            counts = np.diff(np.append(starts, nOld)).astype(float)
+            data = data/counts.reshape((-1,)+(1,)*(data.ndim-ax-1))
+    return data
+
+class CubePyramid(object):
+    """
+    parameters: cubeFile: cube file
+                fname: pyramid file (def: <cube>_pyramid.h5)
+                factors: downsampling factors of the levels
+                blockBytes: maximum size of the blocks of bins read at once
+    """
+    def __init__(self, cubeFile, fname=None, factors=pyramidFactors, blockBytes=256*1024*1024):
+        self.cubeFile = cubeFile
+        self.fname = fname if fname is not None else pyramidFileName(cubeFile)
+        self.factors = sorted(set([1]+list(factors)))
+        self.blockBytes = blockBytes
+        self.shapes = {}
+        with h5py.File(cubeFile, 'r') as f:
+            nEntries = f['nEntries'].shape if 'nEntries' in f else f['binVar_bins'].shape
+            self.nBins = nEntries[0]
+            self.nBinDims = len(nEntries)
+            self._bins = f['binVar_bins'][()]
+            for name in f.keys():
+                obj = f[name]
+                if not isinstance(obj, h5py.Dataset) or name=='binVar_bins' or name.startswith('bins_') or name.lower().find('cfg')>=0:
+                    continue
+                if len(obj.shape)>0 and obj.shape[0]==self.nBins:
+                    self.shapes[name] = obj.shape
+        self._checkCube()
+
+    def _cubeStamp(self):
+        stat = os.stat(self.cubeFile)
+        return stat.st_size, stat.st_mtime
+
+    def _checkCube(self):
+        """ remove a pyramid built from an older version of the cube """
+        if not os.path.isfile(self.fname):
+            return
+        size, mtime = self._cubeStamp()
+        try:
+            with h5py.File(self.fname, 'r') as f:
+                current = f.attrs.get('cubeSize', -1)==size and f.attrs.get('cubeMtime', -1)==mtime
+        except OSError:
+            current = False
+        if not current:
+            logger.info('Cube {0} changed, rebuild its pyramid'.format(self.cubeFile))
+            os.remove(self.fname)
+
+    def variables(self):
+        return sorted(self.shapes.keys())
+
+    def _spatialAxes(self, var):
+        return list(range(self.nBinDims, len(self.shapes[var])))
+
+    def shape(self, var, binFactor=1, spatialFactor=1):
+        shape = list(self.shapes[var])
+        shape[0] = -(-shape[0]//binFactor)
+        for ax in self._spatialAxes(var):
+            shape[ax] = -(-shape[ax]//spatialFactor)
+        return tuple(shape)
+
+    def size(self, var, binFactor=1, spatialFactor=1):
+        return int(np.prod(self.shape(var, binFactor, spatialFactor)))
+
+    def bins(self, binFactor=1):
+        """ bins of a level: first bin of each group """
+        return self._bins[::binFactor]
+
+    def levels(self, var):
+        """ levels of var available w/o building: (binFactor, spatialFactor) """
+        levels = [(1,1)]
+        if not os.path.isfile(self.fname):
+            return levels
+        with h5py.File(self.fname, 'r') as f:
+            for level in f.keys():
+                if var in f[level] and f[level][var].attrs.get('complete', False):
+                    levels.append(tuple([int(fac[1:]) for fac in level.split('_')]))
+        return levels
+
+    def pickLevel(self, var, aimSize, maxBins=None, perBin=False):
+        """
+        level with the least downsampling (bins first, then the other axes) for which
+        var has at most aimSize entries (in each bin if perBin) & at most maxBins bins.
+        If none is small enough, the coarsest level.
+        """
+        spatialFactors = self.factors if len(self._spatialAxes(var))>0 else [1]
+        for binFactor in self.factors:
+            if maxBins is not None and -(-self.nBins//binFactor)>maxBins:
+                continue
+            for spatialFactor in spatialFactors:
+                size = self.size(var, binFactor, spatialFactor)
+                if perBin:
+                    size = size//self.shape(var, binFactor, spatialFactor)[0]
+                if size<=aimSize:
+                    return binFactor, spatialFactor
+        return self.factors[-1], spatialFactors[-1]
+
+    def read(self, var, binFactor=1, spatialFactor=1, binSel=None):
+        """ var at a level (built if needed), binSel: bins of the level to read (index or slice) """
+        if binSel is None:
+            binSel = slice(None)
+        if (binFactor, spatialFactor)==(1,1):
+            with h5py.File(self.cubeFile, 'r') as f:
+                return f[var][binSel]
+        if (binFactor, spatialFactor) not in self.levels(var):
+            self._build(var, binFactor, spatialFactor)
+        with h5py.File(self.fname, 'r') as f:
+            return f[_levelName(binFactor, spatialFactor)][var][binSel]
+
+    def _build(self, var, binFactor, spatialFactor):
+        tstart = time.time()
+        #finest available level the requested one can be made from
+        sources = [(b, s) for b, s in self.levels(var) if binFactor%b==0 and spatialFactor%s==0]
+        srcBin, srcSpatial = sorted(sources, key=lambda level: level[0]*level[1])[-1]
+        relBin, relSpatial = binFactor//srcBin, spatialFactor//srcSpatial
+        average = isStd(var)
+        size, mtime = self._cubeStamp()
+        with h5py.File(self.fname, 'a') as fout:
+            fout.attrs['cubeSize'] = size
+            fout.attrs['cubeMtime'] = mtime
+            fin = h5py.File(self.cubeFile, 'r') if (srcBin, srcSpatial)==(1,1) else fout
+            src = fin[var] if (srcBin, srcSpatial)==(1,1) else fout[_levelName(srcBin, srcSpatial)][var]
+            dtype = src.dtype if src.dtype.kind=='f' else np.dtype(float)
+            grp = fout.require_group(_levelName(binFactor, spatialFactor))
+            if var in grp:
+                del grp[var]
+            shape = self.shape(var, binFactor, spatialFactor)
+            chunks = (1,)+shape[1:] if len(shape)>2 else None
+            ds = grp.create_dataset(var, shape=shape, dtype=dtype, chunks=chunks)
+            rowBytes = max(1, src.size//max(1, src.shape[0])*src.dtype.itemsize)
+            step = max(1, self.blockBytes//rowBytes//relBin)*relBin
+            for start in range(0, src.shape[0], step):
+                block = np.nan_to_num(src[start:start+step].astype(dtype))
+                block = downsample(block, relBin, [0], average=average)
+                block = downsample(block, relSpatial, self._spatialAxes(var), average=average)
+                ds[start//relBin:start//relBin+block.shape[0]] = block
+            ds.attrs['complete'] = True
+            if fin is not fout:
+                fin.close()
+        logger.info('Built level {0} of {1} from level {2} in {3:.1f} s'.format(_levelName(binFactor, spatialFactor), var,
+                                                                             _levelName(srcBin, srcSpatial), time.time()-tstart))
@@ -0,0 +1,240 @@
+"""
+Incremental cube store: combine the cubes of many runs without reprocessing them.
+
+The store keeps per-bin accumulators for each cube variable:
+    sums:   the summed data of the cube files (<var>, <det>_data, ...)
+    counts: nEntries & <det>_nEntries
+    m2:     sum of squared deviations from the mean (for variables with std_<var>/<det>_std)
+The sum of squared deviations is used instead of the sum of squares as it can be
+merged without loss of precision (Chan et al.).
+
+Cubes are grouped by their bin definition (bin coordinates of the cube file & cube
+name), each definition is a group of the store file named by a hash of the bins.
+Adding a run reads its cube file once (in blocks of bins) and adds it to the
+accumulators of its bin definition, the runs & their cube files are recorded.
+The updated accumulators are written to a staging group and only replace the
+current ones once all of them are written, a failed update leaves the store as
+it was. The store file reuses the space of the replaced accumulators.
+
+layout:
+    /<key>/bins/<coordinate>          bin coordinates (binVar_bins, bins_*)
+    /<key>/<var>                      sums & counts
+    /<key>/m2/<var>                   sum of squared deviations of <var>, attrs: count
+    /<key>/runs                       runs in the cube, attrs: cubeName, files
+
+usage:
+    store = CubeStore('Cube_store_xpplv1234.h5')
+    store.addRun(cubeFileName, run, cubeName='delay_on')
+    store.writeCube(store.keys()[0], 'Cube_xpplv1234_combined.h5')
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import h5py
+from smalldata_tools.utilities import mergeMoments
+
+logger = logging.getLogger(__name__)
+
+def _isCoordinate(name):
+    return name=='binVar_bins' or name.startswith('bins_')
+
+def _isCount(name):
+    return name=='nEntries' or name.endswith('_nEntries')
+
+def _stdPair(name):
+    """ sum & count dataset names belonging to a std dataset, None if it is not a std """
+    if name.startswith('std_'):
+        return name[4:], 'nEntries'
+    if name.endswith('_std'):
+        return name[:-4]+'_data', name[:-4]+'_nEntries'
+    return None
+
+def binDefinition(cubeFile, cubeName=''):
+    """ key (hash of the bins & cube name, e.g. to keep on & off cubes apart) & coordinates of the bins of a cube file """
+    coords = {}
+    with h5py.File(cubeFile, 'r') as f:
+        for name in f.keys():
+            if isinstance(f[name], h5py.Dataset) and _isCoordinate(name):
+                coords[name] = f[name][()]
+    digest = hashlib.sha1(cubeName.encode())
+    for name in sorted(coords.keys()):
+        digest.update(name.encode())
+        digest.update(np.round(np.asarray(coords[name], dtype=float), 9).tobytes())
+    return digest.hexdigest()[:16], coords
+
+class CubeStore(object):
+    """
+    parameters: fname: store file (created at the first run added)
+                blockBytes: maximum size of the blocks of bins read at once
+    """
+    def __init__(self, fname, blockBytes=256*1024*1024):
+        self.fname = fname
+        self.blockBytes = blockBytes
+
+    def keys(self):
+        """ bin definitions in the store """
+        if not os.path.isfile(self.fname):
+            return []
+        with h5py.File(self.fname, 'r') as f:
+            return list(f.keys())
+
+    def runs(self, key):
+        """ runs added to the cube of a bin definition """
+        with h5py.File(self.fname, 'r') as f:
+            return f[key]['runs'][:].tolist() if key in f else []
+
+    def provenance(self, key):
+        """ runs, their cube files & when they were added """
+        with h5py.File(self.fname, 'r') as f:
+            grp = f[key]
+            return {'cubeName': grp['runs'].attrs['cubeName'], 'runs': grp['runs'][:].tolist(),
+                    'files': json.loads(grp['runs'].attrs['files']), 'added': grp['runs'].attrs['added'].tolist()}
+
+    def _variables(self, fin, nBins):
+        """
+        per-bin datasets of a cube file: sums, counts & std ({std: (sum, count)}).
+        The count of a std needs the bin shape of the std: <det>_nEntries stay flat in
+        cubes with several bin dimensions, nEntries is used for those.
+        """
+        sums, counts, stds = [], [], {}
+        names = [name for name in fin.keys() if isinstance(fin[name], h5py.Dataset) and not _isCoordinate(name)
+                 and name.lower().find('cfg')<0 and name!='cubeSelection'
+                 and len(fin[name].shape)>0 and fin[name].shape[0]==nBins]
+        for name in names:
+            if _isCount(name):
+                counts.append(name)
+        for name in names:
+            if _isCount(name):
+                continue
+            pair = _stdPair(name)
+            if pair is None or pair[0] not in names:
+                sums.append(name)
+                continue
+            shape = fin[name].shape
+            for countName in [pair[1], 'nEntries']:
+                if countName in counts and shape[:fin[countName].ndim]==fin[countName].shape:
+                    stds[name] = (pair[0], countName)
+                    break
+            else:
+                print('No number of events in the bins of %s, will not add it'%name)
+        return sums, counts, stds
+
+    def _blocks(self, ds):
+        rowBytes = max(1, ds.size//max(1, ds.shape[0])*ds.dtype.itemsize)
+        step = max(1, self.blockBytes//rowBytes)
+        return [slice(start, min(start+step, ds.shape[0])) for start in range(0, ds.shape[0], step)]
+
+    def _open(self):
+        """ store file, new files keep track of the free space to reuse the space of replaced datasets """
+        if not os.path.isfile(self.fname):
+            h5py.File(self.fname, 'w-', fs_strategy='fsm', fs_persist=True).close()
+        return h5py.File(self.fname, 'a')
+
+    def addRun(self, cubeFile, run, cubeName=''):
+        """
+        add the cube of a run to the store, returns the key of its bin definition
+        (None if the run is already in the store or the cube does not match)
+        """
+        tstart = time.time()
+        key, coords = binDefinition(cubeFile, cubeName)
+        if 'binVar_bins' not in coords:
+            print('Cube file %s has no bins (binVar_bins), will not add it'%cubeFile)
+            return None
+        nBins = coords['binVar_bins'].shape[0]
+        with h5py.File(cubeFile, 'r') as fin, self._open() as fstore:
+            sums, counts, stds = self._variables(fin, nBins)
+            newKey = key not in fstore
+            if newKey:
+                grp = fstore.create_group(key)
+                for name, value in coords.items():
+                    grp.create_dataset('bins/%s'%name, data=value)
+                grp.create_dataset('runs', shape=(0,), maxshape=(None,), dtype=int)
+                grp['runs'].attrs['cubeName'] = cubeName
+                grp['runs'].attrs['files'] = json.dumps([])
+                grp['runs'].attrs['added'] = np.zeros(0)
+                #configuration of the first run
+                cfg = grp.create_group('cfg')
+                for name in fin.keys():
+                    if name.lower().find('cfg')>=0 or name=='cubeSelection':
+                        fin.copy(name, cfg, name=name)
+            grp = fstore[key]
+            if int(run) in grp['runs'][:].tolist():
+                print('Run %s is already in the cube %s, will not add it again'%(run, key))
+                return None
+            for name in sums+counts+list(stds.keys()):
+                storeName = 'm2/%s'%name if name in stds else name
+                if storeName in grp and grp[storeName].shape!=fin[name].shape:
+                    print('Shape of %s in %s does not match the store: %s vs %s'%(name, cubeFile, fin[name].shape, grp[storeName].shape))
+                    return None
+            #left over from an update that did not finish
+            if 'staging' in grp:
+                del grp['staging']
+            staging = grp.create_group('staging')
+            try:
+                #sums of squared deviations, they need the sums & counts before this run
+                for name, (sumName, countName) in stds.items():
+                    dsM2 = staging.create_dataset('m2/%s'%name, shape=fin[name].shape, dtype=float)
+                    dsM2.attrs['count'] = countName
+                    for sel in self._blocks(fin[name]):
+                        n_b = fin[countName][sel].astype(float)
+                        n_b = n_b.reshape(n_b.shape+(1,)*(fin[name].ndim-n_b.ndim))
+                        sum_b = np.nan_to_num(fin[sumName][sel].astype(float))
+                        m2_b = np.where(n_b>0, np.nan_to_num(fin[name][sel].astype(float))**2*n_b, 0)
+                        if 'm2/%s'%name in grp:
+                            n_a = grp[countName][sel].reshape(n_b.shape)
+                            dsM2[sel] = mergeMoments(n_a, grp[sumName][sel], grp['m2/%s'%name][sel], n_b, sum_b, m2_b)
+                        else:
+                            dsM2[sel] = m2_b
+                for name in sums+counts:
+                    ds = staging.create_dataset(name, shape=fin[name].shape, dtype=float)
+                    for sel in self._blocks(fin[name]):
+                        previous = grp[name][sel] if name in grp else 0.
+                        ds[sel] = previous+np.nan_to_num(fin[name][sel].astype(float))
+            except Exception:
+                del grp['staging']
+                if newKey:
+                    del fstore[key]
+                raise
+            #all accumulators are written: replace the current ones
+            for name in ['m2/%s'%name for name in stds]+sums+counts:
+                if name in grp:
+                    del grp[name]
+                if name.startswith('m2/'):
+                    grp.require_group('m2')
+                grp.move('staging/%s'%name, name)
+            del grp['staging']
+            runs = grp['runs']
+            runs.resize(runs.shape[0]+1, axis=0)
+            runs[-1] = int(run)
+            runs.attrs['files'] = json.dumps(json.loads(runs.attrs['files'])+[os.path.abspath(cubeFile)])
+            runs.attrs['added'] = np.append(runs.attrs['added'], time.time())
+            nRuns = runs.shape[0]
+        print('Added run %s to cube %s (%d runs) in %.1f s'%(run, key, nRuns, time.time()-tstart))
+        return key
+
+    def writeCube(self, key, outName):
+        """ write the combined cube of a bin definition as cube file (sums, counts & std) """
+        with h5py.File(self.fname, 'r') as fstore, h5py.File(outName, 'w') as fout:
+            grp = fstore[key]
+            for name in grp['bins'].keys():
+                fout.create_dataset(name, data=grp['bins'][name][()])
+            if 'cfg' in grp:
+                for name in grp['cfg'].keys():
+                    grp['cfg'].copy(name, fout, name=name)
+            for name in grp.keys():
+                if isinstance(grp[name], h5py.Dataset) and name!='runs':
+                    grp.copy(name, fout, name=name)
+            if 'm2' in grp:
+                for name in grp['m2'].keys():
+                    countName = grp['m2'][name].attrs.get('count', _stdPair(name)[1])
+                    ds = fout.create_dataset(name, shape=grp['m2'][name].shape, dtype=float)
+                    for sel in self._blocks(grp['m2'][name]):
+                        n = grp[countName][sel]
+                        n = n.reshape(n.shape+(1,)*(ds.ndim-n.ndim))
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                            ds[sel] = np.sqrt(grp['m2'][name][sel]/n)
+            fout.create_dataset('runs', data=grp['runs'][:])
+        print('Wrote cube of %d runs to %s'%(len(self.runs(key)), outName))
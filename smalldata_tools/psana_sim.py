@@ -0,0 +1,615 @@
+"""
+Synthetic stand-in for the parts of psana (LCLS-I) used by smalldata_tools.
+
+It mimics DataSource/MPIDataSource, DetNames, Detector and the event/env/configStore
+objects closely enough to run DetObject (epix100, Jungfrau 1M and Epix10k2M), the
+default detectors (EVR event codes, ipm/gas/ebeam BLD, EPICS PVs) and the analysis
+functions without xtc data, e.g. for benchmarks and tests.
+
+usage:
+    from smalldata_tools import psana_sim
+    psana = psana_sim.install(areaDets=['jungfrau1M'], nEvents=100)
+    #import DetObject & friends only after install()
+    from smalldata_tools.DetObject import DetObject
+    ds = psana.DataSource('exp=xpptst01:run=1:smd')
+    det = DetObject('jungfrau1M', ds.env(), 1)
+
+Frames are pedestal + per-row common mode + gaussian noise + poisson distributed
+photons on a powder ring, the photon rate scales with the simulated pulse energy
+that is also seen by the ipm/gas detectors. Everything is seeded, the same
+(seed, run, event, detector) always gives the same frame.
+"""
+import sys
+import types
+import zlib
+import numpy as np
+
+###
+# detector specifications. Shapes & constants follow the real detectors, calib
+# is in ADU for epix100 and keV (raw/gain) for the gain switching detectors like in psana.
+###
+areaDetSpecs = {
+    'epix100': {'dettype': 13, 'src': 'XppGon.0:Epix100a.0', 'shape': (704,768), 'nGains': 1,
+                'tiles': (1,1), 'pixelSize': 50., 'gap': 0., 'ped': 1500., 'rms': 4.,
+                'aduPerKeV': 150./9.5, 'cmRms': 8.},
+    'jungfrau1M': {'dettype': 26, 'src': 'XppEndstation.0:Jungfrau.0', 'shape': (2,512,1024), 'nGains': 3,
+                   'tiles': (2,1), 'pixelSize': 75., 'gap': 1000., 'ped': 3000., 'rms': 10.,
+                   'aduPerKeV': 40., 'cmRms': 4.},
+    'epix10k2M': {'dettype': 32, 'src': 'XcsEndstation.0:Epix10ka2M.0', 'shape': (16,352,384), 'nGains': 7,
+                  'tiles': (4,4), 'pixelSize': 100., 'gap': 2000., 'ped': 2500., 'rms': 5.,
+                  'aduPerKeV': 16.5, 'cmRms': 3.},
+}
+
+#evr codes as used in xpp/xcs: 162: x-ray off (BYKIK), 90/91: laser on/off
+evrCodes = {'base': [40, 140], 'xrayOff': 162, 'laserOn': 90, 'laserOff': 91}
+
+class _SimConfig(object):
+    def __init__(self, areaDets=None, nEvents=100, seed=0, expname='xpptst01', run=1,
+                 photonEnergy=9.5, occupancy=2e-3, dropRate=10, laserRate=2, epicsPVs=None):
+        self.areaDets = list(areaDetSpecs.keys()) if areaDets is None else list(areaDets)
+        for alias in self.areaDets:
+            if alias not in areaDetSpecs:
+                raise ValueError('no simulated detector %s, choose from %s'%(alias, list(areaDetSpecs.keys())))
+        self.nEvents = nEvents
+        self.seed = seed
+        self.expname = expname
+        self.run = run
+        self.photonEnergy = photonEnergy
+        self.occupancy = occupancy
+        self.dropRate = dropRate
+        self.laserRate = laserRate
+        if epicsPVs is None:
+            epicsPVs = {'lxt': 'LAS:FS3:VIT:FS_TGT_TIME', 'att_T': 'XPP:ATT:COM:R_CUR', 'gon_x': 'XPP:GON:MMS:01'}
+        self.epicsPVs = epicsPVs
+        self.ipms = {'XppSb2_Ipm': 'ipm2', 'XppSb3_Ipm': 'ipm3'}
+        self.bld = ['FEEGasDetEnergy', 'EBeam']
+        self.evrName = 'NoDetector.0:Evr.0'
+        self._detectors = {}
+
+_config = _SimConfig()
+_currentEvent = None
+
+def configure(**kwargs):
+    """ (re)define the simulated run, see _SimConfig for parameters """
+    global _config
+    _config = _SimConfig(**kwargs)
+    return _config
+
+def install(force=False, **kwargs):
+    """
+    configure the simulation and register it as the psana & Detector modules.
+    Needs to be called before modules importing psana are imported.
+    parameters: force: replace a real psana that is already imported
+                kwargs: passed to configure (areaDets, nEvents, seed, occupancy, ...)
+    returns the module to be used as psana
+    """
+    thisModule = sys.modules[__name__]
+    if 'psana' in sys.modules and sys.modules['psana'] is not thisModule and not force:
+        print('psana has already been imported, will not replace it by the simulation')
+        return sys.modules['psana']
+    configure(**kwargs)
+    sys.modules['psana'] = thisModule
+    detTypes = types.ModuleType('Detector')
+    detTypes.GenericWFDetector = types.ModuleType('Detector.GenericWFDetector')
+    detTypes.GenericWFDetector.GenericWFDetector = GenericWFDetector
+    sys.modules['Detector'] = detTypes
+    sys.modules['Detector.GenericWFDetector'] = detTypes.GenericWFDetector
+    #DetObject imports read_uxi which needs krtc (kerberos for the web services)
+    try:
+        import krtc
+    except ImportError:
+        krtc = types.ModuleType('krtc')
+        krtc.KerberosTicket = KerberosTicket
+        sys.modules['krtc'] = krtc
+    return thisModule
+
+class KerberosTicket(object):
+    """ stand-in for krtc.KerberosTicket, the simulation does not use the web services """
+    def __init__(self, service=''):
+        self.service = service
+    def getAuthHeaders(self):
+        return {}
+
+def _detSeed(*args):
+    return zlib.crc32(('_'.join([str(a) for a in args])).encode())
+
+###
+# psana types: configStore().get() & evt.get() are called with psana types,
+# e.g. psana.Epix.Config100aV2. Unknown types are created on the fly, so lookups
+# for data that is not simulated return None like for a missing detector.
+###
+class _TypeNamespace(object):
+    def __init__(self, name):
+        self._name = name
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        simType = type(name, (object,), {'__module__': 'psana.%s'%self._name})
+        setattr(self, name, simType)
+        return simType
+
+_typeNamespaces = {}
+def __getattr__(name):
+    #module level getattr (PEP 562): psana.Epix, psana.TimeTool, psana.Bld ...
+    if name.startswith('__') or not name[0].isupper():
+        raise AttributeError(name)
+    if name not in _typeNamespaces:
+        _typeNamespaces[name] = _TypeNamespace(name)
+    return _typeNamespaces[name]
+
+class EventId(object):
+    def __init__(self, evtIdx, run):
+        self._sec = 1600000000 + run*10000 + evtIdx//120
+        self._nsec = int((evtIdx%120)*1e9/120)
+        self._fiducial = (evtIdx*3)%131040
+    def time(self):
+        return (self._sec, self._nsec)
+    def fiducials(self):
+        return self._fiducial
+    def idxtime(self):
+        return self
+
+class Source(object):
+    def __init__(self, name=''):
+        self._name = name
+    def __repr__(self):
+        return self._name
+    def __str__(self):
+        return self._name
+    def __eq__(self, other):
+        return str(self) == str(other)
+    def __hash__(self):
+        return hash(self._name)
+
+class _Key(object):
+    def __init__(self, src, alias='', keyType=None):
+        self._src = Source(src)
+        self._alias = alias
+        self._type = keyType
+    def src(self):
+        return self._src
+    def alias(self):
+        return self._alias
+    def type(self):
+        return self._type
+
+###
+# configuration objects
+###
+class _Epix100Config(object):
+    def carrierId0(self): return 0x1a2b3c4d
+    def carrierId1(self): return 0x5e6f
+    def digitalCardId0(self): return 0x1111
+    def digitalCardId1(self): return 0x2222
+    def analogCardId0(self): return 0x3333
+    def analogCardId1(self): return 0x4444
+
+class _Epix10kAsicConfig(object):
+    def trbit(self): return 1
+
+class _Epix10kElemConfig(object):
+    def __init__(self, i, tileShape):
+        self._i = i
+        self._tileShape = tileShape
+    def carrierId0(self): return 0x1000+self._i
+    def carrierId1(self): return 0x2000+self._i
+    def asicPixelConfigArray(self):
+        #bit 0x4 set: high gain (with trbit=1)
+        return np.full(self._tileShape, 12, dtype=np.uint8)
+    def asics_shape(self): return (4,)
+    def asics(self, i): return _Epix10kAsicConfig()
+
+class _Epix10k2MConfig(object):
+    def __init__(self, shape):
+        self._shape = shape
+    def elemCfg_shape(self): return (self._shape[0],)
+    def elemCfg(self, i): return _Epix10kElemConfig(i, self._shape[1:])
+    def numberOfElements(self): return self._shape[0]
+
+class _EvrConfig(object):
+    def neventcodes(self): return 24
+
+class ConfigStore(object):
+    def __init__(self, config):
+        self._config = config
+    def keys(self):
+        keys = [_Key(areaDetSpecs[alias]['src'], alias) for alias in self._config.areaDets]
+        keys += [_Key(self._config.evrName, 'evr0')]
+        keys += [_Key('BldInfo(%s)'%name, alias) for name, alias in self._config.ipms.items()]
+        keys += [_Key('BldInfo(%s)'%name) for name in self._config.bld]
+        return keys
+    def get(self, cfgType, src=None):
+        alias = _aliasFromSource(self._config, src)
+        if alias is None:
+            return None
+        spec = areaDetSpecs[alias]
+        typeName = getattr(cfgType, '__name__', '')
+        if spec['dettype'] == 13 and typeName == 'Config100aV2':
+            return _Epix100Config()
+        if spec['dettype'] in [32,33] and typeName in ['Config10ka2MV1', 'Config10ka2MV2', 'Config10kaQuadV1', 'Config10kaQuadV2']:
+            return _Epix10k2MConfig(spec['shape'])
+        return None
+
+def _aliasFromSource(config, src):
+    if src is None:
+        return None
+    srcName = str(src)
+    for alias in config.areaDets:
+        if srcName in [alias, areaDetSpecs[alias]['src'], 'DetInfo(%s)'%areaDetSpecs[alias]['src']]:
+            return alias
+    return None
+
+class Env(object):
+    def __init__(self, config):
+        self._config = config
+        self._configStore = ConfigStore(config)
+    def configStore(self):
+        return self._configStore
+    def experiment(self):
+        return self._config.expname
+    def instrument(self):
+        return self._config.expname[:3].upper()
+    def calibDir(self):
+        return '/tmp/%s/calib'%self._config.expname
+    def fwkName(self):
+        return 'psana'
+
+###
+# events: the beam parameters are drawn once per event, the area detector
+# frames are generated on first access and then kept with the event.
+###
+class Event(object):
+    def __init__(self, config, evtIdx):
+        self._config = config
+        self.evtIdx = evtIdx
+        self._eventId = EventId(evtIdx, config.run)
+        rng = np.random.default_rng(_detSeed(config.seed, config.run, evtIdx, 'beam'))
+        self.xrayOn = not (config.dropRate > 0 and evtIdx%config.dropRate == config.dropRate-1)
+        self.laserOn = not (config.laserRate > 0 and evtIdx%config.laserRate == 1)
+        #SASE-like fluctuations of the pulse energy (mJ)
+        self.pulseEnergy = rng.gamma(4., 0.5) if self.xrayOn else 0.
+        self.beamPos = rng.normal(0., 0.1, 2)
+        self._frames = {}
+    def get(self, evtType, src=None):
+        if evtType is EventId:
+            return self._eventId
+        return None
+    def keys(self):
+        keys = [_Key(areaDetSpecs[alias]['src'], alias) for alias in self._config.areaDets]
+        keys += [_Key(self._config.evrName, 'evr0')]
+        if self.xrayOn:
+            keys += [_Key('BldInfo(%s)'%name, alias) for name, alias in self._config.ipms.items()]
+            keys += [_Key('BldInfo(%s)'%name) for name in self._config.bld]
+        return keys
+    def run(self):
+        return self._config.run
+
+class _SimSmallData(object):
+    """ minimal stand-in for MPIDataSource.small_data: counts, does not write """
+    def __init__(self, filename=None, gather_interval=100):
+        self.filename = filename
+        self.gather_interval = gather_interval
+        self.nEvents = 0
+        self.saved = {}
+    def event(self, *args, **kwargs):
+        self.nEvents += 1
+    def save(self, *args, **kwargs):
+        for arg in args:
+            if isinstance(arg, dict):
+                self.saved.update(arg)
+        self.saved.update(kwargs)
+    def sum(self, value):
+        return value
+    def close(self):
+        pass
+
+class Run(object):
+    def __init__(self, ds):
+        self._ds = ds
+    def run(self):
+        return self._ds._config.run
+    def events(self):
+        return self._ds.events()
+    def env(self):
+        return self._ds.env()
+
+class DataSource(object):
+    """ parameters: dsname: e.g. 'exp=xpptst01:run=3:smd', run & exp overwrite the configured values """
+    def __init__(self, dsname='', **kwargs):
+        config = _config
+        for tok in dsname.split(':'):
+            if tok.startswith('exp='):
+                config.expname = tok.replace('exp=','')
+            elif tok.startswith('run='):
+                config.run = int(tok.replace('run=','').split(',')[0])
+        self._config = config
+        self._env = Env(config)
+        self._currevt = None
+        self._breakAfter = None
+    def env(self):
+        return self._env
+    def runs(self):
+        yield Run(self)
+    def events(self):
+        global _currentEvent
+        nEvents = self._config.nEvents
+        if self._breakAfter is not None:
+            nEvents = min(nEvents, self._breakAfter)
+        for evtIdx in range(nEvents):
+            evt = Event(self._config, evtIdx)
+            self._currevt = evt
+            _currentEvent = evt
+            yield evt
+
+class MPIDataSource(DataSource):
+    def __init__(self, dsname='', **kwargs):
+        super(MPIDataSource, self).__init__(dsname, **kwargs)
+        self.rank = 0
+        self.size = 1
+    def break_after(self, n):
+        self._breakAfter = n
+    def small_data(self, filename=None, gather_interval=100, **kwargs):
+        return _SimSmallData(filename, gather_interval)
+
+def DetNames(which='detectors'):
+    """ list of (full name, alias, data source alias) tuples as psana.DetNames """
+    config = _config
+    if which == 'epics':
+        return [(pv, alias, '') for alias, pv in config.epicsPVs.items()]
+    names = [(areaDetSpecs[alias]['src'], alias, '') for alias in config.areaDets]
+    names.append((config.evrName, 'evr0', ''))
+    names += [(name, alias, '') for name, alias in config.ipms.items()]
+    names += [(name, '', '') for name in config.bld]
+    if which == 'all':
+        names += DetNames('epics')
+    return names
+
+def Detector(name, *args):
+    config = _config
+    if name in config._detectors:
+        return config._detectors[name]
+    det = None
+    for alias in config.areaDets:
+        if name in [alias, areaDetSpecs[alias]['src']]:
+            det = AreaDetector(alias, config)
+    if name in [config.evrName, 'evr0']:
+        det = EvrDetector(config)
+    elif name in config.ipms or name in config.ipms.values():
+        det = IpmDetector(name, config)
+    elif name == 'FEEGasDetEnergy':
+        det = BldDetector(name, config, _GasData)
+    elif name == 'EBeam':
+        det = BldDetector(name, config, _EBeamData)
+    elif name in config.epicsPVs or name in config.epicsPVs.values():
+        det = EpicsDetector(name, config)
+    if det is None:
+        raise KeyError('Detector %s is not part of the simulated data'%name)
+    config._detectors[name] = det
+    return det
+
+###
+# area detectors
+###
+class AreaDetector(object):
+    def __init__(self, alias, config):
+        spec = areaDetSpecs[alias]
+        self.alias = alias
+        self.name = alias
+        self.dettype = spec['dettype']
+        self.source = Source(spec['src'])
+        self._config = config
+        self._spec = spec
+        self._shape = spec['shape']
+        self._nGains = spec['nGains']
+        rng = np.random.default_rng(_detSeed(config.seed, alias, 'constants'))
+        ped = spec['ped'] + rng.normal(0., spec['ped']*0.05, self._shape)
+        rms = np.abs(spec['rms']*(1.+0.1*rng.standard_normal(self._shape)))
+        if self._nGains > 1:
+            #higher gain ranges have lower pedestals & gains
+            self._ped = np.array([ped*(1.-0.1*ig) for ig in range(self._nGains)]).astype(np.float32)
+            self._rms = np.array([rms/(1.+ig) for ig in range(self._nGains)]).astype(np.float32)
+            self._gain = np.array([np.full(self._shape, spec['aduPerKeV']/(10.**ig)) for ig in range(self._nGains)]).astype(np.float32)
+        else:
+            self._ped = ped.astype(np.float32)
+            self._rms = rms.astype(np.float32)
+            self._gain = np.ones(self._shape, dtype=np.float32)
+        self._status = np.zeros(self._shape, dtype=np.uint16)
+        self._status.flat[rng.choice(self._status.size, self._status.size//1000, replace=False)] = 1
+        self._setGeometry()
+        #photon rate per pixel: flat background plus a powder ring
+        r = np.hypot(self._x, self._y)
+        rRing = 0.4*r.max()
+        self._photonRate = (config.occupancy*(0.2 + 5.*np.exp(-0.5*((r-rRing)/(0.02*r.max()))**2))).astype(np.float32)
+
+    def _setGeometry(self):
+        """ tiles on a regular grid with gaps, centered around the beam """
+        spec = self._spec
+        tShape = self._shape[-2:]
+        nTiles = int(np.prod(self._shape[:-2])) if len(self._shape) > 2 else 1
+        pix = spec['pixelSize']
+        tileX, tileY = np.meshgrid(np.arange(tShape[0])*pix, np.arange(tShape[1])*pix, indexing='ij')
+        x = []
+        y = []
+        for it in range(nTiles):
+            row, col = divmod(it, spec['tiles'][1])
+            x.append(tileX + row*(tShape[0]*pix+spec['gap']))
+            y.append(tileY + col*(tShape[1]*pix+spec['gap']))
+        x = np.array(x).reshape(self._shape)
+        y = np.array(y).reshape(self._shape)
+        self._x = x - 0.5*(x.max()+x.min())
+        self._y = y - 0.5*(y.max()+y.min())
+        self._z = np.zeros(self._shape)
+        self._ix = np.round((self._x-self._x.min())/pix).astype(int)
+        self._iy = np.round((self._y-self._y.min())/pix).astype(int)
+        self._imgShape = (self._ix.max()+1, self._iy.max()+1)
+
+    #constants: all take the run (or event) as argument like psana.
+    def pedestals(self, run): return self._ped.copy()
+    def rms(self, run): return self._rms.copy()
+    def gain(self, run): return self._gain.copy()
+    def gain_mask(self, run, gain=None): return None
+    def offset(self, run): return np.zeros_like(self._ped)
+    def status(self, run): return self._status.copy()
+    def common_mode(self, run): return np.array([7,0,10]) if self._nGains>1 else np.array([6,0,0])
+    def coords_x(self, run): return self._x.copy()
+    def coords_y(self, run): return self._y.copy()
+    def coords_z(self, run): return self._z.copy()
+    def indexes_xy(self, run): return self._ix.copy(), self._iy.copy()
+    def shape(self, run=None): return self._shape
+    def size(self, run=None): return int(np.prod(self._shape))
+    def ndim(self, run=None): return len(self._shape)
+
+    def mask(self, run, calib=False, status=False, edges=False, central=False, unbond=False, unbondnbrs=False, **kwargs):
+        mask = np.ones(self._shape, dtype=np.uint8)
+        if status:
+            mask[self._status>0] = 0
+        if edges:
+            mask[...,0,:] = 0
+            mask[...,-1,:] = 0
+            mask[...,:,0] = 0
+            mask[...,:,-1] = 0
+        return mask
+
+    def image(self, evt_or_run, nda_in=None, **kwargs):
+        if nda_in is None:
+            nda_in = self.calib(evt_or_run)
+        nda_in = np.asarray(nda_in)
+        img = np.zeros(self._imgShape, dtype=nda_in.dtype)
+        img[self._ix, self._iy] = nda_in.reshape(self._shape)
+        return img
+
+    def _frame(self, evt):
+        """ signal in keV and the common mode offsets (ADU) of this event """
+        if self.alias not in evt._frames:
+            spec = self._spec
+            rng = np.random.default_rng(_detSeed(self._config.seed, self._config.run, evt.evtIdx, self.alias))
+            nPhot = rng.poisson(self._photonRate*evt.pulseEnergy) if evt.pulseEnergy > 0 else np.zeros(self._shape, dtype=int)
+            signal = (nPhot*self._config.photonEnergy).astype(np.float32)
+            noise = rng.standard_normal(self._shape, dtype=np.float32)
+            noise *= self._rms if self._nGains == 1 else self._rms[0]
+            cm = rng.normal(0., spec['cmRms'], self._shape[:-1]+(1,)).astype(np.float32)
+            evt._frames[self.alias] = (signal, noise+cm, cm)
+        return evt._frames[self.alias]
+
+    def raw(self, evt):
+        if evt is None:
+            return None
+        signal, noise, cm = self._frame(evt)
+        ped = self._ped if self._nGains == 1 else self._ped[0]
+        raw = ped + noise + signal*self._spec['aduPerKeV']
+        raw = np.clip(raw, 0, 0x3fff if self._nGains > 1 else 0xffff)
+        return raw.astype(np.uint16)
+
+    def raw_data(self, evt):
+        return self.raw(evt)
+
+    def calib(self, evt, cmpars=None, mbits=None, **kwargs):
+        raw = self.raw(evt)
+        if raw is None:
+            return None
+        ped = self._ped if self._nGains == 1 else self._ped[0]
+        dat = raw.astype(np.float32) - ped
+        if cmpars is not None and np.atleast_1d(cmpars)[0] > 0:
+            #per-row median of the pixels without photons, like the psana row common mode
+            rowDat = np.where(dat < 5.*self._spec['rms'], dat, np.nan)
+            cmCorr = np.nanmedian(rowDat, axis=-1, keepdims=True)
+            dat -= np.nan_to_num(cmCorr)
+        if self._nGains > 1:
+            dat /= self._gain[0]
+        if mbits is not None and mbits > 0:
+            dat[self._status>0] = 0
+        return dat
+
+class GenericWFDetector(object):
+    """ placeholder for Detector.GenericWFDetector.GenericWFDetector """
+    pass
+
+###
+# EVR, BLD and EPICS
+###
+class _EvrSource(object):
+    def __init__(self):
+        self._cfg = _EvrConfig()
+    def __getitem__(self, i):
+        return self._cfg
+
+class EvrDetector(object):
+    def __init__(self, config):
+        self._config = config
+        self.source = Source(config.evrName)
+        self.name = config.evrName
+    def _fetch_configs(self):
+        return _EvrSource()
+    def eventCodes(self, evt):
+        if evt is None:
+            return None
+        codes = list(evrCodes['base'])
+        if not evt.xrayOn:
+            codes.append(evrCodes['xrayOff'])
+        codes.append(evrCodes['laserOn'] if evt.laserOn else evrCodes['laserOff'])
+        return codes
+
+class IpmDetector(object):
+    def __init__(self, name, config):
+        self._config = config
+        self.name = name
+        self.source = Source('BldInfo(%s)'%name)
+        self._response = 1.+0.1*(_detSeed(name)%10)
+    def channel(self, evt):
+        if evt is None or not evt.xrayOn:
+            return None
+        rng = np.random.default_rng(_detSeed(self._config.seed, evt.evtIdx, self.name))
+        x, y = evt.beamPos
+        weights = np.array([1.+x, 1.-x, 1.+y, 1.-y])*0.25
+        return evt.pulseEnergy*self._response*weights*(1.+0.02*rng.standard_normal(4))
+    def sum(self, evt):
+        channels = self.channel(evt)
+        return None if channels is None else channels.sum()
+    def xpos(self, evt):
+        return None if evt is None or not evt.xrayOn else evt.beamPos[0]
+    def ypos(self, evt):
+        return None if evt is None or not evt.xrayOn else evt.beamPos[1]
+
+class _GasData(object):
+    def __init__(self, evt):
+        self._e = evt.pulseEnergy
+    def f_11_ENRC(self): return self._e*1.01
+    def f_12_ENRC(self): return self._e*0.99
+    def f_21_ENRC(self): return self._e*1.02
+    def f_22_ENRC(self): return self._e*0.98
+    def f_63_ENRC(self): return self._e
+    def f_64_ENRC(self): return self._e
+
+class _EBeamData(object):
+    def __init__(self, evt):
+        self._e = evt.pulseEnergy
+        self._i = evt.evtIdx
+    def ebeamCharge(self): return 0.25
+    def ebeamL3Energy(self): return 14000.+10.*np.sin(self._i/100.)
+    def ebeamPhotonEnergy(self): return 9500.+5.*np.sin(self._i/100.)
+    def ebeamLTUPosX(self): return 0.
+    def ebeamLTUPosY(self): return 0.
+    def damageMask(self): return 0
+
+class BldDetector(object):
+    def __init__(self, name, config, dataClass):
+        self.name = name
+        self.source = Source('BldInfo(%s)'%name)
+        self._dataClass = dataClass
+    def get(self, evt):
+        if evt is None or not evt.xrayOn:
+            return None
+        return self._dataClass(evt)
+
+class EpicsDetector(object):
+    """ PVs are slowly drifting values, calling the detector returns the value for the current event """
+    def __init__(self, name, config):
+        self._config = config
+        self.name = name
+        self._offset = float(_detSeed(name)%100)
+    def __call__(self, evt=None):
+        if evt is None:
+            evt = _currentEvent
+        if evt is None:
+            return None
+        return self._offset + np.sin(evt.evtIdx/500.)
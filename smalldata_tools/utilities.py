@@ -11,15 +11,12 @@ from scipy.stats import gaussian_kde
 from matplotlib import pyplot as plt
 import resource
 
-from collections import deque
-from itertools import islice
-from bisect import insort, bisect_left
- 
 import xarray as xr
 from numba import jit
 from numba.types import List
 
 import sys
+from smalldata_tools.utilities_rolling import rolling_median
 
 def MAD(a, c=0.6745, axis=None):
     """
@@ -53,38 +50,19 @@ def nanmedian(arr, **kwargs):
     return np.ma.median( np.ma.masked_where(arr!=arr, arr), **kwargs )
     
 def running_median_insort(seq, windowsize=10):
+    """ trailing running median, kept for backwards compatibility """
     isArray= isinstance(seq, np.ndarray)
-    if isArray:
-        seq = seq.tolist()
-    seq = iter(seq)
-    d = deque()
-    s = []
-    result = []
-    for item in islice(seq, windowsize):
-        d.append(item)
-        insort(s, item)
-        result.append(s[len(d)//2])
-    m = windowsize // 2
-    for item in seq:
-        old = d.popleft()
-        d.append(item)
-        del s[bisect_left(s, old)]
-        insort(s, item)
-        result.append(s[m])
-    if isArray:
-        result = np.array(result)
+    result = rolling_median(seq, windowsize=windowsize)
+    if not isArray:
+        result = result.tolist()
     return result
 
 def running_median(seq, windowsize=10):
+    """ trailing running median, kept for backwards compatibility """
     isArray= isinstance(seq, np.ndarray)
-    if isArray:
-        seq = seq.tolist()
-    result=[]
-    for ipseq,pseq in enumerate(seq):
-        seqMin = max(0,ipseq-windowsize+1)
-        result.append(np.median(seq[seqMin:ipseq+1]))
-    if isArray:
-        result = np.array(result)
+    result = rolling_median(seq, windowsize=windowsize)
+    if not isArray:
+        result = result.tolist()
     return result
     
 def rebinFactor(a, shape):
@@ -719,80 +697,156 @@ def shapeFromKey_h5(fh5, thiskey):
         return fh5.get_node(thiskey).shape
 
 
-def rename_reduceRandomVar(outFileName):
+def mergeMoments(n_a, sum_a, m2_a, n_b, sum_b, m2_b):
+    """
+    sum of squared deviations from the mean of two sets of events from the number of
+    events, sum & sum of squared deviations of each (Chan et al.). n & sums are added by the caller.
+    """
+    if np.all(n_a==0):
+        return m2_b
+    if np.all(n_b==0):
+        return m2_a
+    n = n_a+n_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(n_b>0, sum_b/np.maximum(n_b,1), 0)-np.where(n_a>0, sum_a/np.maximum(n_a,1), 0)
+        return m2_a+m2_b+np.where((n_a>0)&(n_b>0), delta**2*(n_a*n_b/np.maximum(n,1)), 0)
+
+def combineStd(std, data, nEntries, axis):
+    """
+    std of the events of several bins combined along axis from the std (ddof=0),
+    sum & number of events of each bin
+    """
+    n = nEntries.reshape(nEntries.shape+(1,)*(data.ndim-nEntries.ndim))
+    nTot = n.sum(axis=axis, keepdims=True)
+    #empty bins can have NaN sums
+    data = np.where(n>0, data, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n>0, data/np.maximum(n,1), 0)
+        meanTot = data.sum(axis=axis, keepdims=True)/nTot
+        m2 = np.where(n>0, n*(np.nan_to_num(std)**2+(mean-meanTot)**2), 0)
+        return np.sqrt(m2.sum(axis=axis)/np.squeeze(nTot, axis=axis))
+
+def rename_reduceRandomVar(outFileName, blockBytes=256*1024*1024):
+    """
+    finalize a cube file: rename it from *.inprogress, reshape the flat bin axis to the
+    shape of the bins (nEntries) and sum over the random sub-bin axis (if present).
+    The data is reduced in blocks of bins of at most blockBytes & written into 
+    preallocated datasets. If the random sub-bins are the first axis, the blocks are taken
+    along the second axis (bins or detector). If nothing needs to be reshaped or reduced,
+    the file is renamed.
+    """
     print('rename_reduceRandomVar ',outFileName)
     if outFileName.find('.inprogress')<0:
         print('filename does not end in inprogress, will quit')
         sys.exit()
-    print('Renaming file now from %s to %s'%(outFileName,outFileName.replace('.inprogress','')))
+    finalName = outFileName.replace('.inprogress','')
+    print('Renaming file now from %s to %s'%(outFileName,finalName))
 
     #open file.
     fin = h5py.File(outFileName,'r')
-    fout = h5py.File(outFileName.replace('.inprogress',''),'w')
-            
-    #groups (binning Variables)
+
+    #binning variables of the random sub-bins
     randomNbins=1
+    if 'random' in fin:
+        for kk in fin['random']:
+            randomNbins*=fin['random'][kk].shape[0]
+    nEntryShape=fin['nEntries'].shape
+    nDim=len(nEntryShape)
+    randAxis=None
+    for idc, idim in enumerate(nEntryShape): 
+        if idim==randomNbins:randAxis=idc
+    reduceRandom = randomNbins>1 and randAxis is not None
+
+    dataKeys = [k for k in fin.keys() if not isinstance(fin[k], h5py.Group) and not
+                (k.find('Cfg')>=0 or k=='cubeSelection' or k.find('dim')>=0)]
+    reshapeKeys = [k for k in dataKeys if len(fin[k].shape)>=nDim and fin[k].shape[:nDim]!=nEntryShape]
+    if not reduceRandom and len(reshapeKeys)==0 and 'random' not in fin:
+        fin.close()
+        os.rename(outFileName, finalName)
+        return
+
+    def readBlock(k, start, stop):
+        """ bins start:stop along the first bin axis, in the shape of the bins """
+        if fin[k].shape[:nDim]==nEntryShape:
+            return fin[k][start:stop]
+        nFlat = int(np.prod(nEntryShape[1:]))
+        return fin[k][start*nFlat:stop*nFlat].reshape((stop-start,)+nEntryShape[1:]+fin[k].shape[1:])
+
+    def readColumns(k, start, stop):
+        """ all bins of the first bin axis, start:stop along the second axis (bins or detector) """
+        binShaped = fin[k].shape[:nDim]==nEntryShape
+        if len(fin[k].shape if binShaped else nEntryShape+fin[k].shape[1:])<2:
+            return fin[k][()]
+        if binShaped:
+            return fin[k][:, start:stop]
+        nFlat = int(np.prod(nEntryShape[1:]))
+        nInner = nFlat//nEntryShape[1]
+        block = np.stack([fin[k][i*nFlat+start*nInner:i*nFlat+stop*nInner] for i in range(nEntryShape[0])])
+        return block.reshape((nEntryShape[0], stop-start)+nEntryShape[2:]+fin[k].shape[1:])
+
+    fout = h5py.File(finalName,'w')
     for k in fin.keys():
-        # try:
-        #     print(f'{k} shape: {fin[k].shape}')
-        # except:
-        #     print(f'{k}')
         #deal with groups first. 
         if isinstance(fin[k],  h5py.Group):
             if k!='random':
                 fin.copy(k, fout)
-            else:
-                for kk in fin[k]:
-                    randomNbins*=fin[k][kk].shape[0]
-
         #config & setup have no shape, just copy.
         elif k.find('Cfg')>=0 or k=='cubeSelection':
             fin.copy(k, fout)
 
-    nEntryShape=fin['nEntries'].shape
-    nEntryBinsFlat=1.
-    for idc, idim in enumerate(nEntryShape): 
-        nEntryBinsFlat*=idim
-        if idim==randomNbins:randAxis=idc
-        
-    for k in fin.keys():
-        if isinstance(fin[k], h5py.Group): continue
-        if k.find('Cfg')>=0 or k=='cubeSelection' or k.find('dim')>=0: continue
-        
-        if len(fin[k].shape)>=len(nEntryShape):
-            kShape=tuple([ishp for ishp,nShp in zip(fin[k].shape,nEntryShape)])
-        else:
+    for k in dataKeys:
+        if len(fin[k].shape)<nDim or (k in reshapeKeys and fin[k].shape[0]!=np.prod(nEntryShape)):
             print(f'Cannot determine shape for reshaping {k}: {fin[k].shape} to {nEntryShape}')
             print(f'{k} cannot be reshaped. Save as is. Shape: {fin[k].shape}')
             fin.copy(k, fout)
             continue
+        if k not in reshapeKeys and not reduceRandom:
+            fin.copy(k, fout)
+            continue
 
-        if kShape == nEntryShape:
-            if randomNbins>1 and randomNbins in nEntryShape:
-                # data=fin[k].value.sum(axis=randAxis)
-                data=fin[k][:].sum(axis=randAxis)
-                fout.create_dataset(k, data=data)
-            else:
-                fin.copy(k, fout)
-        else:
-            newShp=list(nEntryShape)
-            for iShp,shp in enumerate(fin[k].shape):
-                if iShp==0: continue
-                newShp.append(shp)
-            newShp=tuple(newShp)
+        newShp = nEntryShape+fin[k].shape[(1 if k in reshapeKeys else nDim):]
+        if k in reshapeKeys:
             print(f'I am reshaping {k}, -- {fin[k].shape} -- {newShp}')
-            # newArray=fin[k].value.reshape(newShp)
-            newArray=fin[k][:].reshape(newShp)
-            if randomNbins>1 and randomNbins in newArray.shape:
-                data=newArray.sum(axis=randAxis)
-                fout.create_dataset(k, data=data)
+        dataKey, nKey = k.replace('_std','_data'), k.replace('_std','_nEntries')
+        isStd = reduceRandom and k.endswith('_std') and dataKey in fin and nKey in fin
+        outShp = newShp
+        if reduceRandom:
+            outShp = newShp[:randAxis]+newShp[randAxis+1:]
+        dset = fout.create_dataset(k, shape=outShp, dtype=fin[k].dtype)
+        if reduceRandom and randAxis==0 and len(newShp)>1:
+            #the random axis is the first: sum it in blocks along the second axis
+            colBytes = max(1, int(np.prod(newShp))//newShp[1]*fin[k].dtype.itemsize)
+            step = max(1, blockBytes//colBytes)
+            for start in range(0, newShp[1], step):
+                stop = min(start+step, newShp[1])
+                block = readColumns(k, start, stop)
+                if isStd:
+                    dset[start:stop] = combineStd(block, readColumns(dataKey, start, stop), readColumns(nKey, start, stop), 0)
+                else:
+                    dset[start:stop] = block.sum(axis=0)
+            continue
+        #the random axis is summed within the blocks (all bins for variables without other axes)
+        rowBytes = max(1, int(np.prod(newShp[1:]))*fin[k].dtype.itemsize)
+        step = nEntryShape[0] if randAxis==0 else max(1, blockBytes//rowBytes)
+        for start in range(0, nEntryShape[0], step):
+            stop = min(start+step, nEntryShape[0])
+            block = readBlock(k, start, stop)
+            if not reduceRandom:
+                dset[start:stop] = block
+                continue
+            if isStd:
+                #std can not be summed, combine with the sums & number of events
+                data = combineStd(block, readBlock(dataKey, start, stop), readBlock(nKey, start, stop), randAxis)
+            else:
+                data = block.sum(axis=randAxis)
+            if randAxis==0:
+                dset[...] = data
             else:
-                fout.create_dataset(k, data=newArray)
+                dset[start:stop] = data
 
     fout.close()
+    fin.close()
     os.remove(outFileName)
-    #for now, rename org file as well.
-    #os.rename(outFileName, outFileName.replace('.inprogress',''))
 
 def getCMpeak(img, nPeakSel=4, minPeakNum=100, ADUmin=-100, ADUmax=200, step=0.5):
     his = np.histogram(img, np.arange(ADUmin, ADUmax, step))
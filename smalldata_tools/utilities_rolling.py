@@ -0,0 +1,140 @@
+import numpy as np
+from numba import jit
+
+###
+# rolling statistics on 1-d arrays.
+# windows are either trailing (event i uses events i-windowsize+1..i)
+# or centered around the event. NaNs are ignored inside the window;
+# if fewer than minPeriods valid values are present, the result is NaN.
+###
+
+def _windowBounds(nPts, windowsize, center):
+    """ return first and last (inclusive) index of the window for each point """
+    idx = np.arange(nPts)
+    if center:
+        stop = idx + (windowsize-1)//2
+    else:
+        stop = idx
+    start = stop - windowsize + 1
+    return np.clip(start, 0, nPts), np.clip(stop, -1, nPts-1)
+
+@jit(nopython=True)
+def _rolling_quantile_sorted(data, start, stop, q, minPeriods):
+    """
+    quantile of a sliding window. The valid values of the current window
+    are kept in a sorted buffer, values entering/leaving the window are
+    placed/removed via binary search, so each step costs O(log(w)+w) in
+    compiled code instead of a full sort.
+    """
+    nPts = data.shape[0]
+    result = np.empty(nPts)
+    buf = np.empty(int((stop-start).max())+2)
+    nBuf = 0
+    iLow = 0   #first index in window
+    iHigh = 0  #first index not yet added
+    for i in range(nPts):
+        while iHigh <= stop[i]:
+            val = data[iHigh]
+            if val == val:
+                pos = np.searchsorted(buf[:nBuf], val)
+                buf[pos+1:nBuf+1] = buf[pos:nBuf].copy()
+                buf[pos] = val
+                nBuf += 1
+            iHigh += 1
+        while iLow < start[i]:
+            val = data[iLow]
+            if val == val:
+                pos = np.searchsorted(buf[:nBuf], val)
+                buf[pos:nBuf-1] = buf[pos+1:nBuf].copy()
+                nBuf -= 1
+            iLow += 1
+        if nBuf < minPeriods or nBuf == 0:
+            result[i] = np.nan
+            continue
+        fpos = q*(nBuf-1)
+        lpos = int(np.floor(fpos))
+        if lpos >= nBuf-1:
+            result[i] = buf[nBuf-1]
+        else:
+            frac = fpos - lpos
+            result[i] = buf[lpos] + frac*(buf[lpos+1]-buf[lpos])
+    return result
+
+def _prepare(seq, windowsize):
+    data = np.asarray(seq, dtype=float).ravel()
+    windowsize = int(windowsize)
+    if windowsize < 1:
+        raise ValueError('windowsize needs to be at least 1, got %d'%windowsize)
+    return data, windowsize
+
+def rolling_quantile(seq, q, windowsize=10, center=False, minPeriods=1):
+    """
+    rolling quantile (linear interpolation as in np.quantile).
+    parameters: seq: 1-d array/list
+                q: quantile in [0,1]
+                windowsize: number of events in window
+                center: if True, window is centered on the event, else trailing
+                minPeriods: minimum number of valid (non-NaN) values needed
+    """
+    if q < 0 or q > 1:
+        raise ValueError('quantile needs to be in [0,1], got %s'%q)
+    data, windowsize = _prepare(seq, windowsize)
+    if data.shape[0] == 0:
+        return data
+    start, stop = _windowBounds(data.shape[0], windowsize, center)
+    return _rolling_quantile_sorted(data, start, stop, float(q), int(minPeriods))
+
+def rolling_median(seq, windowsize=10, center=False, minPeriods=1):
+    """ rolling median, see rolling_quantile for parameters """
+    return rolling_quantile(seq, 0.5, windowsize=windowsize, center=center, minPeriods=minPeriods)
+
+def _rolling_sums(data, windowsize, center):
+    """ windowed number of valid points, sum and sum of squares via cumulative sums """
+    valid = ~np.isnan(data)
+    #subtract an offset to limit cancellation in the sum of squares
+    offset = data[valid].mean() if valid.any() else 0.
+    vals = np.where(valid, data-offset, 0.)
+    start, stop = _windowBounds(data.shape[0], windowsize, center)
+    cN = np.concatenate([[0], np.cumsum(valid)])
+    cS = np.concatenate([[0.], np.cumsum(vals)])
+    cS2 = np.concatenate([[0.], np.cumsum(vals*vals)])
+    n = cN[stop+1]-cN[start]
+    s = cS[stop+1]-cS[start]
+    s2 = cS2[stop+1]-cS2[start]
+    return n, s, s2, offset
+
+def rolling_mean(seq, windowsize=10, center=False, minPeriods=1):
+    """ rolling mean, see rolling_quantile for parameters """
+    data, windowsize = _prepare(seq, windowsize)
+    n, s, s2, offset = _rolling_sums(data, windowsize, center)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = s/n + offset
+    result[(n < max(1,minPeriods))] = np.nan
+    return result
+
+def rolling_std(seq, windowsize=10, center=False, minPeriods=2, ddof=1):
+    """ rolling standard deviation, see rolling_quantile for parameters """
+    data, windowsize = _prepare(seq, windowsize)
+    n, s, s2, offset = _rolling_sums(data, windowsize, center)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = (s2 - s*s/n)/(n-ddof)
+    result = np.sqrt(np.clip(var, 0, None))
+    result[(n < max(1+ddof,minPeriods))] = np.nan
+    return result
+
+rollingFuncs = {'median': rolling_median,
+                'mean': rolling_mean,
+                'std': rolling_std}
+
+def rolling_stat(seq, stat='median', windowsize=10, center=False, minPeriods=1):
+    """
+    dispatch to the rolling functions by name.
+    stat: median, mean, std or a quantile given as float or string (e.g. 0.1, 'q0.1')
+    """
+    if isinstance(stat, str) and stat in rollingFuncs:
+        if stat == 'std':
+            minPeriods = max(2, minPeriods)
+        return rollingFuncs[stat](seq, windowsize=windowsize, center=center, minPeriods=minPeriods)
+    if isinstance(stat, str):
+        stat = float(stat.replace('q',''))
+    return rolling_quantile(seq, stat, windowsize=windowsize, center=center, minPeriods=minPeriods)